@@ -0,0 +1,46 @@
+"""Add tenant_id and tenant-scoped indexes
+
+Revision ID: 4b7d2e91c0a5
+Revises: 68872b39783c
+Create Date: 2026-10-19 09:12:44.318502
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4b7d2e91c0a5'
+down_revision: Union[str, Sequence[str], None] = '68872b39783c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing rows keep a NULL tenant; they are claimed by the first tenant
+    # that syncs them again (see db.upsert_transactions).
+    for table in ('accounts', 'balance_snapshots', 'transactions'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('tenant_id', sa.String(length=64),
+                                          nullable=True))
+
+    op.create_index('ix_acct_tenant', 'accounts', ['tenant_id', 'id'],
+                    unique=False)
+    op.create_index('ix_bal_tenant_acct_asof', 'balance_snapshots',
+                    ['tenant_id', 'account_id', 'as_of'], unique=False)
+    op.create_index('ix_txn_tenant_acct_date', 'transactions',
+                    ['tenant_id', 'account_id', 'date'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_txn_tenant_acct_date', table_name='transactions')
+    op.drop_index('ix_bal_tenant_acct_asof', table_name='balance_snapshots')
+    op.drop_index('ix_acct_tenant', table_name='accounts')
+
+    for table in ('transactions', 'balance_snapshots', 'accounts'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('tenant_id')
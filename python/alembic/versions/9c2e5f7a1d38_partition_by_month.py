@@ -0,0 +1,185 @@
+"""Range-partition transactions and balance_snapshots by month (Postgres)
+
+Revision ID: 9c2e5f7a1d38
+Revises: 4b7d2e91c0a5
+Create Date: 2026-10-19 10:41:07.902114
+
+On Postgres, both tables are rebuilt as RANGE-partitioned tables with one
+partition per month covering the existing data plus three months ahead, and
+a DEFAULT partition for rows without a date. Later months are created by
+``partitions.py`` (run at startup and from cron). Partitioned tables need the
+partition key in every unique constraint, so the primary keys become
+(id, date) and (id, as_of); the ORM keeps treating ``id`` as the key.
+Transaction ids stay unique across partitions through ``transaction_ids``,
+kept up to date by a trigger: a transaction whose date changed between
+syncs cannot be stored a second time. Balance snapshot ids come from a
+sequence and need no such guard.
+
+Other databases are left untouched.
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c2e5f7a1d38'
+down_revision: Union[str, Sequence[str], None] = '4b7d2e91c0a5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MONTHS_AHEAD = 3
+
+TABLES = {
+    'transactions': {
+        'key': 'date',
+        'columns': """
+            id VARCHAR NOT NULL,
+            account_id VARCHAR REFERENCES accounts (id),
+            date DATE,
+            description VARCHAR,
+            amount NUMERIC(14, 2),
+            raw JSON,
+            tenant_id VARCHAR(64)""",
+        'indexes': [
+            ('ix_transactions_account_id', 'account_id', False),
+            ('ix_transactions_date', 'date', False),
+            ('ix_txn_acct_date', 'account_id, date', False),
+            ('ix_txn_tenant_acct_date', 'tenant_id, account_id, date', False),
+        ],
+    },
+    'balance_snapshots': {
+        'key': 'as_of',
+        'columns': """
+            id INTEGER NOT NULL DEFAULT nextval('balance_snapshots_id_seq'),
+            account_id VARCHAR REFERENCES accounts (id),
+            available NUMERIC(14, 2),
+            ledger NUMERIC(14, 2),
+            as_of TIMESTAMP WITHOUT TIME ZONE,
+            raw JSON,
+            tenant_id VARCHAR(64)""",
+        'indexes': [
+            ('ix_balance_snapshots_account_id', 'account_id', False),
+            ('ix_balance_snapshots_as_of', 'as_of', False),
+            ('ix_bal_tenant_acct_asof', 'tenant_id, account_id, as_of', False),
+            ('uq_bal_asof', 'account_id, as_of', True),
+        ],
+    },
+}
+
+
+def _add_months(d, months):
+    index = d.year * 12 + (d.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+# Every stored transaction id, whatever partition its row is in.
+ID_GUARD = """
+CREATE TABLE transaction_ids (id VARCHAR PRIMARY KEY);
+
+CREATE FUNCTION transactions_guard_id() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM transaction_ids WHERE id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO transaction_ids (id) VALUES (NEW.id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER transactions_guard_id
+    AFTER INSERT OR UPDATE OF id OR DELETE ON transactions
+    FOR EACH ROW EXECUTE FUNCTION transactions_guard_id();
+"""
+
+
+def _month_range(bind, table, key):
+    first = bind.execute(sa.text(
+        f'SELECT min("{key}") FROM "{table}_unpartitioned"')).scalar()
+    today = date.today()
+    start = date(first.year, first.month, 1) if first else date(
+        today.year, today.month, 1)
+    end = _add_months(date(today.year, today.month, 1), MONTHS_AHEAD)
+    month = start
+    while month <= end:
+        yield month
+        month = _add_months(month, 1)
+
+
+def _drop_indexes(table, spec):
+    for name, _, unique in spec['indexes']:
+        if unique:
+            op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS "{name}"')
+        op.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    for table, spec in TABLES.items():
+        key = spec['key']
+        op.execute(f'ALTER TABLE "{table}" RENAME TO "{table}_unpartitioned"')
+        _drop_indexes(f'{table}_unpartitioned', spec)
+        op.execute(f'ALTER TABLE "{table}_unpartitioned" '
+                   f'RENAME CONSTRAINT "{table}_pkey" TO "{table}_unpartitioned_pkey"')
+        op.execute(f'CREATE TABLE "{table}" ({spec["columns"]}, '
+                   f'CONSTRAINT "{table}_pkey" PRIMARY KEY (id, "{key}")) '
+                   f'PARTITION BY RANGE ("{key}")')
+        if table == 'transactions':
+            op.execute(ID_GUARD)
+        for month in _month_range(bind, table, key):
+            name = f"{table}_p{month.year:04d}_{month.month:02d}"
+            op.execute(f'CREATE TABLE "{name}" PARTITION OF "{table}" '
+                       f"FOR VALUES FROM ('{month.isoformat()}') "
+                       f"TO ('{_add_months(month, 1).isoformat()}')")
+        op.execute(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT')
+        op.execute(f'INSERT INTO "{table}" SELECT id, account_id, '
+                   + ('date, description, amount, raw, tenant_id'
+                      if table == 'transactions'
+                      else 'available, ledger, as_of, raw, tenant_id')
+                   + f' FROM "{table}_unpartitioned"')
+        if table == 'balance_snapshots':
+            op.execute('ALTER SEQUENCE balance_snapshots_id_seq '
+                       'OWNED BY balance_snapshots.id')
+        op.execute(f'DROP TABLE "{table}_unpartitioned"')
+        for name, columns, unique in spec['indexes']:
+            op.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX "{name}" '
+                       f'ON "{table}" ({columns})')
+        op.execute(f'ANALYZE "{table}"')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    op.execute('DROP TRIGGER transactions_guard_id ON transactions')
+    op.execute('DROP FUNCTION transactions_guard_id()')
+    op.execute('DROP TABLE transaction_ids')
+    for table, spec in TABLES.items():
+        op.execute(f'ALTER TABLE "{table}" RENAME TO "{table}_partitioned"')
+        _drop_indexes(f'{table}_partitioned', spec)
+        op.execute(f'ALTER TABLE "{table}_partitioned" '
+                   f'RENAME CONSTRAINT "{table}_pkey" TO "{table}_partitioned_pkey"')
+        op.execute(f'CREATE TABLE "{table}" ({spec["columns"]}, '
+                   f'CONSTRAINT "{table}_pkey" PRIMARY KEY (id))')
+        op.execute(f'INSERT INTO "{table}" SELECT * FROM "{table}_partitioned"')
+        if table == 'balance_snapshots':
+            op.execute('ALTER SEQUENCE balance_snapshots_id_seq '
+                       'OWNED BY balance_snapshots.id')
+        # Dropping the parent drops every attached partition with it.
+        op.execute(f'DROP TABLE "{table}_partitioned"')
+        for name, columns, unique in spec['indexes']:
+            if unique:
+                op.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" '
+                           f'UNIQUE ({columns})')
+            else:
+                op.execute(f'CREATE INDEX "{name}" ON "{table}" ({columns})')
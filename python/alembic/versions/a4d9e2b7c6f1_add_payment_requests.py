@@ -0,0 +1,50 @@
+"""Add payment_requests table
+
+Revision ID: a4d9e2b7c6f1
+Revises: f2c6d8a1b3e5
+Create Date: 2026-10-19 17:52:19.660417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4d9e2b7c6f1'
+down_revision: Union[str, Sequence[str], None] = 'f2c6d8a1b3e5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'payment_requests',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('tenant_id', sa.String(length=64), nullable=True),
+        sa.Column('idempotency_key', sa.String(length=255), nullable=False),
+        sa.Column('kind', sa.String(length=16), nullable=False),
+        sa.Column('account_id', sa.String(), nullable=False),
+        sa.Column('scheme', sa.String(), nullable=False),
+        sa.Column('body', sa.JSON(), nullable=True),
+        sa.Column('body_hash', sa.String(length=64), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('response_status', sa.Integer(), nullable=True),
+        sa.Column('response', sa.JSON(), nullable=True),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('tenant_id', 'idempotency_key', name='uq_payment_idem')
+    )
+    op.create_index('ix_payment_status_updated', 'payment_requests',
+                    ['status', 'updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_payment_status_updated', table_name='payment_requests')
+    op.drop_table('payment_requests')
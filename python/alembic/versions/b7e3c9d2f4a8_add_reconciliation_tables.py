@@ -0,0 +1,56 @@
+"""Add reconciliation_checkpoints and balance_discrepancies tables
+
+Revision ID: b7e3c9d2f4a8
+Revises: a4d9e2b7c6f1
+Create Date: 2026-10-19 21:14:02.318457
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3c9d2f4a8'
+down_revision: Union[str, Sequence[str], None] = 'a4d9e2b7c6f1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'reconciliation_checkpoints',
+        sa.Column('account_id', sa.String(), nullable=False),
+        sa.Column('tenant_id', sa.String(length=64), nullable=True),
+        sa.Column('as_of', sa.DateTime(), nullable=False),
+        sa.Column('ledger', sa.Numeric(precision=14, scale=2), nullable=False),
+        sa.Column('checked_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+        sa.PrimaryKeyConstraint('account_id')
+    )
+    op.create_table(
+        'balance_discrepancies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('account_id', sa.String(), nullable=False),
+        sa.Column('tenant_id', sa.String(length=64), nullable=True),
+        sa.Column('kind', sa.String(length=16), nullable=False),
+        sa.Column('stored_ledger', sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column('expected_ledger', sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column('difference', sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column('as_of', sa.DateTime(), nullable=True),
+        sa.Column('detected_at', sa.DateTime(), nullable=False),
+        sa.Column('resolved_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_discrepancy_open', 'balance_discrepancies',
+                    ['resolved_at', 'account_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_discrepancy_open', table_name='balance_discrepancies')
+    op.drop_table('balance_discrepancies')
+    op.drop_table('reconciliation_checkpoints')
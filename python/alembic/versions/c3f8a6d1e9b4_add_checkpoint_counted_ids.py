@@ -0,0 +1,31 @@
+"""Add counted_ids to reconciliation_checkpoints
+
+Revision ID: c3f8a6d1e9b4
+Revises: b7e3c9d2f4a8
+Create Date: 2026-10-19 14:22:51.604318
+
+Existing checkpoints keep NULL, which reconcile treats as "every
+transaction of the checkpoint's day is counted", as before.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f8a6d1e9b4'
+down_revision: Union[str, Sequence[str], None] = 'b7e3c9d2f4a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('reconciliation_checkpoints',
+                  sa.Column('counted_ids', sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('reconciliation_checkpoints', 'counted_ids')
@@ -0,0 +1,50 @@
+"""Add recurring_series index table
+
+Revision ID: d5a8e3f6b2c1
+Revises: 9c2e5f7a1d38
+Create Date: 2026-10-19 12:03:51.227630
+
+Run ``python recurring.py --rebuild`` once afterwards to index the
+transactions that are already stored.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a8e3f6b2c1'
+down_revision: Union[str, Sequence[str], None] = '9c2e5f7a1d38'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'recurring_series',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('account_id', sa.String(), nullable=False),
+        sa.Column('tenant_id', sa.String(length=64), nullable=True),
+        sa.Column('counterparty', sa.String(), nullable=False),
+        sa.Column('amount_band', sa.Integer(), nullable=False),
+        sa.Column('occurrences', sa.Integer(), nullable=False),
+        sa.Column('dates', sa.JSON(), nullable=False),
+        sa.Column('amounts', sa.JSON(), nullable=False),
+        sa.Column('average_amount', sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column('period', sa.String(), nullable=True),
+        sa.Column('last_date', sa.Date(), nullable=True),
+        sa.Column('next_expected', sa.Date(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_recurring_acct_next', 'recurring_series',
+                    ['account_id', 'next_expected'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_recurring_acct_next', table_name='recurring_series')
+    op.drop_table('recurring_series')
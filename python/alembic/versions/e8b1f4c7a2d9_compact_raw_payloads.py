@@ -0,0 +1,101 @@
+"""Store raw payloads compactly (JSONB on Postgres, compressed elsewhere)
+
+Revision ID: e8b1f4c7a2d9
+Revises: d5a8e3f6b2c1
+Create Date: 2026-10-19 15:41:08.503217
+
+Fields duplicated in columns are stripped from every stored payload (see
+payloads.compact). Rows are rewritten in batches of BATCH_SIZE.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+import payloads
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b1f4c7a2d9'
+down_revision: Union[str, Sequence[str], None] = 'd5a8e3f6b2c1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+# table -> columns holding payload fields, as in db.*.PAYLOAD_COLUMNS
+TABLES = {
+    'transactions': [sa.column('id', sa.String()),
+                     sa.column('account_id', sa.String()),
+                     sa.column('date', sa.Date()),
+                     sa.column('description', sa.String()),
+                     sa.column('amount', sa.Numeric(14, 2))],
+    'balance_snapshots': [sa.column('account_id', sa.String()),
+                          sa.column('available', sa.Numeric(14, 2)),
+                          sa.column('ledger', sa.Numeric(14, 2))],
+}
+
+
+def _rewrite(table_name, columns, convert, read_type, write_type):
+    """Pass every row's raw payload through ``convert``, one batch at a time."""
+    bind = op.get_bind()
+    pk = sa.column('id')
+    raw = sa.column('raw', read_type)
+    others = [c for c in columns if c.name != 'id']
+    table = sa.table(table_name, pk, raw, *others)
+    update = (table.update()
+              .where(pk == sa.bindparam('_id'))
+              .values(raw=sa.bindparam('_raw', type_=write_type)))
+    last = None
+    while True:
+        query = sa.select(pk, raw, *others).order_by(pk).limit(BATCH_SIZE)
+        if last is not None:
+            query = query.where(pk > last)
+        rows = bind.execute(query).all()
+        if not rows:
+            break
+        params = []
+        for row in rows:
+            values = dict(row._mapping)
+            stored = values.pop('raw')
+            if stored is None:
+                continue
+            fields = {c.name: values[c.name] for c in columns}
+            params.append({'_id': values['id'], '_raw': convert(stored, fields)})
+        if params:
+            bind.execute(update, params)
+        last = rows[-1][0]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    postgres = op.get_bind().dialect.name == 'postgresql'
+    for table_name, columns in TABLES.items():
+        if postgres:
+            op.execute(f'ALTER TABLE "{table_name}" ALTER COLUMN raw '
+                       f'TYPE JSONB USING raw::jsonb')
+            raw_type = postgresql.JSONB()
+        else:
+            with op.batch_alter_table(table_name) as batch_op:
+                batch_op.alter_column('raw', existing_type=sa.JSON(),
+                                      type_=sa.LargeBinary())
+            raw_type = payloads.CompactJSON()
+        _rewrite(table_name, columns, payloads.compact, raw_type, raw_type)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    postgres = op.get_bind().dialect.name == 'postgresql'
+    for table_name, columns in TABLES.items():
+        if postgres:
+            _rewrite(table_name, columns, payloads.expand,
+                     postgresql.JSONB(), postgresql.JSONB())
+            op.execute(f'ALTER TABLE "{table_name}" ALTER COLUMN raw '
+                       f'TYPE JSON USING raw::json')
+        else:
+            _rewrite(table_name, columns, payloads.expand,
+                     payloads.CompactJSON(), sa.JSON())
+            with op.batch_alter_table(table_name) as batch_op:
+                batch_op.alter_column('raw', existing_type=sa.LargeBinary(),
+                                      type_=sa.JSON())
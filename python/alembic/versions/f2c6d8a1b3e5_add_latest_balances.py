@@ -0,0 +1,46 @@
+"""Add latest_balances table
+
+Revision ID: f2c6d8a1b3e5
+Revises: e8b1f4c7a2d9
+Create Date: 2026-10-19 16:27:44.118903
+
+Filled from the newest balance_snapshots row of each account.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2c6d8a1b3e5'
+down_revision: Union[str, Sequence[str], None] = 'e8b1f4c7a2d9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'latest_balances',
+        sa.Column('account_id', sa.String(), nullable=False),
+        sa.Column('tenant_id', sa.String(length=64), nullable=True),
+        sa.Column('available', sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column('ledger', sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column('as_of', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+        sa.PrimaryKeyConstraint('account_id')
+    )
+    op.execute(
+        "INSERT INTO latest_balances "
+        "(account_id, tenant_id, available, ledger, as_of) "
+        "SELECT b.account_id, b.tenant_id, b.available, b.ledger, b.as_of "
+        "FROM balance_snapshots b "
+        "JOIN (SELECT account_id, MAX(as_of) AS as_of FROM balance_snapshots "
+        "      WHERE account_id IS NOT NULL GROUP BY account_id) newest "
+        "ON b.account_id = newest.account_id AND b.as_of = newest.as_of")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('latest_balances')
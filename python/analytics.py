@@ -0,0 +1,145 @@
+"""Vectorized analytics over an account's stored transactions.
+
+Transactions are pulled as plain column tuples (no ORM objects) into NumPy
+arrays, and every statistic below is computed with array operations.
+"""
+import numpy as np
+from sqlalchemy import select
+
+from db import Transaction, tenant_filter
+from recurring import (MAX_TRACKED_DATES, amount_band, classify,
+                       normalize_counterparty)
+
+
+def load_columns(s, account_id, tenant_id=None, account_ids=()):
+    """Return ``(dates, amounts, descriptions)`` arrays sorted by date."""
+    rows = s.execute(
+        select(Transaction.date, Transaction.amount, Transaction.description)
+        .where(Transaction.account_id == account_id)
+        .where(Transaction.date.is_not(None))
+        .where(tenant_filter(Transaction, tenant_id, account_ids))
+        .order_by(Transaction.date)
+    ).all()
+    if not rows:
+        return (np.array([], dtype='datetime64[D]'), np.array([], dtype=float),
+                np.array([], dtype=object))
+    dates, amounts, descriptions = zip(*rows)
+    return (np.array(dates, dtype='datetime64[D]'),
+            np.array([float(a or 0) for a in amounts], dtype=float),
+            np.array(descriptions, dtype=object))
+
+
+def daily_cash_flow(dates, amounts):
+    """Inflow, outflow and net per calendar day, including empty days."""
+    if dates.size == 0:
+        empty = np.array([], dtype=float)
+        return np.array([], dtype='datetime64[D]'), empty, empty, empty
+    offsets = (dates - dates.min()).astype(int)
+    length = offsets.max() + 1
+    inflow = np.bincount(offsets, weights=np.where(amounts > 0, amounts, 0),
+                         minlength=length)
+    outflow = np.bincount(offsets, weights=np.where(amounts < 0, amounts, 0),
+                          minlength=length)
+    days = dates.min() + np.arange(length)
+    return days, inflow, outflow, inflow + outflow
+
+
+def monthly_cash_flow(dates, amounts):
+    if dates.size == 0:
+        return []
+    months = dates.astype('datetime64[M]')
+    unique, index = np.unique(months, return_inverse=True)
+    inflow = np.bincount(index, weights=np.where(amounts > 0, amounts, 0))
+    outflow = np.bincount(index, weights=np.where(amounts < 0, amounts, 0))
+    return [{'month': str(m), 'inflow': round(i, 2), 'outflow': round(o, 2),
+             'net': round(i + o, 2)}
+            for m, i, o in zip(unique, inflow.tolist(), outflow.tolist())]
+
+
+def rolling_mean(values, window):
+    """Trailing mean over ``window`` points (shorter at the start)."""
+    if values.size == 0:
+        return values
+    csum = np.cumsum(np.insert(values, 0, 0.0))
+    ends = np.arange(1, values.size + 1)
+    starts = np.maximum(ends - window, 0)
+    return (csum[ends] - csum[starts]) / (ends - starts)
+
+
+def _robust_outliers(amounts, threshold):
+    if amounts.size < 3:
+        return np.zeros(amounts.size, dtype=bool)
+    deviation = np.abs(amounts - np.median(amounts))
+    mad = np.median(deviation)
+    if mad > 0:
+        return 0.6745 * deviation / mad > threshold
+    # Over half the amounts are equal (a recurring charge, say): scale by
+    # the mean absolute deviation instead, which is only 0 if all are.
+    mean_ad = np.mean(deviation)
+    if mean_ad == 0:
+        return np.zeros(amounts.size, dtype=bool)
+    return deviation / (1.2533 * mean_ad) > threshold
+
+
+def anomaly_flags(amounts, threshold=3.5):
+    """Robust z-score (median/MAD) outliers among the amounts.
+
+    Debits and credits are scored separately, so deposits are not measured
+    against spending.
+    """
+    flags = np.zeros(amounts.size, dtype=bool)
+    for side in (amounts < 0, amounts > 0):
+        flags[side] = _robust_outliers(amounts[side], threshold)
+    return flags
+
+
+def recurring_charges(dates, amounts, descriptions):
+    """Recurring series among the transactions, grouped and classified as
+    by the index in ``recurring`` (counterparty and amount band)."""
+    groups = {}
+    for i, (description, amount) in enumerate(zip(descriptions, amounts)):
+        counterparty = normalize_counterparty(description)
+        if counterparty:
+            groups.setdefault((counterparty, amount_band(amount)),
+                              []).append(i)
+    results = []
+    for (counterparty, _), rows in groups.items():
+        tracked = np.array(rows[-MAX_TRACKED_DATES:])
+        group_dates = dates[tracked]
+        period, gap = classify(group_dates.tolist())
+        if period is None:
+            continue
+        results.append({
+            'counterparty': counterparty,
+            'period': period,
+            'occurrences': len(rows),
+            'average_amount': round(float(np.mean(amounts[tracked])), 2),
+            'last_date': str(group_dates[-1]),
+            'next_expected': str(group_dates[-1] + int(round(gap))),
+        })
+    return sorted(results, key=lambda r: r['average_amount'])
+
+
+def account_analytics(s, account_id, window=30, tenant_id=None,
+                      account_ids=()):
+    dates, amounts, descriptions = load_columns(s, account_id, tenant_id,
+                                                account_ids)
+    days, inflow, outflow, net = daily_cash_flow(dates, amounts)
+    flags = anomaly_flags(amounts)
+    return {
+        'account_id': account_id,
+        'transactions': int(dates.size),
+        'daily': [{'date': str(d), 'inflow': round(i, 2),
+                   'outflow': round(o, 2), 'net': round(n, 2),
+                   'rolling_net': round(r, 2)}
+                  for d, i, o, n, r in zip(days, inflow.tolist(),
+                                           outflow.tolist(), net.tolist(),
+                                           rolling_mean(net, window).tolist())],
+        'monthly': monthly_cash_flow(dates, amounts),
+        'recurring': recurring_charges(dates, amounts, descriptions),
+        'anomalies': [{'date': str(d), 'amount': round(a, 2),
+                       'description': desc}
+                      for d, a, desc in zip(dates[flags],
+                                            amounts[flags].tolist(),
+                                            descriptions[flags])],
+    }
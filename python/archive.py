@@ -0,0 +1,306 @@
+"""Cold storage for old transactions.
+
+Transactions older than a cutoff are moved out of the database into
+zstd-compressed Parquet files, one per account and month::
+
+    <TRANSACTION_ARCHIVE_DIR>/2023-04/acc_123.parquet
+    <TRANSACTION_ARCHIVE_DIR>/manifest.json
+
+The manifest lists every file with its account, month and date range so
+readers can tell which files a query needs without opening any of them.
+Its ``archived_before`` day marks the history that lives here. Teller
+keeps returning those transactions, and db skips the ids found in the
+account's files instead of storing them again. Requires the ``pyarrow``
+package.
+
+    python archive.py --before 2024-01-01
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("The transaction archive needs the 'pyarrow' "
+                           "package: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def default_root():
+    return Path(os.getenv('TRANSACTION_ARCHIVE_DIR', 'archive'))
+
+
+_readers = {}
+
+
+def default_reader():
+    """The ArchiveReader of default_root(), shared by the process."""
+    root = default_root()
+    reader = _readers.get(root)
+    if reader is None:
+        reader = _readers.setdefault(root, ArchiveReader(root))
+    return reader
+
+
+def load_manifest(root):
+    path = Path(root) / MANIFEST
+    if not path.exists():
+        return {'version': 0, 'files': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(root, manifest):
+    manifest['version'] += 1
+    manifest['updated_at'] = datetime.utcnow().isoformat()
+    path = Path(root) / MANIFEST
+    tmp = path.with_suffix('.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _write_partition(root, month, account_id, rows):
+    """Write (or extend) one account-month file; return its manifest entry."""
+    pa, pq = _require_pyarrow()
+    rel = f"{month}/{account_id}.parquet"
+    path = Path(root) / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    schema = pa.schema([
+        ('id', pa.string()),
+        ('account_id', pa.string()),
+        ('date', pa.date32()),
+        ('description', pa.string()),
+        ('amount', pa.string()),
+        ('raw', pa.string()),
+        ('tenant_id', pa.string()),
+    ])
+    new = pa.table({
+        'id': [r.id for r in rows],
+        'account_id': [r.account_id for r in rows],
+        'date': [r.date for r in rows],
+        'description': [r.description for r in rows],
+        'amount': [str(r.amount) if r.amount is not None else None
+                   for r in rows],
+        'raw': [json.dumps(r.payload()) for r in rows],
+        'tenant_id': [r.tenant_id for r in rows],
+    }, schema=schema)
+    if path.exists():
+        old = pq.read_table(path)
+        known = set(new.column('id').to_pylist())
+        keep = [i for i, txn_id in enumerate(old.column('id').to_pylist())
+                if txn_id not in known]
+        new = pa.concat_tables([old.take(keep).cast(schema), new])
+    new = new.sort_by([('date', 'descending'), ('id', 'ascending')])
+
+    tmp = path.with_suffix('.parquet.tmp')
+    pq.write_table(new, tmp, compression='zstd')
+    os.replace(tmp, path)
+    dates = new.column('date').to_pylist()
+    return rel, {
+        'account_id': account_id,
+        'month': month,
+        'rows': new.num_rows,
+        'min_date': min(dates).isoformat(),
+        'max_date': max(dates).isoformat(),
+    }
+
+
+def archive_transactions(session_factory, before, root=None, batch_size=5000,
+                         dry_run=False):
+    """Move transactions dated before ``before`` into the archive.
+
+    Rows are deleted from the database only after their file and the
+    manifest have been written, so an interrupted run never loses data;
+    re-running it simply rewrites the affected files.
+    """
+    from sqlalchemy import func
+    from db import Transaction
+
+    if dry_run:
+        with session_factory() as s:
+            return (s.query(func.count(Transaction.id))
+                    .filter(Transaction.date < before)
+                    .scalar())
+
+    root = Path(root or default_root())
+    root.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(root)
+    moved = 0
+    while True:
+        with session_factory() as s:
+            rows = (s.query(Transaction)
+                    .filter(Transaction.date < before)
+                    .order_by(Transaction.account_id, Transaction.date)
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                break
+            groups = {}
+            for r in rows:
+                groups.setdefault((r.date.strftime('%Y-%m'), r.account_id),
+                                  []).append(r)
+            for (month, account_id), group in groups.items():
+                rel, entry = _write_partition(root, month, account_id, group)
+                manifest['files'][rel] = entry
+            _write_manifest(root, manifest)
+            (s.query(Transaction)
+             .filter(Transaction.id.in_([r.id for r in rows]))
+             .delete(synchronize_session=False))
+            s.commit()
+            moved += len(rows)
+            logger.info(f"Archived {moved} transactions so far")
+    manifest.setdefault('archived_before', None)
+    if (manifest['archived_before'] is None
+            or manifest['archived_before'] < before.isoformat()):
+        manifest['archived_before'] = before.isoformat()
+        _write_manifest(root, manifest)
+    return moved
+
+
+class ArchiveReader:
+    """Reads archived transactions through memory-mapped Parquet files."""
+
+    # Accounts whose archived ids are kept in memory.
+    IDS_CACHE_SIZE = 1000
+
+    def __init__(self, root=None):
+        self._root = Path(root or default_root())
+        self._manifest = None
+        self._mtime = None
+        self._ids = OrderedDict()  # account_id -> frozenset of archived ids
+        self._lock = threading.Lock()
+
+    def _current_manifest(self):
+        path = self._root / MANIFEST
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return {'version': 0, 'files': {}}
+        with self._lock:
+            if mtime != self._mtime:
+                self._manifest = load_manifest(self._root)
+                self._mtime = mtime
+                self._ids.clear()
+            return self._manifest
+
+    def version(self):
+        return self._current_manifest()['version']
+
+    def archived_before(self):
+        """Transactions dated before this day are archived; None if none."""
+        cutoff = self._current_manifest().get('archived_before')
+        return date.fromisoformat(cutoff) if cutoff else None
+
+    def files_for(self, account_id):
+        files = self._current_manifest()['files']
+        return sorted((rel for rel, entry in files.items()
+                       if entry['account_id'] == account_id),
+                      key=lambda rel: files[rel]['month'], reverse=True)
+
+    def archived_ids(self, account_id):
+        """Ids of the archived transactions of ``account_id``.
+
+        Only the id column of the account's files is read, once per
+        manifest change.
+        """
+        files = self.files_for(account_id)
+        if not files:
+            return frozenset()
+        with self._lock:
+            ids = self._ids.get(account_id)
+            if ids is not None:
+                self._ids.move_to_end(account_id)
+                return ids
+        try:
+            _, pq = _require_pyarrow()
+        except RuntimeError:
+            logger.warning(f"Archived transactions for {account_id} exist but "
+                           f"pyarrow is not installed", exc_info=True)
+            return frozenset()
+        ids = frozenset(
+            txn_id for rel in files
+            for txn_id in pq.read_table(self._root / rel, memory_map=True,
+                                        columns=['id']).column('id').to_pylist())
+        with self._lock:
+            self._ids[account_id] = ids
+            while len(self._ids) > self.IDS_CACHE_SIZE:
+                self._ids.popitem(last=False)
+        return ids
+
+    def read(self, account_id, limit, tenant_id=None, account_ids=()):
+        """Newest-first raw transactions for ``account_id``, at most ``limit``.
+
+        Rows archived without a tenant are only read for ``account_ids``;
+        see db.tenant_filter.
+        """
+        legacy = tenant_id is None or account_id in account_ids
+        files = self.files_for(account_id)
+        if not files or limit <= 0:
+            return []
+        try:
+            _, pq = _require_pyarrow()
+        except RuntimeError:
+            logger.warning(f"Archived transactions for {account_id} exist but "
+                           f"pyarrow is not installed", exc_info=True)
+            return []
+        out = []
+        for rel in files:
+            table = pq.read_table(self._root / rel, memory_map=True,
+                                  columns=['raw', 'tenant_id'])
+            raws = table.column('raw').to_pylist()
+            tenants = table.column('tenant_id').to_pylist()
+            for raw, tenant in zip(raws, tenants):
+                if tenant_id is not None and tenant != tenant_id and not (
+                        tenant is None and legacy):
+                    continue
+                out.append(json.loads(raw))
+                if len(out) >= limit:
+                    return out
+        return out
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Move old transactions into compressed Parquet files')
+    parser.add_argument('--before', required=True, type=date.fromisoformat,
+                        help='archive transactions dated before this day '
+                             '(YYYY-MM-DD)')
+    parser.add_argument('--root', type=Path, default=None,
+                        help='archive directory (default '
+                             '$TRANSACTION_ARCHIVE_DIR or ./archive)')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--dry-run', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    args = _parse_args(argv)
+    _require_pyarrow()
+    from db import SessionLocal
+    moved = archive_transactions(SessionLocal, args.before, args.root,
+                                 args.batch_size, args.dry_run)
+    logger.info(f"{'Found' if args.dry_run else 'Archived'} {moved} "
+                f"transactions dated before {args.before}")
+
+
+if __name__ == '__main__':
+    main()
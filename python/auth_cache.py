@@ -0,0 +1,71 @@
+"""Per-user state for proxied requests, keyed by a hash of the credentials.
+
+Decoding the Authorization header and building a Teller client happens
+once per user and TTL instead of on every request. Each entry also keeps
+the ids of the user's accounts once they are known, so requests for other
+account ids can be rejected without asking Teller.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedUser:
+
+    def __init__(self, token, tenant_id, client):
+        self.token = token
+        self.tenant_id = tenant_id
+        self.client = client  # shares the parent client's connection pool
+        self._accounts = None
+        self._accounts_at = 0.0
+
+    @property
+    def accounts(self):
+        """Ids of the user's accounts, or None if not fetched yet."""
+        return self._accounts
+
+    def accounts_age(self):
+        return time.monotonic() - self._accounts_at
+
+    def set_accounts(self, account_ids):
+        self._accounts, self._accounts_at = (frozenset(account_ids),
+                                             time.monotonic())
+
+
+class AuthCache:
+    """Bounded LRU of CachedUser objects that expire after ``ttl`` seconds."""
+
+    def __init__(self, ttl=300, max_entries=1000):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, CachedUser)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(ttl=float(os.getenv('AUTH_CACHE_TTL', '300')),
+                   max_entries=int(os.getenv('AUTH_CACHE_SIZE', '1000')))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, user):
+        if self._max_entries <= 0 or self._ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,284 @@
+"""Load the full transaction history of many enrollments from Teller.
+
+    python backfill.py --tokens-file tokens.txt --workers 8 \\
+        --cert cert.pem --cert-key key.pem
+
+The tokens file holds one Teller access token per line. Accounts are
+fetched in parallel by ``--workers`` threads, page by page, and written in
+batches through db.bulk_insert_transactions. After every batch the
+account's position is saved in a SQLite checkpoint file (``--checkpoint``),
+so an interrupted run continues where it stopped; finished accounts are
+skipped unless ``--restart`` is given. Progress and throughput are logged
+every ``--report-interval`` seconds.
+"""
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+
+import db
+import partitions
+from offline import teller_unavailable
+from shards import tenant_for_token
+
+logger = logging.getLogger(__name__)
+
+_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TellerError(Exception):
+    pass
+
+
+class Checkpoints:
+    """Per-account backfill position, kept in a SQLite file."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " account_id TEXT PRIMARY KEY,"
+            " from_id TEXT,"
+            " stored INTEGER NOT NULL DEFAULT 0,"
+            " done INTEGER NOT NULL DEFAULT 0,"
+            " updated_at TEXT NOT NULL)")
+        self._lock = threading.Lock()
+
+    def get(self, account_id):
+        """``(from_id, stored, done)`` for an account; from_id is the last
+        transaction written, or None to start from the newest."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT from_id, stored, done FROM checkpoints"
+                " WHERE account_id = ?", (account_id,)).fetchone()
+        return (row[0], row[1], bool(row[2])) if row else (None, 0, False)
+
+    def save(self, account_id, from_id, stored, done=False):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints"
+                " (account_id, from_id, stored, done, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (account_id, from_id, stored, int(done),
+                 datetime.utcnow().isoformat()))
+
+    def reset(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints")
+
+    def close(self):
+        self._conn.close()
+
+
+class Progress:
+
+    def __init__(self):
+        self.accounts_total = 0
+        self.accounts_done = 0
+        self.accounts_failed = 0
+        self.fetched = 0
+        self.stored = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return (f"{self.accounts_done}/{self.accounts_total} accounts done"
+                f" ({self.accounts_failed} failed), {self.fetched}"
+                f" transactions fetched, {self.stored} stored,"
+                f" {self.fetched / elapsed:.0f} txn/s over {elapsed:.0f}s")
+
+
+def _call(fun, retries, delay):
+    """Call Teller, retrying rate limits, server errors and unreachable
+    hosts with exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            teller_response = fun()
+        except Exception as e:
+            if not teller_unavailable(e) or attempt == retries:
+                raise
+            logger.warning(f"Teller unreachable ({e}), retrying")
+        else:
+            if (teller_response.status_code not in _RETRYABLE_STATUS_CODES
+                    or attempt == retries):
+                break
+            logger.warning(f"Teller answered {teller_response.status_code}, "
+                           f"retrying")
+        time.sleep(delay * 2 ** attempt)
+    if teller_response.status_code != 200:
+        raise TellerError(f"Teller answered {teller_response.status_code}")
+    return teller_response.json()
+
+
+class Backfill:
+
+    def __init__(self, client, checkpoints, session_factory=None, workers=8,
+                 page_size=500, batch_size=5000, retries=5, retry_delay=1.0):
+        """``session_factory(tenant_id)`` defaults to db.session_for_tenant."""
+        self._client = client
+        self._checkpoints = checkpoints
+        self._session_factory = session_factory or db.session_for_tenant
+        self._workers = workers
+        self._page_size = page_size
+        self._batch_size = batch_size
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self.progress = Progress()
+
+    def run(self, tokens):
+        """Backfill every account of every token; returns the Progress."""
+        with ThreadPoolExecutor(self._workers,
+                                thread_name_prefix='backfill') as pool:
+            listed = [pool.submit(self._accounts, token) for token in tokens]
+            jobs = []
+            for future in as_completed(listed):
+                try:
+                    token, accounts = future.result()
+                except Exception as e:
+                    logger.error(f"Could not list accounts: {e}")
+                    continue
+                self.progress.add(accounts_total=len(accounts))
+                jobs.extend(pool.submit(self._guarded, token, acct['id'])
+                            for acct in accounts)
+            for job in jobs:
+                job.result()
+        return self.progress
+
+    def _accounts(self, token):
+        client = self._client.for_user(token)
+        accounts = _call(client.list_accounts, self._retries,
+                         self._retry_delay)
+        tenant_id = tenant_for_token(token)
+        with self._session_factory(tenant_id) as s:
+            db.upsert_accounts(s, accounts, tenant_id=tenant_id)
+            s.commit()
+        return token, accounts
+
+    def _guarded(self, token, account_id):
+        try:
+            self.backfill_account(token, account_id)
+        except Exception as e:
+            self.progress.add(accounts_failed=1)
+            logger.error(f"Backfill of {account_id} failed: {e}",
+                         exc_info=not isinstance(e, TellerError))
+
+    def backfill_account(self, token, account_id):
+        from_id, stored, done = self._checkpoints.get(account_id)
+        if done:
+            self.progress.add(accounts_done=1)
+            return
+        client = self._client.for_user(token)
+        tenant_id = tenant_for_token(token)
+        batch = []
+        while True:
+            page = _call(
+                lambda: client.list_account_transactions(
+                    account_id, count=self._page_size, from_id=from_id),
+                self._retries, self._retry_delay)
+            full = len(page) >= self._page_size
+            if page and page[0]['id'] == from_id:
+                page = page[1:]  # the page starts at from_id itself
+            self.progress.add(fetched=len(page))
+            batch.extend(page)
+            if page:
+                from_id = page[-1]['id']
+            last = not full or not page
+            if len(batch) >= self._batch_size or last:
+                stored += self._write(account_id, tenant_id, batch)
+                batch = []
+                self._checkpoints.save(account_id, from_id, stored, done=last)
+            if last:
+                break
+        self.progress.add(accounts_done=1)
+        logger.info(f"Account {account_id}: {stored} transactions stored")
+
+    def _write(self, account_id, tenant_id, txns):
+        if not txns:
+            return 0
+        with self._session_factory(tenant_id) as s:
+            # History may predate the partitions created so far.
+            partitions.ensure_months(s.connection(), 'transactions',
+                                     {date.fromisoformat(t['date'])
+                                      for t in txns})
+            added = []
+            for start in range(0, len(txns), 1000):
+                added += db.bulk_insert_transactions(
+                    s, account_id, txns[start:start + 1000],
+                    tenant_id=tenant_id)
+            s.commit()
+        self.progress.add(stored=len(added))
+        return len(added)
+
+
+def _report(progress, interval, stop):
+    while not stop.wait(interval):
+        logger.info(progress.summary())
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Backfill transaction history from Teller')
+    parser.add_argument('--tokens-file', required=True,
+                        help='file with one Teller access token per line')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='accounts fetched in parallel')
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='transactions requested per Teller call')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='transactions written per database commit')
+    parser.add_argument('--checkpoint', default='backfill.sqlite',
+                        help='SQLite file recording per-account progress')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoints of earlier runs')
+    parser.add_argument('--report-interval', type=float, default=10,
+                        help='seconds between progress reports')
+    parser.add_argument('--cert', type=str,
+                        help='path to the TLS certificate')
+    parser.add_argument('--cert-key', type=str,
+                        help='path to the TLS certificate private key')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    args = _parse_args(argv)
+    from teller import TellerClient
+
+    with open(args.tokens_file) as f:
+        tokens = list(dict.fromkeys(line.strip() for line in f
+                                    if line.strip()))
+    db.init_db()
+    checkpoints = Checkpoints(args.checkpoint)
+    if args.restart:
+        checkpoints.reset()
+    cert = (args.cert, args.cert_key) if args.cert and args.cert_key else None
+    backfill = Backfill(TellerClient(cert), checkpoints,
+                        workers=args.workers, page_size=args.page_size,
+                        batch_size=args.batch_size)
+    stop = threading.Event()
+    threading.Thread(target=_report,
+                     args=(backfill.progress, args.report_interval, stop),
+                     daemon=True).start()
+    try:
+        progress = backfill.run(tokens)
+    finally:
+        stop.set()
+        checkpoints.close()
+    logger.info(progress.summary())
+    return 1 if progress.accounts_failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
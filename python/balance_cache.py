@@ -0,0 +1,169 @@
+"""In-process cache of each account's latest balance.
+
+``db.add_balance_snapshot`` writes through to the cache when its session
+commits, so a process always sees its own writes. Other processes learn
+about them through an invalidation backend: with BALANCE_CACHE_INVALIDATION
+set to a file path, every write is recorded in that SQLite file and the
+other processes drop their copy the next time they look (at most once per
+``poll_interval`` seconds). Without a backend each process only knows
+about its own writes, which is fine for a single server process.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationBackend:
+    """Carries "this account's balance changed" notices between processes."""
+
+    def publish(self, account_id):
+        pass
+
+    def poll(self):
+        """Account ids changed by other processes since the last poll."""
+        return []
+
+
+class SQLiteInvalidationBackend(InvalidationBackend):
+    """Invalidation log in a SQLite file shared by processes on one host."""
+
+    def __init__(self, path, retention=3600):
+        self._path = path
+        self._retention = retention
+        self._origin = uuid.uuid4().hex
+        self._conn = None
+        self._last_seen = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._path, check_same_thread=False,
+                                         isolation_level=None, timeout=5)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS invalidations ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " account_id TEXT NOT NULL,"
+                " origin TEXT NOT NULL,"
+                " at REAL NOT NULL)")
+            # Only changes made after this process started matter to it.
+            self._last_seen = self._conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM invalidations").fetchone()[0]
+        return self._conn
+
+    def publish(self, account_id):
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute("INSERT INTO invalidations (account_id, origin, at)"
+                         " VALUES (?, ?, ?)", (account_id, self._origin, now))
+            conn.execute("DELETE FROM invalidations WHERE at < ?",
+                         (now - self._retention,))
+
+    def poll(self):
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT seq, account_id, origin FROM invalidations"
+                " WHERE seq > ? ORDER BY seq", (self._last_seen,)).fetchall()
+            if rows:
+                self._last_seen = rows[-1][0]
+        return [account_id for _, account_id, origin in rows
+                if origin != self._origin]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class LatestBalanceCache:
+    """Bounded LRU of ``account_id -> latest balance`` dicts.
+
+    Values carry ``available``, ``ledger``, ``as_of`` and ``tenant_id``.
+    """
+
+    def __init__(self, max_entries=10000, backend=None, poll_interval=1.0):
+        self._max_entries = max_entries
+        self._backend = backend or InvalidationBackend()
+        self._poll_interval = poll_interval
+        self._next_poll = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        path = os.getenv('BALANCE_CACHE_INVALIDATION')
+        return cls(
+            max_entries=int(os.getenv('BALANCE_CACHE_SIZE', '10000')),
+            backend=SQLiteInvalidationBackend(path) if path else None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, account_id, tenant_id=None, account_ids=()):
+        """The cached balance, if ``tenant_id`` may see it; a balance
+        stored without a tenant only for ``account_ids`` (see
+        db.tenant_filter)."""
+        self._sync()
+        with self._lock:
+            value = self._entries.get(account_id)
+            if value is None:
+                return None
+            self._entries.move_to_end(account_id)
+        if tenant_id is not None and value['tenant_id'] != tenant_id and not (
+                value['tenant_id'] is None and account_id in account_ids):
+            return None
+        return value
+
+    def put(self, account_id, value):
+        """Store ``value`` unless a newer balance is already cached."""
+        if self._max_entries <= 0:
+            return
+        with self._lock:
+            current = self._entries.get(account_id)
+            if (current is not None and current['as_of'] and value['as_of']
+                    and current['as_of'] > value['as_of']):
+                return
+            self._entries[account_id] = value
+            self._entries.move_to_end(account_id)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def written(self, account_id, value):
+        """Write-through for a committed balance snapshot."""
+        self.put(account_id, value)
+        try:
+            self._backend.publish(account_id)
+        except Exception:
+            logger.warning(f"Could not publish balance invalidation for "
+                           f"{account_id}", exc_info=True)
+
+    def invalidate(self, account_id):
+        with self._lock:
+            self._entries.pop(account_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _sync(self):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self._poll_interval
+        try:
+            changed = self._backend.poll()
+        except Exception:
+            logger.warning("Could not poll balance invalidations",
+                           exc_info=True)
+            return
+        for account_id in changed:
+            self.invalidate(account_id)
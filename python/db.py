@@ -1,17 +1,59 @@
+import hashlib
+import json
 import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime, date
 from decimal import Decimal
 from sqlalchemy import (create_engine, Column, String, Integer, Numeric, Date,
-                        DateTime, ForeignKey, JSON, UniqueConstraint, Index, func)
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+                        DateTime, ForeignKey, JSON, UniqueConstraint, Index, func,
+                        event, insert, and_, or_, select, true)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import (Session, aliased, declarative_base, relationship,
+                            sessionmaker)
 
-db_url = os.getenv("DATABASE_URL", "sqlite:///devin_teller.db")
-if db_url.startswith("postgres://"):
-    db_url = db_url.replace("postgres://", "postgresql://", 1)
+import payloads
+from partitions import guarded_transaction_ids
+from balance_cache import LatestBalanceCache
+from shards import ShardRouter, StaticShardMap
 
-DB_URL = db_url
-engine = create_engine(DB_URL, future=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+def _normalize_url(url):
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+DB_URL = _normalize_url(os.getenv("DATABASE_URL", "sqlite:///devin_teller.db"))
+# Optional read replica for the /api/db read endpoints. Without one, reads
+# simply go to the primary.
+READ_DB_URL = _normalize_url(os.getenv("READ_DATABASE_URL"))
+READ_AFTER_WRITE_SECONDS = float(os.getenv("READ_AFTER_WRITE_SECONDS", "5"))
+
+class _LazySessionFactory(sessionmaker):
+    # Importing this module must stay cheap, so the engines are only created
+    # by init_engine() (called from teller.create_app) or on first use.
+    def __call__(self, **local_kw):
+        if engine is None:
+            init_engine()
+        return super().__call__(**local_kw)
+
+engine = None
+read_engine = None
+shard_router = None
+SessionLocal = _LazySessionFactory(autoflush=False, autocommit=False, future=True)
+ReadSessionLocal = _LazySessionFactory(autoflush=False, autocommit=False, future=True)
+_recent_writes = OrderedDict()
+_recent_writes_lock = threading.Lock()
+_RECENT_WRITES_MAX = 10000
+# engine -> {account_id: hash of the stored account columns}, filled on commit
+_account_hashes = weakref.WeakKeyDictionary()
+_account_hashes_lock = threading.Lock()
+_ACCOUNT_HASHES_MAX = 10000
+balance_cache = LatestBalanceCache.from_env()
+# Subsystems of the write path, bound by _load_subsystems() from
+# init_engine() or the first write instead of when this module is imported.
+archive = events = recurring = None
 Base = declarative_base()
 
 class Account(Base):
@@ -22,64 +64,610 @@ class Account(Base):
     type = Column(String)
     subtype = Column(String)
     last_four = Column(String)
+    tenant_id = Column(String(64))                  # see shards.tenant_for_token
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, onupdate=func.now())
+    __table_args__ = (Index("ix_acct_tenant", "tenant_id", "id"),)
+
+class CompactRawMixin:
+    """``raw`` holds the Teller payload minus fields kept in PAYLOAD_COLUMNS.
+
+    Use ``set_payload``/``payload()`` rather than ``raw`` directly; see
+    payloads.compact.
+    """
+    PAYLOAD_COLUMNS = ()
+
+    def _payload_columns(self):
+        return {c: getattr(self, c) for c in self.PAYLOAD_COLUMNS}
+
+    def set_payload(self, payload):
+        self.raw = payloads.compact(payload, self._payload_columns())
+
+    def payload(self):
+        return payloads.expand(self.raw, self._payload_columns())
 
-class BalanceSnapshot(Base):
+class BalanceSnapshot(CompactRawMixin, Base):
     __tablename__ = "balance_snapshots"
     id = Column(Integer, primary_key=True)
     account_id = Column(String, ForeignKey("accounts.id"), index=True)
     available = Column(Numeric(14, 2))
     ledger = Column(Numeric(14, 2))
     as_of = Column(DateTime, default=func.now(), index=True)
-    raw = Column(JSON)
+    raw = Column(payloads.CompactJSON)
+    tenant_id = Column(String(64))
     account = relationship("Account")
-    __table_args__ = (UniqueConstraint("account_id", "as_of", name="uq_bal_asof"),)
+    PAYLOAD_COLUMNS = ("account_id", "available", "ledger")
+    __table_args__ = (UniqueConstraint("account_id", "as_of", name="uq_bal_asof"),
+                      Index("ix_bal_tenant_acct_asof", "tenant_id", "account_id", "as_of"))
 
-class Transaction(Base):
+class LatestBalance(Base):
+    """Newest snapshot per account, kept up to date by add_balance_snapshot."""
+    __tablename__ = "latest_balances"
+    account_id = Column(String, ForeignKey("accounts.id"), primary_key=True)
+    tenant_id = Column(String(64))
+    available = Column(Numeric(14, 2))
+    ledger = Column(Numeric(14, 2))
+    as_of = Column(DateTime)
+
+class Transaction(CompactRawMixin, Base):
     __tablename__ = "transactions"
     id = Column(String, primary_key=True)           # Teller txn id
     account_id = Column(String, ForeignKey("accounts.id"), index=True)
     date = Column(Date, index=True)
     description = Column(String)
     amount = Column(Numeric(14, 2))
-    raw = Column(JSON)
+    raw = Column(payloads.CompactJSON)
+    tenant_id = Column(String(64))
     account = relationship("Account")
-    __table_args__ = (Index("ix_txn_acct_date", "account_id", "date"),)
+    PAYLOAD_COLUMNS = ("id", "account_id", "date", "description", "amount")
+    __table_args__ = (Index("ix_txn_acct_date", "account_id", "date"),
+                      Index("ix_txn_tenant_acct_date", "tenant_id", "account_id", "date"))
+
+class RecurringSeries(Base):
+    __tablename__ = "recurring_series"
+    id = Column(String(32), primary_key=True)       # see recurring.series_id
+    account_id = Column(String, ForeignKey("accounts.id"), nullable=False)
+    tenant_id = Column(String(64))
+    counterparty = Column(String, nullable=False)
+    amount_band = Column(Integer, nullable=False)
+    occurrences = Column(Integer, nullable=False, default=0)
+    dates = Column(JSON, nullable=False)            # most recent, ISO dates
+    amounts = Column(JSON, nullable=False)
+    average_amount = Column(Numeric(14, 2))
+    period = Column(String)                         # None until detected
+    last_date = Column(Date)
+    next_expected = Column(Date)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    __table_args__ = (Index("ix_recurring_acct_next", "account_id", "next_expected"),)
+
+class PaymentRequest(Base):
+    """A payment or payee creation submitted through payments.PaymentQueue."""
+    __tablename__ = "payment_requests"
+    id = Column(String(32), primary_key=True)
+    tenant_id = Column(String(64))
+    idempotency_key = Column(String(255), nullable=False)
+    kind = Column(String(16), nullable=False)       # "payment" or "payee"
+    account_id = Column(String, nullable=False)
+    scheme = Column(String, nullable=False)
+    body = Column(JSON)
+    body_hash = Column(String(64), nullable=False)
+    status = Column(String(16), nullable=False)     # see payments.STATUSES
+    attempts = Column(Integer, nullable=False, default=0)
+    response_status = Column(Integer)
+    response = Column(JSON)
+    error = Column(String)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    __table_args__ = (UniqueConstraint("tenant_id", "idempotency_key", name="uq_payment_idem"),
+                      Index("ix_payment_status_updated", "status", "updated_at"))
+
+class ReconciliationCheckpoint(Base):
+    """Last balance of an account that reconciled cleanly; see reconcile.py."""
+    __tablename__ = "reconciliation_checkpoints"
+    account_id = Column(String, ForeignKey("accounts.id"), primary_key=True)
+    tenant_id = Column(String(64))
+    as_of = Column(DateTime, nullable=False)
+    ledger = Column(Numeric(14, 2), nullable=False)
+    counted_ids = Column(JSON)                      # txns of as_of's day in ledger
+    checked_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class BalanceDiscrepancy(Base):
+    """A stored balance that disagrees with the stored transactions or Teller."""
+    __tablename__ = "balance_discrepancies"
+    id = Column(Integer, primary_key=True)
+    account_id = Column(String, ForeignKey("accounts.id"), nullable=False)
+    tenant_id = Column(String(64))
+    kind = Column(String(16), nullable=False)       # see reconcile.KINDS
+    stored_ledger = Column(Numeric(14, 2))
+    expected_ledger = Column(Numeric(14, 2))
+    difference = Column(Numeric(14, 2))
+    as_of = Column(DateTime)                        # of the stored balance
+    detected_at = Column(DateTime, nullable=False)
+    resolved_at = Column(DateTime)                  # None while open
+    __table_args__ = (Index("ix_discrepancy_open", "resolved_at", "account_id"),)
+
+def init_engine(url=None, read_url=None):
+    """Create the engines and bind the session factories.
+
+    Called once when the app is created; later calls are no-ops unless a
+    URL is passed explicitly.
+    """
+    global engine, read_engine, shard_router
+    if engine is not None and url is None and read_url is None:
+        return engine
+    _load_subsystems()
+    # Statement counts, N+1 warnings and the slow-query log for every engine,
+    # including the shard engines; see query_stats.
+    import query_stats
+    query_stats.install(Engine)
+    engine = create_engine(_normalize_url(url) or DB_URL, future=True)
+    read_url = _normalize_url(read_url) or READ_DB_URL
+    read_engine = (create_engine(read_url, future=True, pool_pre_ping=True)
+                   if read_url else engine)
+    SessionLocal.configure(bind=engine)
+    ReadSessionLocal.configure(bind=read_engine)
+    # Tenants are stored in the default database unless TENANT_SHARDS (or a
+    # custom ShardMap assigned to shard_router.shard_map) places them elsewhere.
+    shard_router = ShardRouter(engine, Base.metadata, StaticShardMap.from_env())
+    return engine
+
+def _load_subsystems():
+    global archive, events, recurring
+    if recurring is None:
+        import archive
+        import events
+        import recurring
 
 def init_db():
-    Base.metadata.create_all(engine)
-
-def upsert_account(s, acct_json):
-    obj = s.get(Account, acct_json["id"]) or Account(id=acct_json["id"])
-    obj.name = acct_json.get("name")
-    obj.institution_id = acct_json.get("institution", {}).get("id")
-    obj.type = acct_json.get("type")
-    obj.subtype = acct_json.get("subtype")
-    obj.last_four = acct_json.get("last_four")
-    s.add(obj)
-    return obj
-
-def add_balance_snapshot(s, account_id, balances_json):
+    """Make sure the tables exist.
+
+    Cheap when migrations are up to date: only the stored Alembic revision
+    is read, and the schema is not reflected.
+    """
+    from migrations import ensure_schema
+    return ensure_schema(init_engine(), Base.metadata)
+
+def session_for_tenant(tenant_id=None):
+    init_engine()
+    factory = shard_router.sessionmaker_for(tenant_id)
+    return factory() if factory else SessionLocal()
+
+def session_factories():
+    """Session factories of the default database and of every tenant shard,
+    for jobs that have to visit all of them."""
+    init_engine()
+    return [SessionLocal] + shard_router.sessionmakers()
+
+def tenant_filter(model, tenant_id, account_ids=()):
+    """Criterion limiting ``model`` rows to ``tenant_id``.
+
+    Rows stored before tenants were tracked have no tenant. They are only
+    included for ``account_ids``, the accounts Teller listed for the caller,
+    since nothing else proves who owns them. ``tenant_id=None`` means no
+    limit, for jobs that are not acting for a caller.
+    """
+    if tenant_id is None:
+        return true()
+    owned = list(account_ids or ())
+    if not owned:
+        return model.tenant_id == tenant_id
+    column = model.id if model is Account else model.account_id
+    return or_(model.tenant_id == tenant_id,
+               and_(model.tenant_id.is_(None), column.in_(owned)))
+
+def _owns_row(row_tenant_id, account_id, tenant_id, account_ids=()):
+    # tenant_filter for a row that is already loaded.
+    if tenant_id is None or row_tenant_id == tenant_id:
+        return True
+    return row_tenant_id is None and account_id in (account_ids or ())
+
+def mark_write(client_key):
+    """Remember that ``client_key`` just wrote, pinning its reads to the primary."""
+    if not client_key:
+        return
+    with _recent_writes_lock:
+        _recent_writes[client_key] = time.monotonic()
+        _recent_writes.move_to_end(client_key)
+        while len(_recent_writes) > _RECENT_WRITES_MAX:
+            _recent_writes.popitem(last=False)
+
+def read_session(client_key=None, require_primary=False, tenant_id=None):
+    """Session for read-only queries.
+
+    Uses the replica unless there is none, the caller asks for the primary,
+    or ``client_key`` wrote within READ_AFTER_WRITE_SECONDS (the replica may
+    not have caught up with that write yet). Tenants on their own shard
+    always read from that shard.
+    """
+    init_engine()
+    if not shard_router.is_default(tenant_id):
+        return session_for_tenant(tenant_id)
+    if read_engine is engine or require_primary:
+        return SessionLocal()
+    if client_key:
+        with _recent_writes_lock:
+            written_at = _recent_writes.get(client_key)
+        if (written_at is not None
+                and time.monotonic() - written_at < READ_AFTER_WRITE_SECONDS):
+            return SessionLocal()
+    return ReadSessionLocal()
+
+def _account_values(acct_json, tenant_id=None):
+    values = {
+        "name": acct_json.get("name"),
+        "institution_id": acct_json.get("institution", {}).get("id"),
+        "type": acct_json.get("type"),
+        "subtype": acct_json.get("subtype"),
+        "last_four": acct_json.get("last_four"),
+    }
+    if tenant_id is not None:
+        values["tenant_id"] = tenant_id
+    return values
+
+def _account_hash(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+def _known_account_hash(s, account_id):
+    pending = s.info.get("account_hashes", {})
+    if account_id in pending:
+        return pending[account_id]
+    with _account_hashes_lock:
+        known = _account_hashes.get(s.get_bind())
+        if known is None or account_id not in known:
+            return None
+        known.move_to_end(account_id)
+        return known[account_id]
+
+def upsert_accounts(s, accts_json, tenant_id=None, chunk_size=500):
+    """Insert or update many accounts with one SELECT per chunk.
+
+    Accounts whose columns are unchanged since this process last stored
+    them are skipped without touching the database. Returns the Account
+    objects that were inserted or compared with their row.
+    """
+    changed = {}
+    for acct in accts_json:
+        values = _account_values(acct, tenant_id)
+        digest = _account_hash(values)
+        if _known_account_hash(s, acct["id"]) != digest:
+            changed[acct["id"]] = (values, digest)
+    ids = list(changed)
+    pending = s.info.setdefault("account_hashes", {})
+    out = []
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        existing = {a.id: a for a in s.query(Account).filter(Account.id.in_(chunk))}
+        for account_id in chunk:
+            values, digest = changed[account_id]
+            obj = existing.get(account_id)
+            if obj is None:
+                obj = Account(id=account_id, **values)
+                s.add(obj)
+            else:
+                # Only assign differing columns so an unchanged row gets no
+                # UPDATE (and no updated_at bump).
+                for key, value in values.items():
+                    if getattr(obj, key) != value:
+                        setattr(obj, key, value)
+            pending[account_id] = digest
+            out.append(obj)
+    return out
+
+def upsert_account(s, acct_json, tenant_id=None):
+    """Insert or update one account; a no-op when nothing changed.
+
+    Returns the Account, or None when the account is known to be stored
+    unchanged and neither a read nor a write was issued.
+    """
+    stored = upsert_accounts(s, [acct_json], tenant_id=tenant_id)
+    return stored[0] if stored else None
+
+def add_balance_snapshot(s, account_id, balances_json, as_of=None, tenant_id=None):
     snap = BalanceSnapshot(
         account_id=account_id,
         available=Decimal(str(balances_json.get("available", 0))),
         ledger=Decimal(str(balances_json.get("ledger", 0))),
-        raw=balances_json,
+        tenant_id=tenant_id,
     )
+    snap.set_payload(balances_json)
+    if as_of is not None:
+        snap.as_of = as_of
     s.add(snap)
+    as_of = as_of or datetime.utcnow()
+    # One upsert, so concurrent writers of the same account cannot both
+    # insert; an older snapshot never replaces a newer one. The flush puts
+    # the account row in place first.
+    s.flush()
+    insert_ = _dialect_insert(s)
+    stmt = insert_(LatestBalance).values(
+        account_id=account_id, tenant_id=tenant_id, available=snap.available,
+        ledger=snap.ledger, as_of=as_of)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[LatestBalance.account_id],
+        set_={"available": stmt.excluded.available,
+              "ledger": stmt.excluded.ledger,
+              "as_of": stmt.excluded.as_of,
+              "tenant_id": func.coalesce(stmt.excluded.tenant_id,
+                                         LatestBalance.tenant_id)},
+        where=or_(LatestBalance.as_of.is_(None),
+                  LatestBalance.as_of <= stmt.excluded.as_of),
+    ).returning(LatestBalance.available, LatestBalance.ledger,
+                LatestBalance.as_of, LatestBalance.tenant_id)
+    latest = s.execute(stmt).one_or_none()
+    if latest is not None:
+        s.info.setdefault("latest_balances", {})[account_id] = _balance_value(latest)
+    _queue_event(s, tenant_id, {
+        "type": "balance",
+        "account_id": account_id,
+        "available": str(snap.available),
+        "ledger": str(snap.ledger),
+        "as_of": as_of.isoformat(),
+    })
+
+def _dialect_insert(s):
+    if s.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+def _balance_value(latest):
+    return {"available": str(latest.available), "ledger": str(latest.ledger),
+            "as_of": latest.as_of, "tenant_id": latest.tenant_id}
 
-def upsert_transactions(s, account_id, txns_json):
+def latest_balance(s, account_id, tenant_id=None, account_ids=()):
+    """Newest ``{"available", "ledger", ...}`` for an account, or None.
+
+    Served from balance_cache when possible, else by one primary-key read.
+    Only reads from a primary are cached: a lagging replica could otherwise
+    keep serving an old balance after the write-through. ``account_ids``
+    is used as in tenant_filter.
+    """
+    value = balance_cache.get(account_id)
+    if value is not None:
+        return (value if _owns_row(value["tenant_id"], account_id,
+                                   tenant_id, account_ids) else None)
+    latest = s.get(LatestBalance, account_id, populate_existing=True)
+    if latest is None:
+        return None
+    value = _balance_value(latest)
+    if not _on_replica(s):
+        balance_cache.put(account_id, value)
+    if not _owns_row(latest.tenant_id, account_id, tenant_id, account_ids):
+        return None
+    return value
+
+def _on_replica(s):
+    return read_engine is not engine and s.get_bind() is read_engine
+
+def _archived_ids(account_id):
+    # archive only reads its manifest (one stat() while it is unchanged) and
+    # the ids of accounts that have archived files.
+    if archive is None:
+        _load_subsystems()
+    return archive.default_reader().archived_ids(account_id)
+
+def _skip_archived(account_id, txns_json):
+    """Drop transactions that were moved to the archive; Teller keeps
+    returning them, but they must not grow back into the table. History
+    that was never archived is kept, however old."""
+    archived = _archived_ids(account_id)
+    if not archived:
+        return txns_json
+    return [t for t in txns_json if t["id"] not in archived]
+
+def upsert_transactions(s, account_id, txns_json, tenant_id=None):
+    added = []
+    txns_json = _skip_archived(account_id, txns_json)
+    ids = [t["id"] for t in txns_json]
+    # One query for the stored rows instead of a lookup per transaction.
+    stored = ({r.id: r for r in s.scalars(
+                  select(Transaction).where(Transaction.id.in_(ids)))}
+              if ids else {})
+    # Rows of detached partitions are not in the table but keep their ids.
+    detached = guarded_transaction_ids(s, [i for i in ids if i not in stored])
     for t in txns_json:
-        if s.get(Transaction, t["id"]):
+        if t["id"] in detached:
+            continue
+        existing = stored.get(t["id"])
+        if existing:
+            # Claim rows stored before tenants were tracked.
+            if existing.tenant_id is None and tenant_id is not None:
+                existing.tenant_id = tenant_id
             continue
-        s.add(Transaction(
+        txn = Transaction(
             id=t["id"],
             account_id=account_id,
             date=date.fromisoformat(t["date"]),
             description=t.get("description"),
             amount=Decimal(str(t.get("amount", 0))),
-            raw=t,
-        ))
+            tenant_id=tenant_id,
+        )
+        txn.set_payload(t)
+        s.add(txn)
+        added.append(t)
+    if added:
+        _index_recurring(s, account_id, added, tenant_id)
+        _queue_event(s, tenant_id, {
+            "type": "transactions",
+            "account_id": account_id,
+            "transactions": added,
+        })
+
+def _index_recurring(s, account_id, added, tenant_id):
+    if recurring is None:
+        _load_subsystems()
+    recurring.update_index(s, RecurringSeries, account_id, added, tenant_id)
+
+def bulk_insert_transactions(s, account_id, txns_json, tenant_id=None):
+    """Insert many transactions at once, skipping ids already stored.
+
+    One query finds the stored ids and one multi-row INSERT writes the rest,
+    instead of a lookup and an ORM object per transaction. No change events
+    are published. Returns the Teller JSON of the inserted transactions.
+    """
+    txns_json = _skip_archived(account_id, txns_json)
+    ids = [t["id"] for t in txns_json]
+    seen = set(s.scalars(select(Transaction.id)
+                         .where(Transaction.id.in_(ids)))) if ids else set()
+    seen |= guarded_transaction_ids(s, [i for i in ids if i not in seen])
+    rows, added = [], []
+    for t in txns_json:
+        if t["id"] in seen:
+            continue
+        seen.add(t["id"])
+        values = {
+            "id": t["id"],
+            "account_id": account_id,
+            "date": date.fromisoformat(t["date"]),
+            "description": t.get("description"),
+            "amount": Decimal(str(t.get("amount", 0))),
+            "tenant_id": tenant_id,
+        }
+        values["raw"] = payloads.compact(
+            t, {c: values[c] for c in Transaction.PAYLOAD_COLUMNS})
+        rows.append(values)
+        added.append(t)
+    if rows:
+        s.execute(insert(Transaction), rows)
+        _index_recurring(s, account_id, added, tenant_id)
+    return added
+
+def dashboard(s, tenant_id, tx_limit=10, account_ids=()):
+    """Every account of a tenant with its latest balance and newest transactions.
+
+    Two queries regardless of the number of accounts: accounts joined with
+    latest_balances, and the transactions ranked per account with
+    row_number(). ``account_ids`` is used as in tenant_filter.
+    """
+    rows = s.execute(
+        select(Account, LatestBalance)
+        .outerjoin(LatestBalance, LatestBalance.account_id == Account.id)
+        .where(tenant_filter(Account, tenant_id, account_ids))
+        .order_by(Account.name, Account.id)
+    ).all()
+    accounts = {}
+    for acct, latest in rows:
+        accounts[acct.id] = {
+            "id": acct.id,
+            "name": acct.name,
+            "institution_id": acct.institution_id,
+            "type": acct.type,
+            "subtype": acct.subtype,
+            "last_four": acct.last_four,
+            "balance": (None if latest is None else {
+                "available": str(latest.available),
+                "ledger": str(latest.ledger),
+                "as_of": latest.as_of.isoformat() if latest.as_of else None,
+            }),
+            "transactions": [],
+        }
+    if not accounts or tx_limit <= 0:
+        return list(accounts.values())
+
+    rank = (func.row_number()
+            .over(partition_by=Transaction.account_id,
+                  order_by=(Transaction.date.desc(), Transaction.id.desc()))
+            .label("rank"))
+    ranked = (select(Transaction, rank)
+              .where(Transaction.account_id.in_(list(accounts)))
+              .where(tenant_filter(Transaction, tenant_id, account_ids))
+              .subquery())
+    txn = aliased(Transaction, ranked)
+    for row in s.execute(select(txn)
+                         .where(ranked.c.rank <= tx_limit)
+                         .order_by(ranked.c.account_id, ranked.c.rank)).scalars():
+        accounts[row.account_id]["transactions"].append(row.payload())
+    return list(accounts.values())
+
+def stored_accounts(s, tenant_id, account_ids=()):
+    """A tenant's stored accounts in Teller's shape, and when they were
+    last changed (None if unknown)."""
+    rows = (s.query(Account)
+            .filter(tenant_filter(Account, tenant_id, account_ids))
+            .order_by(Account.name, Account.id)
+            .all())
+    accounts = [{
+        "id": a.id,
+        "name": a.name,
+        "type": a.type,
+        "subtype": a.subtype,
+        "last_four": a.last_four,
+        "institution": {"id": a.institution_id},
+    } for a in rows]
+    stamps = [a.updated_at or a.created_at for a in rows
+              if a.updated_at or a.created_at]
+    return accounts, max(stamps, default=None)
+
+def stored_transactions(s, account_id, tenant_id, count=None, account_ids=()):
+    """An account's stored transactions, newest first, as Teller sent them."""
+    q = (s.query(Transaction)
+         .filter(Transaction.account_id == account_id)
+         .filter(tenant_filter(Transaction, tenant_id, account_ids))
+         .order_by(Transaction.date.desc(), Transaction.id.desc()))
+    if count:
+        q = q.limit(count)
+    return [r.payload() for r in q]
+
+def transactions_etag(s, account_id, *extra, tenant_id=None, account_ids=()):
+    """Strong validator for the stored transactions ``tenant_id`` sees.
+
+    Transactions are insert-only, so the row count plus the max id changes
+    whenever anything is added; both come from the account_id index. They
+    are counted with the same tenant_filter as the rows served, and the
+    tenant and ``account_ids`` are part of the tag, so callers who see
+    different rows never share a tag.
+    """
+    count, max_id = (s.query(func.count(Transaction.id), func.max(Transaction.id))
+                     .filter(Transaction.account_id == account_id)
+                     .filter(tenant_filter(Transaction, tenant_id, account_ids))
+                     .one())
+    owned = ",".join(sorted(account_ids or ()))
+    key = ":".join(str(p) for p in (account_id, count, max_id, tenant_id, owned)
+                   + extra)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+# Change events are held on the session and only published once the
+# transaction commits, so listeners never see data that was rolled back.
+def _queue_event(s, tenant_id, evt):
+    s.info.setdefault("pending_events", []).append((tenant_id, evt))
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_events(s):
+    pending = s.info.pop("pending_events", None)
+    if not pending:
+        return
+    if events is None:
+        _load_subsystems()
+    for tenant_id, evt in pending:
+        events.broker.publish(evt, tenant_id=tenant_id)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_events(s):
+    s.info.pop("pending_events", None)
+
+@event.listens_for(Session, "after_commit")
+def _remember_account_hashes(s):
+    pending = s.info.pop("account_hashes", None)
+    if not pending:
+        return
+    with _account_hashes_lock:
+        known = _account_hashes.setdefault(s.get_bind(), OrderedDict())
+        for account_id, digest in pending.items():
+            known[account_id] = digest
+            known.move_to_end(account_id)
+        while len(known) > _ACCOUNT_HASHES_MAX:
+            known.popitem(last=False)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_account_hashes(s):
+    s.info.pop("account_hashes", None)
 
+@event.listens_for(Session, "after_commit")
+def _write_through_balances(s):
+    for account_id, value in s.info.pop("latest_balances", {}).items():
+        balance_cache.written(account_id, value)
 
+@event.listens_for(Session, "after_rollback")
+def _discard_balances(s):
+    s.info.pop("latest_balances", None)
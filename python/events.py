@@ -0,0 +1,110 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription:
+
+    def __init__(self, broker, tenant_id, account_ids, queue_size):
+        self.tenant_id = tenant_id
+        self.account_ids = set(account_ids or ())
+        self.lagged = False
+        self._broker = broker
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def wants(self, tenant_id, event):
+        return tenant_id == self.tenant_id and (
+            not self.account_ids or event['account_id'] in self.account_ids)
+
+    def offer(self, event_id, event):
+        try:
+            self._queue.put_nowait((event_id, event))
+            return True
+        except queue.Full:
+            self.lagged = True
+            return False
+
+    def get(self, timeout):
+        """Next ``(event_id, event)``, or None after ``timeout`` seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._broker.unsubscribe(self)
+
+
+class EventBroker:
+    """In-process fan-out of persisted account changes to live listeners.
+
+    Events are published with the tenant whose data changed and only reach
+    that tenant's subscribers. Every subscriber gets a bounded queue. A
+    subscriber that falls behind is disconnected instead of slowing down
+    publishers or growing without limit; clients reconnect and re-read
+    current state.
+    """
+
+    def __init__(self, max_subscribers=100, queue_size=256):
+        self._max_subscribers = max_subscribers
+        self._queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, tenant_id, account_ids=None):
+        with self._lock:
+            if len(self._subscribers) >= self._max_subscribers:
+                raise TooManySubscribers(
+                    f"{len(self._subscribers)} live subscribers")
+            sub = Subscription(self, tenant_id, account_ids,
+                               self._queue_size)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, event, tenant_id=None):
+        event_id = next(self._ids)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            if (sub.wants(tenant_id, event)
+                    and not sub.offer(event_id, event)):
+                logger.warning("Dropping lagging event stream subscriber")
+                self.unsubscribe(sub)
+
+
+broker = EventBroker()
+
+
+def format_sse(event_id, event):
+    data = json.dumps(event, default=str)
+    return f"id: {event_id}\nevent: {event['type']}\ndata: {data}\n\n".encode()
+
+
+def stream(sub, heartbeat=15.0):
+    """Yield SSE frames for ``sub`` until it lags or the client goes away."""
+    try:
+        yield b"retry: 5000\n\n"
+        while not sub.lagged:
+            item = sub.get(timeout=heartbeat)
+            if item is None:
+                yield b": keep-alive\n\n"
+                continue
+            yield format_sse(*item)
+    finally:
+        sub.close()
@@ -0,0 +1,365 @@
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import falcon
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Suffixes appended to an entity-tag when the body is served with a
+# content-coding, so the compressed and identity representations never share
+# a strong validator.
+_ENCODING_SUFFIXES = ('-br', '-gzip')
+
+
+def strip_encoding_suffix(etag):
+    for suffix in _ENCODING_SUFFIXES:
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def not_modified(req, etag):
+    """Return the If-None-Match entity-tag matching ``etag``, if any.
+
+    The returned tag is the one the client holds (including any encoding
+    suffix), so it can be echoed back on the 304.
+    """
+    for candidate in (req.if_none_match or []):
+        if candidate == '*':
+            return etag
+        if strip_encoding_suffix(candidate) == etag:
+            return str(candidate)
+    return None
+
+
+def set_not_modified(resp, etag):
+    resp.etag = etag
+    resp.status = falcon.HTTP_304
+    resp.media = None
+    resp.data = None
+    resp.text = None
+    resp.delete_header('Content-Type')
+
+
+class ETagMiddleware:
+    """Add a strong content ETag to GET responses and answer 304s.
+
+    Resources that can compute a cheaper validator from stored data set
+    ``resp.etag`` themselves (and short-circuit via :func:`not_modified`);
+    this middleware only hashes bodies of responses that have none.
+    """
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.method != 'GET' or resp.status != falcon.HTTP_200:
+            return
+        if resp.etag or resp.stream is not None:
+            return
+        body = resp.render_body()
+        if not body:
+            return
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        matched = not_modified(req, etag)
+        if matched:
+            set_not_modified(resp, matched)
+            return
+        resp.etag = etag
+
+
+class CompressionMiddleware:
+    """Compress response bodies above ``min_size`` bytes with br or gzip."""
+
+    def __init__(self, min_size=None, level=6):
+        if min_size is None:
+            min_size = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+        self._min_size = min_size
+        self._level = level
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.method == 'HEAD' or resp.stream is not None:
+            return
+        if resp.get_header('Content-Encoding'):
+            return
+        encoding = self._choose_encoding(req.get_header('Accept-Encoding'))
+        if encoding is None:
+            return
+        body = resp.render_body()
+        if not body or len(body) < self._min_size:
+            return
+
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=min(self._level, 11))
+        else:
+            compressed = gzip.compress(body, compresslevel=self._level)
+
+        resp.text = None
+        resp.data = compressed
+        resp.set_header('Content-Encoding', encoding)
+        resp.append_header('Vary', 'Accept-Encoding')
+        if resp.etag and not resp.etag.startswith('W/'):
+            # The getter returns the formatted (quoted) header value.
+            tag = resp.etag.strip('"')
+            resp.etag = f"{tag}-{encoding}"
+
+    def _choose_encoding(self, accept_encoding):
+        if not accept_encoding:
+            return None
+        accepted = {}
+        for part in accept_encoding.split(','):
+            coding, _, params = part.strip().partition(';')
+            qvalue = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    qvalue = float(params[2:])
+                except ValueError:
+                    qvalue = 0.0
+            accepted[coding.strip().lower()] = qvalue
+        if brotli is not None and accepted.get('br', 0) > 0:
+            return 'br'
+        if accepted.get('gzip', 0) > 0:
+            return 'gzip'
+        return None
+
+
+class AdaptiveLimit:
+    """Concurrency limit that follows upstream latency (AIMD).
+
+    While the smoothed latency stays within ``tolerance`` times the recent
+    minimum, the limit grows by one per ``limit`` successful requests; when
+    latency inflates (the upstream is queueing) or requests fail, it is cut
+    by ``backoff``, at most once per ``limit`` requests.
+    """
+
+    def __init__(self, initial=16, min_limit=2, max_limit=64, tolerance=2.0,
+                 backoff=0.9, window=100):
+        self._limit = float(initial)
+        self._min = min_limit
+        self._max = max_limit
+        self._tolerance = tolerance
+        self._backoff = backoff
+        self._window = window
+        self._ewma = None
+        self._min_latency = None
+        self._window_min = None
+        self._samples = 0
+        self._since_change = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def latency(self):
+        return self._ewma
+
+    def record(self, latency, ok=True):
+        with self._lock:
+            self._ewma = (latency if self._ewma is None
+                          else 0.8 * self._ewma + 0.2 * latency)
+            # Windowed minimum, so the baseline can move up when the
+            # upstream gets slower for good.
+            self._window_min = (latency if self._window_min is None
+                                else min(self._window_min, latency))
+            self._samples += 1
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            if self._samples >= self._window:
+                self._min_latency = self._window_min
+                self._window_min = None
+                self._samples = 0
+
+            self._since_change += 1
+            if self._since_change < self._limit:
+                return
+            congested = self._ewma > self._min_latency * self._tolerance
+            if congested or not ok:
+                self._limit = max(self._min, self._limit * self._backoff)
+            else:
+                self._limit = min(self._max, self._limit + 1)
+            self._since_change = 0
+
+
+class _Gate:
+    """Admits at most ``limit`` concurrent requests; others wait briefly."""
+
+    def __init__(self, limit):
+        self._limit = limit  # int or AdaptiveLimit
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return (self._limit.limit if isinstance(self._limit, AdaptiveLimit)
+                else self._limit)
+
+    def acquire(self, timeout):
+        """Return True once admitted, False if no slot freed in time."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, latency, ok):
+        """``latency`` is the upstream time, or None if there was none."""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+        if latency is not None and isinstance(self._limit, AdaptiveLimit):
+            self._limit.record(latency, ok)
+
+
+def _upstream_queue_seconds(header, now=None):
+    """Time spent before reaching us, from an ``X-Request-Start`` header
+    (``t=<epoch>`` in seconds, milliseconds or microseconds)."""
+    if not header:
+        return 0.0
+    try:
+        start = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return 0.0
+    if start > 1e14:
+        start /= 1e6
+    elif start > 1e11:
+        start /= 1e3
+    return max(0.0, (now or time.time()) - start)
+
+
+class LoadSheddingMiddleware:
+    """Admission control per route class, answering 503 when overloaded.
+
+    Requests are classed as ``proxy`` (calls Teller), ``db-read`` or
+    ``write``. Each class has a concurrency limit; a request that cannot be
+    admitted within ``max_queue`` seconds (including time already spent in
+    a front proxy, per ``X-Request-Start``) gets 503 with Retry-After. The
+    proxy limit adapts to observed Teller latency, which handlers report in
+    ``req.context.upstream_seconds``; requests answered without calling
+    Teller (cache hits, stored data, local errors) leave the limit alone.
+    ``/health`` and event streams are never queued or shed.
+    """
+
+    EXEMPT_PREFIXES = ('/health', '/api/stream/')
+
+    def __init__(self, proxy_limit=None, db_read_limit=None, write_limit=None,
+                 max_queue=None, retry_after=None):
+        env = os.getenv
+        if proxy_limit is None:
+            max_limit = int(env('SHED_PROXY_LIMIT', '32'))
+            min_limit = min(int(env('SHED_PROXY_MIN_LIMIT', '4')), max_limit)
+            proxy_limit = AdaptiveLimit(
+                initial=max(min_limit, max_limit // 2),
+                min_limit=min_limit, max_limit=max_limit)
+        if db_read_limit is None:
+            db_read_limit = int(env('SHED_DB_READ_LIMIT', '64'))
+        if write_limit is None:
+            write_limit = int(env('SHED_WRITE_LIMIT', '16'))
+        self._gates = {
+            'proxy': _Gate(proxy_limit),
+            'db-read': _Gate(db_read_limit),
+            'write': _Gate(write_limit),
+        }
+        self._max_queue = (max_queue if max_queue is not None
+                           else float(env('SHED_MAX_QUEUE_MS', '250')) / 1000)
+        self._retry_after = (retry_after if retry_after is not None
+                             else int(env('SHED_RETRY_AFTER', '2')))
+
+    def classify(self, req):
+        if req.path.startswith(self.EXEMPT_PREFIXES):
+            return None
+        if req.method not in ('GET', 'HEAD', 'OPTIONS'):
+            return 'write'
+        if req.path.startswith(('/api/db/', '/api/payments/')):
+            return 'db-read'
+        return 'proxy'
+
+    def stats(self):
+        return {name: {'limit': gate.limit, 'in_flight': gate.in_flight,
+                       'waiting': gate.waiting, 'shed': gate.shed}
+                for name, gate in self._gates.items()}
+
+    def process_request(self, req, resp):
+        route_class = self.classify(req)
+        if route_class is None or req.method == 'OPTIONS':
+            return
+        gate = self._gates[route_class]
+        budget = self._max_queue - _upstream_queue_seconds(
+            req.get_header('X-Request-Start'))
+        if not gate.acquire(max(budget, 0.0)):
+            logger.warning(f"Shedding {req.method} {req.path} "
+                           f"({route_class}: {gate.in_flight} in flight, "
+                           f"limit {gate.limit})")
+            raise falcon.HTTPServiceUnavailable(
+                title="Server Busy",
+                description="Too many requests in progress, retry shortly.",
+                retry_after=self._retry_after)
+        req.context.admission = route_class
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        route_class = req.context.get('admission')
+        if route_class is None:
+            return
+        req.context.admission = None
+        ok = req_succeeded and not resp.status.startswith(('502', '503',
+                                                           '504'))
+        self._gates[route_class].release(req.context.get('upstream_seconds'),
+                                         ok)
+
+
+class QueryStatsMiddleware:
+    """Collects the SQL statements of each request (see query_stats).
+
+    Statements repeated often enough to suggest an N+1 pattern are logged;
+    with ``debug_headers`` the request's statement count and time are also
+    sent as ``X-Query-Count`` and ``X-Query-Time-Ms``.
+    """
+
+    def __init__(self, debug_headers=None, n_plus_one=None):
+        # Imported here, once, rather than with this module or per request.
+        import query_stats
+        from sqlalchemy.engine import Engine
+        query_stats.install(Engine)
+        self._stats = query_stats
+        self._debug_headers = (query_stats.DEBUG_HEADERS
+                               if debug_headers is None else debug_headers)
+        self._n_plus_one = n_plus_one
+
+    def process_request(self, req, resp):
+        self._stats.begin()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        stats = self._stats.end()
+        if stats is None:
+            return
+        repeated = stats.repeated(self._n_plus_one)
+        for sql, count in repeated:
+            logger.warning(f"Possible N+1 query in {req.method} {req.path}: "
+                           f"{count} x {sql}")
+        if stats.count:
+            logger.debug(f"{req.method} {req.path}: {stats.count} statements "
+                         f"in {stats.seconds * 1000:.1f} ms")
+        if self._debug_headers:
+            resp.set_header('X-Query-Count', str(stats.count))
+            resp.set_header('X-Query-Time-Ms', f"{stats.seconds * 1000:.1f}")
+            if repeated:
+                resp.set_header('X-Query-Repeated', str(repeated[0][1]))
@@ -0,0 +1,89 @@
+"""Schema version checks and the migrate-only command.
+
+Deploys run the migrations once, before the new release starts::
+
+    python migrations.py           # alembic upgrade head
+    python migrations.py --check   # exit 1 unless the database is at head
+
+At start-up the server only compares the revision stored in
+``alembic_version`` with the head of ``alembic/versions`` (a single query)
+and skips ``create_all`` when they match.
+"""
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+logger = logging.getLogger(__name__)
+
+ALEMBIC_INI = Path(__file__).resolve().with_name('alembic.ini')
+
+
+def _config():
+    from alembic.config import Config
+    return Config(str(ALEMBIC_INI))
+
+
+def expected_head():
+    """Head revision of the migration scripts; reads local files only."""
+    from alembic.script import ScriptDirectory
+    return ScriptDirectory.from_config(_config()).get_current_head()
+
+
+def stored_revision(engine):
+    """Revision recorded in the database, or None if it was never stamped."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(
+                text("SELECT version_num FROM alembic_version")).scalar()
+    except (OperationalError, ProgrammingError):
+        return None
+
+
+def ensure_schema(engine, metadata):
+    """Create missing tables unless the database is already at head.
+
+    Returns True when ``create_all`` had to run.
+    """
+    head = expected_head()
+    current = stored_revision(engine)
+    if current == head:
+        logger.info(f"Database schema is at {head}")
+        return False
+    logger.warning(f"Database schema is at {current or 'no revision'}, "
+                   f"expected {head}; run 'python migrations.py'. "
+                   f"Creating missing tables.")
+    metadata.create_all(engine)
+    return True
+
+
+def upgrade(revision='head'):
+    from alembic import command
+    command.upgrade(_config(), revision)
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Apply database migrations (or check they are applied)')
+    parser.add_argument('--check', action='store_true',
+                        help='only report whether the database is at head')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = _parse_args(argv)
+    if not args.check:
+        upgrade()
+        return 0
+    from db import init_engine
+    head, current = expected_head(), stored_revision(init_engine())
+    logger.info(f"Database revision {current}, expected {head}")
+    return 0 if current == head else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
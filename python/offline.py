@@ -0,0 +1,137 @@
+"""Serving stored data when Teller is slow or unavailable.
+
+The proxy routes for accounts, balances and transactions can answer from
+what the database already holds instead of asking Teller:
+
+* when the client sends ``X-Data-Source: database``,
+* always, with OFFLINE_MODE=prefer,
+* after a Teller call failed or timed out (OFFLINE_MODE=fallback, the
+  default); for OFFLINE_COOLDOWN seconds afterwards Teller is not asked
+  first at all, by any process sharing SHARED_STATE_URL, so an outage
+  does not slow every request down,
+* when the call would exceed TELLER_RATE_LIMIT (unless OFFLINE_MODE=off).
+
+Whenever stored data is served, the same Teller call runs in the
+background (at most once per OFFLINE_REFRESH_INTERVAL seconds per route
+and user, across all processes sharing SHARED_STATE_URL) to bring the
+database up to date for the next request.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import shared_state
+
+logger = logging.getLogger(__name__)
+
+OFF = 'off'
+FALLBACK = 'fallback'
+PREFER = 'prefer'
+MODES = (OFF, FALLBACK, PREFER)
+
+# Values of the X-Data-Reason response header.
+REQUESTED = 'requested'
+PREFERRED = 'preferred'
+TELLER_UNAVAILABLE = 'teller-unavailable'
+RATE_LIMITED = 'rate-limited'
+
+_UNAVAILABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def teller_unavailable(exc):
+    """True if ``exc`` means Teller could not be reached or timed out."""
+    import requests
+
+    return isinstance(exc, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+class OfflinePolicy:
+
+    def __init__(self, mode=FALLBACK, cooldown=30.0, refresh_interval=30.0,
+                 workers=2, state=None):
+        if mode not in MODES:
+            raise ValueError(f"OFFLINE_MODE must be one of {MODES}")
+        self.mode = mode
+        self._cooldown = cooldown
+        self._refresh_interval = refresh_interval
+        self._workers = workers
+        self._executor = None
+        self._state = state if state is not None else shared_state.MemoryState()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, state=None):
+        return cls(
+            mode=os.getenv('OFFLINE_MODE', FALLBACK),
+            cooldown=float(os.getenv('OFFLINE_COOLDOWN', '30')),
+            refresh_interval=float(os.getenv('OFFLINE_REFRESH_INTERVAL',
+                                             '30')),
+            state=state)
+
+    def stored_first(self, req):
+        """Why ``req`` should be answered from the database, or None."""
+        if self.mode == OFF:
+            return None
+        if (req.get_header('X-Data-Source') or '').lower() == 'database':
+            return REQUESTED
+        if self.mode == PREFER:
+            return PREFERRED
+        if self.teller_down:
+            return TELLER_UNAVAILABLE
+        return None
+
+    def fall_back(self, teller_response=None, exc=None):
+        """Record a Teller failure; True if stored data should be served."""
+        if exc is not None:
+            failed = teller_unavailable(exc)
+        else:
+            failed = teller_response.status_code in _UNAVAILABLE_STATUS_CODES
+        if failed and self._cooldown > 0:
+            self._state.set('teller-down', '1', self._cooldown)
+        return failed and self.mode != OFF
+
+    def rate_limited(self):
+        """True if stored data should answer a call over the rate limit."""
+        return self.mode != OFF
+
+    def teller_ok(self):
+        if self.teller_down:
+            self._state.delete('teller-down')
+
+    @property
+    def teller_down(self):
+        return self._state.get('teller-down') is not None
+
+    def refresh(self, key, fun):
+        """Run ``fun()`` in the background unless ``key`` (a tuple of
+        strings) was refreshed recently or is being refreshed right now."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            if (self._refresh_interval > 0 and not self._state.add(
+                    'refresh:' + ':'.join(key), '1', self._refresh_interval)):
+                return False
+            self._refreshing.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self._workers, thread_name_prefix='offline-refresh')
+        self._executor.submit(self._run, key, fun)
+        return True
+
+    def _run(self, key, fun):
+        try:
+            teller_response = fun()
+            if teller_response.status_code in _UNAVAILABLE_STATUS_CODES:
+                self.fall_back(teller_response)
+            else:
+                self.teller_ok()
+        except Exception as e:
+            if teller_unavailable(e):
+                self.fall_back(exc=e)
+            logger.warning(f"Background refresh of {key[1]} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -0,0 +1,254 @@
+"""Monthly range partitions for transactions and balance_snapshots.
+
+Only applies to Postgres databases that went through the
+``partition_by_month`` migration; everywhere else these helpers are no-ops.
+
+    python partitions.py --months-ahead 3 --detach-before 2023-01 \\
+        --archive-schema archive
+"""
+import argparse
+import logging
+import re
+import threading
+import time
+import weakref
+from datetime import date
+
+from sqlalchemy import Column, MetaData, String, Table, inspect, select, text
+
+logger = logging.getLogger(__name__)
+
+# table -> partition key column
+PARTITIONED_TABLES = {
+    'transactions': 'date',
+    'balance_snapshots': 'as_of',
+}
+
+_PARTITION_RE = re.compile(r'^(?P<table>\w+)_p(?P<year>\d{4})_(?P<month>\d{2})$')
+
+# Every stored transaction id, kept by a trigger of the partition_by_month
+# migration; not part of db.Base, so only partitioned databases have it.
+transaction_ids = Table('transaction_ids', MetaData(),
+                        Column('id', String, primary_key=True))
+_has_transaction_ids = weakref.WeakKeyDictionary()  # engine -> bool
+
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def add_months(d, months):
+    index = d.year * 12 + (d.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+def parse_partition_name(name):
+    """Return ``(table, month)`` for a monthly partition name, else None."""
+    m = _PARTITION_RE.match(name)
+    if not m:
+        return None
+    return m.group('table'), date(int(m.group('year')), int(m.group('month')), 1)
+
+
+def create_partition_sql(table, month):
+    return (f'CREATE TABLE IF NOT EXISTS "{partition_name(table, month)}" '
+            f'PARTITION OF "{table}" '
+            f"FOR VALUES FROM ('{month.isoformat()}') "
+            f"TO ('{add_months(month, 1).isoformat()}')")
+
+
+def default_partition_name(table):
+    return f"{table}_default"
+
+
+def create_partition(conn, table, month):
+    """Create the partition for ``month``.
+
+    Rows of that month already in the DEFAULT partition (loaded before the
+    partition existed) are moved into it; Postgres refuses to create the
+    partition while they are there.
+    """
+    key = PARTITIONED_TABLES[table]
+    default = default_partition_name(table)
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    in_month = f'"{key}" >= :start AND "{key}" < :end'
+    has_default = conn.execute(text(
+        "SELECT to_regclass(:name) IS NOT NULL"), {'name': default}).scalar()
+    moved = 0
+    if has_default:
+        conn.execute(text(f'CREATE TEMPORARY TABLE partition_move '
+                          f'(LIKE "{table}")'))
+        moved = conn.execute(text(
+            f'WITH moved AS (DELETE FROM "{default}" WHERE {in_month} '
+            f'RETURNING *) INSERT INTO partition_move SELECT * FROM moved'),
+            bounds).rowcount
+    conn.execute(text(create_partition_sql(table, month)))
+    if has_default:
+        conn.execute(text(f'INSERT INTO "{table}" '
+                          f'SELECT * FROM partition_move'))
+        conn.execute(text('DROP TABLE partition_move'))
+    if moved:
+        logger.info(f"Moved {moved} rows of {month:%Y-%m} out of {default}")
+
+
+def guarded_transaction_ids(s, ids):
+    """Those of ``ids`` recorded in ``transaction_ids``.
+
+    This includes transactions whose partition was detached, which the
+    ``transactions`` table no longer shows but which cannot be inserted
+    again. Empty where the table does not exist.
+    """
+    if not ids:
+        return set()
+    engine = s.get_bind()
+    exists = _has_transaction_ids.get(engine)
+    if exists is None:
+        exists = inspect(s.connection()).has_table(transaction_ids.name)
+        _has_transaction_ids[engine] = exists
+    if not exists:
+        return set()
+    return set(s.scalars(select(transaction_ids.c.id)
+                         .where(transaction_ids.c.id.in_(ids))))
+
+
+def is_partitioned(conn, table):
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table AND pg_table_is_visible(c.oid)"),
+        {'table': table}).first() is not None
+
+
+def list_partitions(conn, table):
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits i "
+        "JOIN pg_class parent ON parent.oid = i.inhparent "
+        "JOIN pg_class child ON child.oid = i.inhrelid "
+        "WHERE parent.relname = :table AND pg_table_is_visible(parent.oid)"),
+        {'table': table}).scalars().all()
+    return sorted(rows)
+
+
+def ensure_partitions(conn, table, months_ahead=3, today=None):
+    """Create monthly partitions up to ``months_ahead`` months from today.
+
+    Returns the names of the partitions that were created.
+    """
+    if not is_partitioned(conn, table):
+        return []
+    existing = set(list_partitions(conn, table))
+    current = month_start(today or date.today())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        name = partition_name(table, month)
+        if name in existing:
+            continue
+        create_partition(conn, table, month)
+        created.append(name)
+    if created:
+        logger.info(f"Created partitions {', '.join(created)}")
+    return created
+
+
+def ensure_months(conn, table, months):
+    """Create the monthly partitions holding ``months`` (dates), e.g.
+    before loading history older than the existing partitions."""
+    if not is_partitioned(conn, table):
+        return []
+    existing = set(list_partitions(conn, table))
+    created = []
+    for month in sorted({month_start(m) for m in months}):
+        if partition_name(table, month) in existing:
+            continue
+        create_partition(conn, table, month)
+        created.append(partition_name(table, month))
+    if created:
+        logger.info(f"Created partitions {', '.join(created)}")
+    return created
+
+
+def detach_partitions_before(conn, table, cutoff, archive_schema=None):
+    """Detach monthly partitions that end on or before ``cutoff``.
+
+    Detached partitions become plain tables, optionally moved into
+    ``archive_schema``; nothing is dropped. Their transaction ids stay in
+    ``transaction_ids``, and db skips those transactions when Teller
+    returns them again (see guarded_transaction_ids).
+    """
+    if not is_partitioned(conn, table):
+        return []
+    cutoff = month_start(cutoff)
+    if archive_schema:
+        conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{archive_schema}"'))
+    detached = []
+    for name in list_partitions(conn, table):
+        parsed = parse_partition_name(name)
+        if parsed is None or add_months(parsed[1], 1) > cutoff:
+            continue
+        conn.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"'))
+        if archive_schema:
+            conn.execute(text(
+                f'ALTER TABLE "{name}" SET SCHEMA "{archive_schema}"'))
+        detached.append(name)
+    if detached:
+        logger.info(f"Detached partitions {', '.join(detached)}")
+    return detached
+
+
+def maintain(engine, months_ahead=3, detach_before=None, archive_schema=None):
+    with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            ensure_partitions(conn, table, months_ahead)
+            if detach_before is not None:
+                detach_partitions_before(conn, table, detach_before,
+                                         archive_schema)
+
+
+def start_maintenance_thread(engine, interval=24 * 3600, months_ahead=3):
+    """Keep partitions ahead of time for long-running processes."""
+    def run():
+        while True:
+            try:
+                maintain(engine, months_ahead)
+            except Exception:
+                logger.error("Partition maintenance failed", exc_info=True)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='partition-maintenance',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Maintain monthly partitions of transactions and '
+                    'balance_snapshots')
+    parser.add_argument('--months-ahead', type=int, default=3,
+                        help='create partitions this many months ahead')
+    parser.add_argument('--detach-before', type=lambda v: date.fromisoformat(
+                            f"{v}-01" if len(v) == 7 else v),
+                        help='detach partitions ending on or before this '
+                             'month (YYYY-MM)')
+    parser.add_argument('--archive-schema',
+                        help='move detached partitions into this schema')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = _parse_args(argv)
+    from db import init_engine
+    maintain(init_engine(), args.months_ahead, args.detach_before,
+             args.archive_schema)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compact storage of raw Teller payloads.
+
+Rows keep the Teller JSON next to columns that already hold some of its
+fields (id, date, amount, ...). ``compact`` drops those fields when the
+column reproduces them exactly and ``expand`` puts them back, so the
+payload read from a row equals the one that was stored. ``CompactJSON``
+stores the remainder as JSONB on Postgres and as zlib-compressed JSON
+everywhere else.
+"""
+import json
+import zlib
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+# Fields the original payload did not have, so expand() must not add them.
+ABSENT = '_absent'
+_CENT = Decimal('0.01')
+
+
+def _as_payload_value(value):
+    """A column value in the form Teller sends it (Numeric(14, 2) columns)."""
+    if isinstance(value, Decimal):
+        return str(value.quantize(_CENT))
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def compact(payload, columns):
+    """``payload`` minus the keys whose value ``columns`` already store."""
+    if not isinstance(payload, dict):
+        return payload
+    out = dict(payload)
+    absent = []
+    for key, value in columns.items():
+        if key not in payload:
+            absent.append(key)
+        elif payload[key] == _as_payload_value(value):
+            del out[key]
+    if absent:
+        out[ABSENT] = absent
+    return out
+
+
+def expand(stored, columns):
+    """Rebuild the payload that ``compact`` reduced to ``stored``."""
+    if not isinstance(stored, dict):
+        return stored
+    absent = stored.get(ABSENT, ())
+    out = {key: _as_payload_value(value) for key, value in columns.items()
+           if key not in stored and key not in absent}
+    out.update((k, v) for k, v in stored.items() if k != ABSENT)
+    return out
+
+
+def encode(payload):
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode())
+
+
+def decode(value):
+    """Inverse of ``encode``; also accepts plain JSON text from older rows."""
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    if isinstance(value, bytes) and not value.lstrip().startswith((b'{', b'[')):
+        value = zlib.decompress(value)
+    return json.loads(value)
+
+
+class CompactJSON(TypeDecorator):
+    """JSON stored as JSONB on Postgres and compressed bytes elsewhere."""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import JSONB
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return encode(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return decode(value)
@@ -0,0 +1,403 @@
+"""Idempotent, queued submission of payments and payees to Teller.
+
+A POST is stored as a ``payment_requests`` row keyed by the client's
+``Idempotency-Key`` and answered with 202 straight away; a pool of worker
+threads sends it to Teller. Repeating the POST with the same key never
+creates a second request, it returns the state of the first one.
+
+A request is only retried when it certainly did not reach Teller (the
+connection could not be opened, or Teller answered 429/503). If the outcome
+is unclear, e.g. the response timed out, a gateway answered 500/502/504 or
+the process died while sending, the request ends in ``unknown`` and must be
+checked by hand rather than risk paying twice.
+
+Access tokens are kept in memory only. A request queued by a process that
+has since restarted stays ``queued`` until the client repeats the POST,
+which supplies the token again. Requests nobody repeats fail after
+``queued_ttl`` seconds; they were never sent, so submitting them again
+under a new key is safe. ``recover`` settles both cases in every database
+at start-up and then every ``recover_interval`` seconds.
+"""
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from db import PaymentRequest
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+STATUSES = (QUEUED, SENDING, SUCCEEDED, FAILED, UNKNOWN)
+FINAL_STATUSES = (SUCCEEDED, FAILED, UNKNOWN)
+
+KINDS = ('payment', 'payee')
+_RETRYABLE_STATUS_CODES = (429, 503)
+
+
+class IdempotencyConflict(Exception):
+    """The idempotency key was already used for a different request."""
+
+
+def body_hash(kind, account_id, scheme, body):
+    key = json.dumps([kind, account_id, scheme, body], sort_keys=True,
+                     default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def as_dict(row):
+    return {
+        'id': row.id,
+        'kind': row.kind,
+        'account_id': row.account_id,
+        'scheme': row.scheme,
+        'status': row.status,
+        'attempts': row.attempts,
+        'response_status': row.response_status,
+        'response': row.response,
+        'error': row.error,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+    }
+
+
+def _never_sent(exc):
+    """True if ``exc`` means the request cannot have reached Teller."""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        return isinstance(getattr(exc.args[0], 'reason', None),
+                          NewConnectionError)
+    return False
+
+
+class PaymentQueue:
+
+    def __init__(self, client, session_factory, workers=4, max_attempts=5,
+                 retry_delay=1.0, timeout=(5, 60), lease=300, queued_ttl=3600,
+                 recover_interval=60, databases=None):
+        """``session_factory(tenant_id)`` returns a session for that tenant;
+        ``databases()`` returns a session factory for every database that
+        can hold requests, by default only the one of tenant None."""
+        self._client = client
+        self._session_factory = session_factory
+        self._databases = databases
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._timeout = timeout
+        self._lease = lease
+        self._queued_ttl = queued_ttl
+        self._recover_interval = recover_interval
+        self._stopping = threading.Event()
+        self._queue = queue.Queue()
+        self._tokens = {}  # request id -> (access token, tenant id)
+        self._tokens_lock = threading.Lock()
+        self._threads = []
+        self._recoverer = None
+
+    @classmethod
+    def from_env(cls, client, session_factory, databases=None):
+        return cls(client, session_factory,
+                   workers=int(os.getenv('PAYMENT_WORKERS', '4')),
+                   max_attempts=int(os.getenv('PAYMENT_MAX_ATTEMPTS', '5')),
+                   queued_ttl=float(os.getenv('PAYMENT_QUEUED_TTL', '3600')),
+                   recover_interval=float(
+                       os.getenv('PAYMENT_RECOVER_INTERVAL', '60')),
+                   databases=databases)
+
+    def submit(self, token, tenant_id, idempotency_key, kind, account_id,
+               scheme, body):
+        """Store and enqueue a request, or find the one stored for the key.
+
+        Returns ``(request dict, created)``; raises IdempotencyConflict when
+        the key belongs to a different request.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"unknown request kind {kind!r}")
+        digest = body_hash(kind, account_id, scheme, body)
+        created = False
+        with self._session_factory(tenant_id) as s:
+            # Another process may store the same key between our lookup and
+            # insert; the second lookup then finds its row. Should that row
+            # be gone again (its transaction rolled back), try once more.
+            for _ in range(2):
+                row = self._find(s, tenant_id, idempotency_key)
+                if row is not None:
+                    break
+                row = PaymentRequest(
+                    id=uuid.uuid4().hex, tenant_id=tenant_id,
+                    idempotency_key=idempotency_key, kind=kind,
+                    account_id=account_id, scheme=scheme, body=body,
+                    body_hash=digest, status=QUEUED, attempts=0)
+                s.add(row)
+                try:
+                    s.commit()
+                    created = True
+                    break
+                except IntegrityError:
+                    s.rollback()
+                    row = self._find(s, tenant_id, idempotency_key)
+                    if row is not None:
+                        break
+            if row is None:
+                raise IdempotencyConflict(
+                    f"Idempotency-Key {idempotency_key!r} is being used by "
+                    f"another request; retry later")
+            if row.body_hash != digest:
+                raise IdempotencyConflict(
+                    f"Idempotency-Key {idempotency_key!r} was used for a "
+                    f"different request")
+            result = as_dict(row)
+        if result['status'] == QUEUED:
+            with self._tokens_lock:
+                self._tokens[result['id']] = (token, tenant_id)
+            self._queue.put(result['id'])
+        return result, created
+
+    def status(self, tenant_id, request_id):
+        with self._session_factory(tenant_id) as s:
+            row = s.get(PaymentRequest, request_id)
+            if row is None or row.tenant_id != tenant_id:
+                return None
+            return as_dict(row)
+
+    def start(self):
+        self._stopping.clear()
+        self.recover_all()
+        for n in range(self._workers):
+            thread = threading.Thread(target=self._run, name=f'payments-{n}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self._recover_interval > 0:
+            self._recoverer = threading.Thread(
+                target=self._recover_periodically, name='payments-recover',
+                daemon=True)
+            self._recoverer.start()
+        logger.info(f"Payment queue started with {self._workers} workers")
+
+    def stop(self, timeout=30):
+        """Let in-flight requests finish.
+
+        Queued requests stay in the database; they are sent when the client
+        repeats them, or fail after ``queued_ttl`` (see ``recover``).
+        """
+        self._stopping.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        if self._recoverer is not None:
+            self._recoverer.join(timeout)
+            self._recoverer = None
+
+    def recover(self, tenant_id=None):
+        """Settle the requests of ``tenant_id``'s database no worker will
+        finish, and return how many there were.
+
+        Requests left in ``sending`` past the lease become ``unknown``.
+        Requests ``queued`` for longer than ``queued_ttl`` whose access
+        token this process does not hold (it was lost in a restart) fail.
+        """
+        with self._session_factory(tenant_id) as s:
+            return self._recover(s)
+
+    def recover_all(self):
+        """``recover`` every database; errors are logged, not raised."""
+        if self._databases is None:
+            factories = [lambda: self._session_factory(None)]
+        else:
+            factories = self._databases()
+        settled = 0
+        for factory in factories:
+            try:
+                with factory() as s:
+                    settled += self._recover(s)
+            except Exception:
+                logger.error("Could not recover payment requests",
+                             exc_info=True)
+        return settled
+
+    def _recover(self, s):
+        now = datetime.utcnow()
+        # Conditional updates, so a row a worker claims or settles in the
+        # meantime is left alone.
+        interrupted = (s.query(PaymentRequest)
+                       .filter(PaymentRequest.status == SENDING,
+                               PaymentRequest.updated_at
+                               < now - timedelta(seconds=self._lease))
+                       .update({PaymentRequest.status: UNKNOWN,
+                                PaymentRequest.error:
+                                    "interrupted while sending; "
+                                    "check with Teller",
+                                PaymentRequest.updated_at: now},
+                               synchronize_session=False))
+        with self._tokens_lock:
+            held = list(self._tokens)
+        expired = (s.query(PaymentRequest)
+                   .filter(PaymentRequest.status == QUEUED,
+                           PaymentRequest.updated_at
+                           < now - timedelta(seconds=self._queued_ttl),
+                           PaymentRequest.id.not_in(held))
+                   .update({PaymentRequest.status: FAILED,
+                            PaymentRequest.error:
+                                "expired before it was sent: the access "
+                                "token was lost in a restart; submit it "
+                                "again with a new Idempotency-Key",
+                            PaymentRequest.updated_at: now},
+                           synchronize_session=False))
+        s.commit()
+        if interrupted:
+            logger.warning(f"{interrupted} payment requests were interrupted "
+                           f"while sending and are now 'unknown'")
+        if expired:
+            logger.warning(f"{expired} queued payment requests lost their "
+                           f"access token and expired")
+        return interrupted + expired
+
+    def _recover_periodically(self):
+        while not self._stopping.wait(self._recover_interval):
+            self.recover_all()
+
+    def process(self, request_id):
+        """Send one queued request to Teller and record the outcome."""
+        with self._tokens_lock:
+            token, tenant_id = self._tokens.get(request_id, (None, None))
+        if token is None:
+            return
+        with self._session_factory(tenant_id) as s:
+            # Claim the row; only one worker (in any process) wins.
+            claimed = (s.query(PaymentRequest)
+                       .filter(PaymentRequest.id == request_id,
+                               PaymentRequest.status == QUEUED)
+                       .update({PaymentRequest.status: SENDING,
+                                PaymentRequest.attempts:
+                                    PaymentRequest.attempts + 1,
+                                PaymentRequest.updated_at: datetime.utcnow()},
+                               synchronize_session=False))
+            s.commit()
+            row = s.get(PaymentRequest, request_id)
+            if not claimed:
+                # A duplicate of a request another worker is sending; that
+                # worker still needs the token if it has to retry.
+                if row is None or row.status in FINAL_STATUSES:
+                    self._forget(request_id)
+                return
+            kind, account_id, scheme = row.kind, row.account_id, row.scheme
+            body, key, attempts = row.body, row.idempotency_key, row.attempts
+
+        user_client = self._client.for_user(token)
+        send = (user_client.create_account_payment if kind == 'payment'
+                else user_client.create_account_payee)
+        retry = False
+        try:
+            teller_response = send(account_id, scheme, body,
+                                   idempotency_key=key, timeout=self._timeout)
+        except Exception as e:
+            if _never_sent(e):
+                retry = attempts < self._max_attempts
+                update = {'status': QUEUED if retry else FAILED,
+                          'error': f"could not reach Teller: {e}"}
+            else:
+                logger.error(f"Payment request {request_id} outcome unknown",
+                             exc_info=True)
+                update = {'status': UNKNOWN, 'error': str(e)}
+        else:
+            try:
+                retry, update = self._outcome(teller_response, attempts)
+            except Exception as e:
+                # Teller got the request; whatever it did, it must not be
+                # sent again.
+                logger.error(f"Payment request {request_id} outcome unknown",
+                             exc_info=True)
+                update = {'status': UNKNOWN,
+                          'response_status': getattr(
+                              teller_response, 'status_code', None),
+                          'error': f"unreadable Teller response: {e}"}
+
+        try:
+            self._record(tenant_id, request_id, update)
+        except Exception:
+            logger.error(f"Could not record the outcome of payment request "
+                         f"{request_id}", exc_info=True)
+            retry = False
+            try:
+                self._record(tenant_id, request_id, {
+                    'status': UNKNOWN,
+                    'error': "outcome could not be recorded; "
+                             "check with Teller"})
+            except Exception:
+                # Left in 'sending'; recover() makes it 'unknown' once the
+                # lease runs out.
+                logger.error(f"Payment request {request_id} stays 'sending'",
+                             exc_info=True)
+        if retry:
+            delay = self._retry_delay * 2 ** (attempts - 1)
+            timer = threading.Timer(delay, self._queue.put, (request_id,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._forget(request_id)
+
+    def _outcome(self, teller_response, attempts):
+        """``(retry, column updates)`` for a response Teller sent."""
+        code = teller_response.status_code
+        update = {'response_status': code,
+                  'response': (teller_response.json()
+                               if teller_response.content else None),
+                  'error': None}
+        retry = False
+        if code in _RETRYABLE_STATUS_CODES:
+            retry = attempts < self._max_attempts
+            update['status'] = QUEUED if retry else FAILED
+        elif code >= 500:
+            # Teller or a gateway in front of it may have carried the
+            # request out before failing.
+            update['status'] = UNKNOWN
+        else:
+            update['status'] = SUCCEEDED if code < 400 else FAILED
+        return retry, update
+
+    def _record(self, tenant_id, request_id, update):
+        with self._session_factory(tenant_id) as s:
+            row = s.get(PaymentRequest, request_id)
+            for name, value in update.items():
+                setattr(row, name, value)
+            row.updated_at = datetime.utcnow()
+            s.commit()
+
+    def _find(self, s, tenant_id, idempotency_key):
+        return (s.query(PaymentRequest)
+                .filter_by(tenant_id=tenant_id,
+                           idempotency_key=idempotency_key)
+                .one_or_none())
+
+    def _forget(self, request_id):
+        with self._tokens_lock:
+            self._tokens.pop(request_id, None)
+
+    def _run(self):
+        while True:
+            request_id = self._queue.get()
+            if request_id is None:
+                return
+            try:
+                self.process(request_id)
+            except Exception:
+                logger.error(f"Payment worker failed on {request_id}",
+                             exc_info=True)
@@ -0,0 +1,156 @@
+"""Statement counts and timings per request, N+1 warnings and a slow-query
+log, collected from SQLAlchemy engine events.
+
+Statements are grouped by their normalized SQL (literals, parameters and
+IN/VALUES lists collapsed), so a query run once per row shows up as one
+statement with a high count. At the end of a request every statement run
+at least QUERY_N_PLUS_ONE times is logged as a suspected N+1 pattern, and
+with QUERY_DEBUG=1 the totals are sent in ``X-Query-Count`` and
+``X-Query-Time-Ms`` response headers (plus ``X-Query-Repeated``, the
+highest repeat count, when a pattern was flagged).
+
+Any statement slower than SLOW_QUERY_MS, inside a request or not, is
+written to the ``slow_queries`` logger (and to the SLOW_QUERY_LOG file, if
+set) with its EXPLAIN plan.
+"""
+import contextvars
+import logging
+import os
+import re
+import time
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger('slow_queries')
+
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_MS', '200')) / 1000
+N_PLUS_ONE_THRESHOLD = int(os.getenv('QUERY_N_PLUS_ONE', '10'))
+DEBUG_HEADERS = os.getenv('QUERY_DEBUG', '') not in ('', '0')
+
+_EXPLAIN = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN ',
+            'mysql': 'EXPLAIN '}
+_EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+
+_current = contextvars.ContextVar('query_stats', default=None)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PARAM_RE = re.compile(r'%\(\w+\)s|%s|\$\d+|:\w+|\?')
+_LIST_RE = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_VALUES_RE = re.compile(r'(VALUES\s*\(\?\))(?:\s*,\s*\(\?\))+', re.IGNORECASE)
+
+
+def normalize(statement):
+    """``statement`` with its variable parts replaced by ``?``."""
+    sql = _WHITESPACE_RE.sub(' ', statement).strip()
+    sql = _STRING_RE.sub('?', sql)
+    sql = _PARAM_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _LIST_RE.sub('(?)', sql)
+    return _VALUES_RE.sub(r'\1', sql)[:1000]
+
+
+class QueryStats:
+    """Statements run during one request, by normalized SQL."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = {}  # normalized SQL -> [count, seconds]
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        entry = self.statements.setdefault(normalize(statement), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def repeated(self, threshold=None):
+        """``(sql, count)`` of statements run at least ``threshold`` times."""
+        threshold = threshold or N_PLUS_ONE_THRESHOLD
+        return sorted(((sql, count) for sql, (count, _)
+                       in self.statements.items() if count >= threshold),
+                      key=lambda item: -item[1])
+
+
+def begin():
+    """Start collecting for the current request (thread or task)."""
+    stats = QueryStats()
+    _current.set(stats)
+    return stats
+
+
+def end():
+    """Stop collecting; returns what was collected, or None."""
+    stats = _current.get()
+    _current.set(None)
+    return stats
+
+
+def current():
+    return _current.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.record(statement, seconds)
+    if SLOW_QUERY_SECONDS > 0 and seconds >= SLOW_QUERY_SECONDS:
+        plan = None if executemany else explain(conn, cursor, statement,
+                                                parameters)
+        slow_logger.warning(
+            f"{seconds * 1000:.1f} ms: {_WHITESPACE_RE.sub(' ', statement)}"
+            f"\n  parameters: {str(parameters)[:500]}"
+            + (f"\n  plan:\n    {plan}" if plan else ""))
+
+
+def _handle_error(context):
+    if context.connection is not None:
+        started = context.connection.info.get('query_started')
+        if started:
+            started.pop()
+
+
+def explain(conn, cursor, statement, parameters):
+    """The plan of a statement that just ran, or None if not available."""
+    prefix = _EXPLAIN.get(conn.dialect.name)
+    if (prefix is None
+            or not statement.lstrip().upper().startswith(_EXPLAINABLE)):
+        return None
+    try:
+        explain_cursor = cursor.connection.cursor()
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            rows = explain_cursor.fetchall()
+        finally:
+            explain_cursor.close()
+    except Exception as e:
+        logger.debug(f"EXPLAIN failed: {e}")
+        return None
+    return '\n    '.join(' '.join(str(col) for col in row) for row in rows)
+
+
+def install(target):
+    """Collect statistics for ``target`` (an Engine, or the Engine class)."""
+    if event.contains(target, 'after_cursor_execute', _after_cursor_execute):
+        return
+    event.listen(target, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(target, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(target, 'handle_error', _handle_error)
+    path = os.getenv('SLOW_QUERY_LOG')
+    if path and not slow_logger.handlers:
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_logger.addHandler(handler)
@@ -0,0 +1,387 @@
+"""Check stored balances against the stored transactions and against Teller.
+
+    python reconcile.py --workers 8 --batch-size 200
+    python reconcile.py --tokens-file tokens.txt --cert cert.pem \\
+        --cert-key key.pem [--resync]
+
+Accounts are checked in batches of ``--batch-size`` on ``--workers``
+threads; each batch is read with five queries. Without tokens, the default
+database and every tenant shard are checked. Two checks are made:
+
+* ``transactions``: the ledger at the account's reconciliation checkpoint
+  plus the posted transactions dated from its day on, up to the latest
+  balance, must equal the latest stored ledger. Transactions dated on the
+  checkpoint's day that were stored when it was set are already in its
+  ledger; the checkpoint keeps their ids and they are not counted again.
+  Only depository accounts are checked this way, since the sign of credit
+  card transactions relative to their ledger varies.
+* ``teller``: the latest stored ledger must equal the live Teller ledger.
+  This needs the enrollments' access tokens (``--tokens-file``).
+
+Mismatches are stored in ``balance_discrepancies``, one open row per
+account and check. An account that passes gets its checkpoint moved to its
+latest balance and its open discrepancies resolved; an account seen for
+the first time only gets a checkpoint.
+
+With ``--resync``, the accounts of the given tokens that have open
+discrepancies, and only those, are fetched from Teller again, stored, and
+given a fresh checkpoint.
+"""
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import select
+
+import db
+from shards import tenant_for_token
+
+logger = logging.getLogger(__name__)
+
+TRANSACTIONS = 'transactions'
+TELLER = 'teller'
+KINDS = (TRANSACTIONS, TELLER)
+
+TOLERANCE = Decimal('0.01')
+
+
+def _depository(account):
+    return account.type in (None, 'depository')
+
+
+def check_accounts(s, accounts, live=None, tolerance=TOLERANCE, now=None):
+    """Reconcile ``accounts`` (Account rows of one database) and record the
+    outcome in session ``s``; ``live`` maps account ids to Teller's ledger.
+
+    Returns the discrepancies found as ``(account_id, kind, difference)``.
+    """
+    live = live or {}
+    now = now or datetime.utcnow()
+    ids = [a.id for a in accounts]
+    latest = {b.account_id: b for b in s.scalars(
+        select(db.LatestBalance).where(db.LatestBalance.account_id.in_(ids)))}
+    checkpoints = {c.account_id: c for c in s.scalars(
+        select(db.ReconciliationCheckpoint)
+        .where(db.ReconciliationCheckpoint.account_id.in_(ids)))}
+    sums, boundary = _posted_sums(s, accounts, checkpoints, latest)
+    open_rows = {(d.account_id, d.kind): d for d in s.scalars(
+        select(db.BalanceDiscrepancy)
+        .where(db.BalanceDiscrepancy.resolved_at.is_(None))
+        .where(db.BalanceDiscrepancy.account_id.in_(ids)))}
+
+    found, passed = [], {}
+    for account in accounts:
+        balance = latest.get(account.id)
+        if balance is None or balance.ledger is None:
+            continue
+        checks = {}
+        checkpoint = checkpoints.get(account.id)
+        if checkpoint is not None and _depository(account):
+            checks[TRANSACTIONS] = checkpoint.ledger + sums.get(account.id, 0)
+        if account.id in live:
+            checks[TELLER] = live[account.id]
+        failed = False
+        for kind, expected in checks.items():
+            difference = balance.ledger - expected
+            if abs(difference) > tolerance:
+                failed = True
+                found.append((account.id, kind, difference))
+                row = open_rows.get((account.id, kind))
+                if row is None:
+                    row = db.BalanceDiscrepancy(account_id=account.id,
+                                                tenant_id=account.tenant_id,
+                                                kind=kind, detected_at=now)
+                    s.add(row)
+                row.stored_ledger = balance.ledger
+                row.expected_ledger = expected
+                row.difference = difference
+                row.as_of = balance.as_of
+        if not failed:
+            _checkpoint(s, checkpoint, account, balance,
+                        boundary.get(account.id, ()))
+            if checks:
+                passed.setdefault(tuple(sorted(checks)), []).append(account.id)
+    # A check that was not made (no tokens, no checkpoint yet) says nothing
+    # about the discrepancies it found before.
+    for kinds, account_ids in passed.items():
+        _resolve(s, account_ids, now, kinds)
+    return found
+
+
+def _posted_sums(s, accounts, checkpoints, latest):
+    """Posted transaction amounts per account between its checkpoint and
+    its latest balance, from one query.
+
+    Also returns the ids of the posted transactions dated on each latest
+    balance's day, for a checkpoint moved there.
+    """
+    windows = {}
+    for account in accounts:
+        checkpoint, balance = checkpoints.get(account.id), latest.get(account.id)
+        if balance is None or balance.as_of is None:
+            continue
+        if checkpoint is None:
+            start, counted = None, None
+        else:
+            start, counted = checkpoint.as_of.date(), checkpoint.counted_ids
+        windows[account.id] = (start, balance.as_of.date(),
+                               None if counted is None else set(counted))
+    if not windows:
+        return {}, {}
+    since = min(start or end for start, end, _ in windows.values())
+    sums, boundary = {}, {}
+    for txn in s.scalars(select(db.Transaction)
+                         .where(db.Transaction.account_id.in_(list(windows)))
+                         .where(db.Transaction.date >= since)):
+        start, end, counted = windows[txn.account_id]
+        if txn.date > end or txn.payload().get('status') == 'pending':
+            continue
+        if txn.date == end:
+            boundary.setdefault(txn.account_id, []).append(txn.id)
+        if start is None or txn.date < start:
+            continue
+        # Checkpoints set before their ids were kept counted their whole day.
+        if txn.date == start and (counted is None or txn.id in counted):
+            continue
+        sums[txn.account_id] = sums.get(txn.account_id, 0) + txn.amount
+    return sums, boundary
+
+
+def _day_ids(s, account_id, day):
+    """Ids of an account's posted transactions dated ``day``."""
+    return [txn.id for txn in s.scalars(
+                select(db.Transaction)
+                .where(db.Transaction.account_id == account_id)
+                .where(db.Transaction.date == day))
+            if txn.payload().get('status') != 'pending']
+
+
+def _checkpoint(s, checkpoint, account, balance, counted_ids):
+    if checkpoint is None:
+        checkpoint = db.ReconciliationCheckpoint(account_id=account.id,
+                                                 tenant_id=account.tenant_id)
+        s.add(checkpoint)
+    checkpoint.as_of = balance.as_of
+    checkpoint.ledger = balance.ledger
+    checkpoint.counted_ids = sorted(counted_ids)
+
+
+def _resolve(s, account_ids, now, kinds=KINDS):
+    if not account_ids:
+        return
+    (s.query(db.BalanceDiscrepancy)
+     .filter(db.BalanceDiscrepancy.account_id.in_(account_ids),
+             db.BalanceDiscrepancy.kind.in_(kinds),
+             db.BalanceDiscrepancy.resolved_at.is_(None))
+     .update({db.BalanceDiscrepancy.resolved_at: now},
+             synchronize_session=False))
+
+
+def drifted_accounts(s, tenant_id=None):
+    """Ids of accounts with open discrepancies."""
+    q = (select(db.BalanceDiscrepancy.account_id).distinct()
+         .where(db.BalanceDiscrepancy.resolved_at.is_(None)))
+    if tenant_id is not None:
+        q = q.where(db.BalanceDiscrepancy.tenant_id == tenant_id)
+    return list(s.scalars(q))
+
+
+class Reconciler:
+
+    def __init__(self, client=None, session_factory=None, workers=8,
+                 batch_size=200, tolerance=TOLERANCE, databases=None):
+        """``session_factory(tenant_id)`` defaults to db.session_for_tenant;
+        ``client`` (a TellerClient) is only needed with tokens.
+
+        ``databases()`` returns a session factory for every database a run
+        without tokens checks. It defaults to db.session_factories (the
+        default database and every tenant shard), or with a custom
+        ``session_factory`` to ``session_factory(None)``'s database.
+        """
+        self._client = client
+        if databases is None:
+            databases = (db.session_factories if session_factory is None
+                         else lambda: [lambda: session_factory(None)])
+        self._session_factory = session_factory or db.session_for_tenant
+        self._databases = databases
+        self._workers = workers
+        self._batch_size = batch_size
+        self._tolerance = tolerance
+        self.checked = 0
+        self.discrepancies = []
+        self._lock = threading.Lock()
+
+    def run(self, tokens=None):
+        """Check every stored account, or with ``tokens`` the accounts of
+        those enrollments, live balances included."""
+        self.checked, self.discrepancies = 0, []
+        if tokens:
+            targets = []
+            for token in tokens:
+                tenant_id = tenant_for_token(token)
+                targets.append((token, tenant_id,
+                                self._tenant_sessions(tenant_id)))
+        else:
+            targets = [(None, None, factory) for factory in self._databases()]
+        with ThreadPoolExecutor(self._workers,
+                                thread_name_prefix='reconcile') as pool:
+            jobs = []
+            for token, tenant_id, factory in targets:
+                for batch in self._batches(factory, tenant_id):
+                    jobs.append(pool.submit(self._check_batch, factory,
+                                            token, batch))
+            for job in jobs:
+                job.result()
+        return self.discrepancies
+
+    def _tenant_sessions(self, tenant_id):
+        return lambda: self._session_factory(tenant_id)
+
+    def _batches(self, factory, tenant_id):
+        """Account ids in batches, read by keyset pagination."""
+        last = ''
+        while True:
+            with factory() as s:
+                q = (select(db.Account.id).where(db.Account.id > last)
+                     .order_by(db.Account.id).limit(self._batch_size))
+                if tenant_id is not None:
+                    q = q.where(db.Account.tenant_id == tenant_id)
+                batch = list(s.scalars(q))
+            if not batch:
+                return
+            yield batch
+            last = batch[-1]
+
+    def _check_batch(self, factory, token, account_ids):
+        try:
+            # Teller is asked before the session is opened, so no database
+            # transaction waits on the network.
+            live = self._live_ledgers(token, account_ids) if token else None
+            with factory() as s:
+                accounts = list(s.scalars(select(db.Account).where(
+                    db.Account.id.in_(account_ids))))
+                found = check_accounts(s, accounts, live, self._tolerance)
+                s.commit()
+        except Exception:
+            logger.error(f"Reconciling {len(account_ids)} accounts failed",
+                         exc_info=True)
+            return
+        with self._lock:
+            self.checked += len(account_ids)
+            self.discrepancies.extend(found)
+        for account_id, kind, difference in found:
+            logger.warning(f"Account {account_id}: stored ledger differs "
+                           f"from {kind} by {difference}")
+
+    def _live_ledgers(self, token, account_ids):
+        client = self._client.for_user(token)
+        ledgers = {}
+        for account_id in account_ids:
+            teller_response = client.get_account_balances(account_id)
+            if teller_response.status_code == 200:
+                ledger = teller_response.json().get('ledger')
+                if ledger is not None:
+                    ledgers[account_id] = Decimal(str(ledger))
+            else:
+                logger.warning(f"Teller answered "
+                               f"{teller_response.status_code} for the "
+                               f"balance of {account_id}")
+        return ledgers
+
+    def resync(self, tokens):
+        """Refetch the drifted accounts of ``tokens`` from Teller."""
+        resynced = []
+        for token in tokens:
+            tenant_id = tenant_for_token(token)
+            with self._session_factory(tenant_id) as s:
+                drifted = drifted_accounts(s, tenant_id)
+            client = self._client.for_user(token)
+            for account_id in drifted:
+                try:
+                    self._resync_account(client, tenant_id, account_id)
+                    resynced.append(account_id)
+                except Exception:
+                    logger.error(f"Resync of {account_id} failed",
+                                 exc_info=True)
+        return resynced
+
+    def _resync_account(self, client, tenant_id, account_id):
+        balances = client.get_account_balances(account_id)
+        txns = client.list_account_transactions(account_id)
+        if balances.status_code != 200 or txns.status_code != 200:
+            raise RuntimeError(f"Teller answered {balances.status_code}/"
+                               f"{txns.status_code}")
+        now = datetime.utcnow()
+        with self._session_factory(tenant_id) as s:
+            db.upsert_transactions(s, account_id, txns.json(),
+                                   tenant_id=tenant_id)
+            db.add_balance_snapshot(s, account_id, balances.json(), as_of=now,
+                                    tenant_id=tenant_id)
+            account = s.get(db.Account, account_id)
+            checkpoint = s.get(db.ReconciliationCheckpoint, account_id)
+            balance = s.get(db.LatestBalance, account_id,
+                            populate_existing=True)
+            _checkpoint(s, checkpoint, account, balance,
+                        _day_ids(s, account_id, balance.as_of.date()))
+            _resolve(s, [account_id], now)
+            s.commit()
+        logger.info(f"Resynced account {account_id}")
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Reconcile stored balances with transactions and Teller')
+    parser.add_argument('--tokens-file',
+                        help='file with one Teller access token per line; '
+                             'enables the comparison with live balances')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='batches checked in parallel')
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help='accounts per batch')
+    parser.add_argument('--tolerance', type=Decimal, default=TOLERANCE,
+                        help='largest difference that is not reported')
+    parser.add_argument('--resync', action='store_true',
+                        help='refetch accounts with open discrepancies '
+                             '(needs --tokens-file)')
+    parser.add_argument('--cert', type=str,
+                        help='path to the TLS certificate')
+    parser.add_argument('--cert-key', type=str,
+                        help='path to the TLS certificate private key')
+    args = parser.parse_args(argv)
+    if args.resync and not args.tokens_file:
+        parser.error('--resync needs --tokens-file')
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    args = _parse_args(argv)
+    tokens, client = None, None
+    if args.tokens_file:
+        from teller import TellerClient
+
+        with open(args.tokens_file) as f:
+            tokens = list(dict.fromkeys(line.strip() for line in f
+                                        if line.strip()))
+        cert = ((args.cert, args.cert_key) if args.cert and args.cert_key
+                else None)
+        client = TellerClient(cert)
+    db.init_db()
+    reconciler = Reconciler(client, workers=args.workers,
+                            batch_size=args.batch_size,
+                            tolerance=args.tolerance)
+    if args.resync:
+        resynced = reconciler.resync(tokens)
+        logger.info(f"Resynced {len(resynced)} accounts")
+    found = reconciler.run(tokens)
+    logger.info(f"Checked {reconciler.checked} accounts, "
+                f"{len(found)} discrepancies")
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,169 @@
+"""Recurring-payment detection backed by an incremental index.
+
+Every stored transaction belongs to a series keyed by account, normalized
+counterparty and amount band. ``update_index`` is called with only the
+newly inserted transactions and touches only the series they belong to, so
+detection never rescans an account's history. Existing data is indexed with
+
+    python recurring.py --rebuild [--account-id acc_123]
+"""
+import argparse
+import hashlib
+import logging
+import math
+import re
+from datetime import date, timedelta
+from decimal import Decimal
+from statistics import median
+
+# Typical gaps between charges of a recurring series, in days.
+PERIODS = {'weekly': 7, 'biweekly': 14, 'monthly': 30, 'quarterly': 91,
+           'annual': 365}
+MIN_OCCURRENCES = 3
+TOLERANCE = 0.2
+MAX_TRACKED_DATES = 48
+# Amounts within ~15% of each other share a band, so small price changes
+# stay in one series while different products from one merchant do not.
+_BAND_BASE = math.log(1.15)
+
+_NOISE_RE = re.compile(r"[\d#*]+|\s+")
+
+
+def normalize_counterparty(description):
+    """Collapse a description to a stable counterparty key."""
+    return _NOISE_RE.sub(' ', (description or '').lower()).strip()
+
+
+def amount_band(amount):
+    amount = float(amount or 0)
+    if amount == 0:
+        return 0
+    band = int(round(math.log(abs(amount)) / _BAND_BASE)) + 1
+    return band if amount > 0 else -band
+
+
+def series_id(account_id, counterparty, band):
+    key = f"{account_id}|{counterparty}|{band}"
+    return hashlib.sha1(key.encode()).hexdigest()[:32]
+
+
+def classify(dates):
+    """Return ``(period, gap_days)`` for sorted dates, or ``(None, None)``."""
+    if len(dates) < MIN_OCCURRENCES:
+        return None, None
+    gaps = [(b - a).days for a, b in zip(dates, dates[1:])]
+    if min(gaps) <= 0:
+        return None, None
+    gap = median(gaps)
+    period = min(PERIODS, key=lambda p: abs(PERIODS[p] - gap))
+    expected = PERIODS[period]
+    if max(abs(g - expected) for g in gaps) > expected * TOLERANCE:
+        return None, None
+    return period, gap
+
+
+def _refresh(series):
+    dates = [date.fromisoformat(d) for d in series.dates]
+    amounts = [Decimal(a) for a in series.amounts]
+    series.period, gap = classify(dates)
+    series.last_date = dates[-1]
+    series.average_amount = sum(amounts) / len(amounts)
+    series.next_expected = (dates[-1] + timedelta(days=round(gap))
+                            if series.period else None)
+
+
+def _load_series(s, model, ids, chunk_size=500):
+    """The stored series among ``ids``, one query per chunk, plus those
+    added earlier in this session but not flushed yet."""
+    found = {obj.id: obj for obj in s.new if isinstance(obj, model)}
+    ids = [sid for sid in ids if sid not in found]
+    for start in range(0, len(ids), chunk_size):
+        found.update((series.id, series) for series in s.query(model).filter(
+            model.id.in_(ids[start:start + chunk_size])))
+    return found
+
+
+def update_index(s, model, account_id, txns, tenant_id=None):
+    """Fold newly stored transactions (Teller JSON) into their series."""
+    grouped = {}
+    for t in txns:
+        counterparty = normalize_counterparty(t.get('description'))
+        if not counterparty or not t.get('date'):
+            continue
+        band = amount_band(t.get('amount'))
+        grouped.setdefault((counterparty, band), []).append(t)
+
+    ids = {key: series_id(account_id, *key) for key in grouped}
+    stored = _load_series(s, model, list(ids.values()))
+    for (counterparty, band), items in grouped.items():
+        sid = ids[counterparty, band]
+        series = stored.get(sid)
+        if series is None:
+            series = model(id=sid, account_id=account_id, tenant_id=tenant_id,
+                           counterparty=counterparty, amount_band=band,
+                           occurrences=0, dates=[], amounts=[])
+            s.add(series)
+        entries = sorted(zip(series.dates, series.amounts))
+        entries.extend((t['date'], str(t.get('amount', 0))) for t in items)
+        entries.sort()
+        entries = entries[-MAX_TRACKED_DATES:]
+        # Assign new lists so the JSON columns are flagged as modified.
+        series.dates = [d for d, _ in entries]
+        series.amounts = [a for _, a in entries]
+        series.occurrences = (series.occurrences or 0) + len(items)
+        _refresh(series)
+
+
+def detected(s, model, account_id, tenant_filter=None):
+    query = (s.query(model)
+             .filter(model.account_id == account_id)
+             .filter(model.period.is_not(None)))
+    if tenant_filter is not None:
+        query = query.filter(tenant_filter)
+    return [{
+        'counterparty': r.counterparty,
+        'period': r.period,
+        'occurrences': r.occurrences,
+        'average_amount': str(round(r.average_amount, 2)),
+        'last_date': r.last_date.isoformat(),
+        'next_expected': r.next_expected.isoformat(),
+    } for r in query.order_by(model.next_expected)]
+
+
+def rebuild(s, model, transaction_model, account_id=None, batch_size=5000):
+    """Recreate the index from stored transactions (e.g. after migrating)."""
+    query = s.query(model)
+    txns = s.query(transaction_model)
+    if account_id is not None:
+        query = query.filter(model.account_id == account_id)
+        txns = txns.filter(transaction_model.account_id == account_id)
+    query.delete()
+    pending = {}
+    for t in txns.order_by(transaction_model.date).yield_per(batch_size):
+        pending.setdefault((t.account_id, t.tenant_id), []).append({
+            'date': t.date.isoformat() if t.date else None,
+            'description': t.description,
+            'amount': str(t.amount),
+        })
+    for (acct, tenant), items in pending.items():
+        update_index(s, model, acct, items, tenant)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Maintain the recurring-payment index')
+    parser.add_argument('--rebuild', action='store_true', required=True,
+                        help='recompute the index from stored transactions')
+    parser.add_argument('--account-id', help='only rebuild this account')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from db import RecurringSeries, SessionLocal, Transaction
+    with SessionLocal() as s:
+        rebuild(s, RecurringSeries, Transaction, args.account_id)
+        s.commit()
+        logging.info(f"Indexed {s.query(RecurringSeries).count()} series")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def tenant_for_token(token):
+    """Stable tenant key for a Teller access token (one per enrollment).
+
+    The token itself is never stored; only a truncated hash of it.
+    """
+    if not token:
+        return None
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+class ShardMap:
+    """Decides where a tenant's data lives.
+
+    ``locate`` returns None for the default database, a database URL, or
+    ``"schema:<name>"`` for a separate schema inside the default database.
+    Subclass it to plug in a lookup table, consistent hashing, etc.
+    """
+
+    def locate(self, tenant_id):
+        return None
+
+    def locations(self):
+        """Every location ``locate`` can return, for jobs that visit all
+        shards. Maps that cannot enumerate them return only those known."""
+        return []
+
+
+class StaticShardMap(ShardMap):
+
+    def __init__(self, mapping):
+        self._mapping = dict(mapping)
+
+    @classmethod
+    def from_env(cls):
+        raw = os.getenv("TENANT_SHARDS")
+        return cls(json.loads(raw)) if raw else cls({})
+
+    def locate(self, tenant_id):
+        return self._mapping.get(tenant_id)
+
+    def locations(self):
+        return sorted({loc for loc in self._mapping.values() if loc})
+
+
+class ShardRouter:
+    """Hands out session factories for tenants according to a ShardMap.
+
+    Engines are created once per distinct location and the tables are
+    created in a shard the first time it is used.
+    """
+
+    def __init__(self, default_engine, metadata, shard_map=None):
+        self._default_engine = default_engine
+        self._metadata = metadata
+        self._shard_map = shard_map or ShardMap()
+        self._factories = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shard_map(self):
+        return self._shard_map
+
+    @shard_map.setter
+    def shard_map(self, shard_map):
+        with self._lock:
+            self._shard_map = shard_map
+            self._factories = {}
+
+    def is_default(self, tenant_id):
+        return tenant_id is None or self._shard_map.locate(tenant_id) is None
+
+    def sessionmaker_for(self, tenant_id):
+        location = self._shard_map.locate(tenant_id) if tenant_id else None
+        if location is None:
+            return None
+        return self._sessionmaker_at(location)
+
+    def sessionmakers(self):
+        """Session factories of every shard, not including the default."""
+        return [self._sessionmaker_at(location)
+                for location in self._shard_map.locations()]
+
+    def _sessionmaker_at(self, location):
+        from sqlalchemy.orm import sessionmaker
+
+        with self._lock:
+            factory = self._factories.get(location)
+            if factory is None:
+                engine = self._engine_for(location)
+                self._metadata.create_all(engine)
+                factory = sessionmaker(bind=engine, autoflush=False,
+                                       autocommit=False, future=True)
+                self._factories[location] = factory
+                logger.info(f"Initialized tenant shard {location.split('@')[-1]}")
+        return factory
+
+    def _engine_for(self, location):
+        from sqlalchemy import create_engine, text
+
+        if location.startswith("schema:"):
+            schema = location[len("schema:"):]
+            with self._default_engine.begin() as conn:
+                conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+            return self._default_engine.execution_options(
+                schema_translate_map={None: schema})
+        if location.startswith("postgres://"):
+            location = location.replace("postgres://", "postgresql://", 1)
+        return create_engine(location, future=True, pool_pre_ping=True)
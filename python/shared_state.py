@@ -0,0 +1,261 @@
+"""State shared by all server processes: cached Teller responses,
+rate-limit counters and single-flight locks.
+
+SHARED_STATE_URL selects the backend:
+
+* unset: in-process memory, which is all a single worker needs;
+* ``sqlite:///path/to/state.sqlite``: a SQLite file shared by the worker
+  processes on one host, with no extra service to run;
+* ``redis://host:6379/0``: Redis, for workers on several hosts (needs the
+  ``redis`` package).
+
+Values are strings and every key expires. Locks are plain keys set only if
+absent, so a lock whose holder died is released by its TTL.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState:
+
+    def get(self, key):
+        """The value stored under ``key``, or None if absent or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        """Store ``value`` only if ``key`` is absent; True if it was stored."""
+        raise NotImplementedError
+
+    def delete(self, key, value=None):
+        """Remove ``key``; with ``value``, only while it still holds it."""
+        raise NotImplementedError
+
+    def hit(self, key, limit, window):
+        """Count one event in the current ``window`` seconds for ``key``;
+        False once more than ``limit`` happened in it."""
+        raise NotImplementedError
+
+    def acquire(self, key, ttl):
+        """Take the lock ``key``; returns a token for release(), or None
+        while another process holds it."""
+        token = uuid.uuid4().hex
+        return token if self.add(key, token, ttl) else None
+
+    def release(self, key, token):
+        self.delete(key, token)
+
+    def wait_for(self, key, lock, timeout, poll=0.05):
+        """Wait for ``key`` to be set while ``lock`` is held by someone
+        else; returns its value, or None if the lock went away without it."""
+        deadline = time.monotonic() + timeout
+        while True:
+            value = self.get(key)
+            if value is not None or self.get(lock) is None:
+                return value
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+
+class MemoryState(SharedState):
+    """Process-local state; nothing is shared."""
+
+    def __init__(self, max_entries=10000):
+        self._max_entries = max_entries
+        self._entries = {}  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+        return entry[1]
+
+    def _store(self, key, value, expires):
+        if len(self._entries) >= self._max_entries:
+            now = time.monotonic()
+            self._entries = {k: e for k, e in self._entries.items()
+                             if e[0] > now}
+        self._entries[key] = (expires, value)
+
+    def get(self, key):
+        with self._lock:
+            return self._live(key, time.monotonic())
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store(key, value, time.monotonic() + ttl)
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            now = time.monotonic()
+            if self._live(key, now) is not None:
+                return False
+            self._store(key, value, now + ttl)
+            return True
+
+    def delete(self, key, value=None):
+        with self._lock:
+            if value is None or self._live(key, time.monotonic()) == value:
+                self._entries.pop(key, None)
+
+    def hit(self, key, limit, window):
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                entry = (now + window, 0)
+            entry = (entry[0], entry[1] + 1)
+            self._store(key, entry[1], entry[0])
+            return entry[1] <= limit
+
+
+class SQLiteState(SharedState):
+    """State in a SQLite file, shared by the processes on one host."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self._path = path
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connect lazily and again after a fork: pre-forking servers create
+        # the app before starting their workers.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, check_same_thread=False,
+                                         isolation_level=None, timeout=5)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS shared_state ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires REAL NOT NULL)")
+        return self._conn
+
+    def _write(self, sql, params):
+        conn = self._connect()
+        changed = conn.execute(sql, params).rowcount
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM shared_state WHERE expires <= ?",
+                         (time.time(),))
+        return changed
+
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value FROM shared_state WHERE key = ? AND expires > ?",
+                (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._write("INSERT OR REPLACE INTO shared_state"
+                        " (key, value, expires) VALUES (?, ?, ?)",
+                        (key, value, time.time() + ttl))
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            return self._write(
+                "INSERT INTO shared_state (key, value, expires)"
+                " VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE"
+                " SET value = excluded.value, expires = excluded.expires"
+                " WHERE shared_state.expires <= ?",
+                (key, value, now + ttl, now)) == 1
+
+    def delete(self, key, value=None):
+        with self._lock:
+            if value is None:
+                self._write("DELETE FROM shared_state WHERE key = ?", (key,))
+            else:
+                self._write("DELETE FROM shared_state"
+                            " WHERE key = ? AND value = ?", (key, value))
+
+    def hit(self, key, limit, window):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write(
+                    "INSERT INTO shared_state (key, value, expires)"
+                    " VALUES (?, '1', ?) ON CONFLICT (key) DO UPDATE SET"
+                    " value = CASE WHEN expires <= ? THEN '1'"
+                    "              ELSE CAST(value AS INTEGER) + 1 END,"
+                    " expires = CASE WHEN expires <= ? THEN excluded.expires"
+                    "                ELSE expires END",
+                    (key, now + window, now, now))
+                count = conn.execute(
+                    "SELECT value FROM shared_state WHERE key = ?",
+                    (key,)).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return int(count) <= limit
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RedisState(SharedState):
+    """State in Redis, through a redis-py compatible client."""
+
+    def __init__(self, client, prefix='teller:'):
+        self._client = client
+        self._prefix = prefix
+
+    def get(self, key):
+        value = self._client.get(self._prefix + key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, value, px=int(ttl * 1000))
+
+    def add(self, key, value, ttl):
+        return bool(self._client.set(self._prefix + key, value,
+                                     px=int(ttl * 1000), nx=True))
+
+    def delete(self, key, value=None):
+        # Compare-then-delete is not atomic; a lock that expires in between
+        # may be released for its next holder, which at worst lets one more
+        # request through to Teller.
+        if value is None or self.get(key) == value:
+            self._client.delete(self._prefix + key)
+
+    def hit(self, key, limit, window):
+        count = self._client.incr(self._prefix + key)
+        if count == 1:
+            self._client.pexpire(self._prefix + key, int(window * 1000))
+        return count <= limit
+
+
+def from_env():
+    url = os.getenv('SHARED_STATE_URL')
+    if not url:
+        return MemoryState()
+    if url.startswith('sqlite:///'):
+        return SQLiteState(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return RedisState(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported SHARED_STATE_URL {url!r}")
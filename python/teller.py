@@ -1,14 +1,28 @@
 import os
+import socketserver
 from wsgiref import simple_server
 
 import argparse
+import atexit
 import base64
+import hashlib
+import json
 import falcon
-import requests
 import logging
+import signal
 import sys
+import threading
+import time
+from datetime import datetime
 from decimal import Decimal
 
+import db
+from auth_cache import AuthCache, CachedUser
+from middleware import (CompressionMiddleware, ETagMiddleware,
+                        LoadSheddingMiddleware, QueryStatsMiddleware,
+                        not_modified, set_not_modified)
+from shards import tenant_for_token
+
 log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
     level=log_level,
@@ -17,17 +31,57 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Optional subsystems, bound by _load_subsystems() when the app or a
+# resource is created rather than when this module is imported (see
+# tests/test_startup.py), so request handlers do not import anything.
+events = offline = payments = recurring = shared_state = None
+# Imported by the first analytics request, as it loads NumPy.
+analytics = None
+
+
+def _load_subsystems():
+    global events, offline, payments, recurring, shared_state
+    if shared_state is None:
+        import events
+        import offline
+        import payments
+        import recurring
+        import shared_state
+
 
 class TellerClient:
 
     _BASE_URL = 'https://api.teller.io'
+    _POOL_SIZE = int(os.getenv('TELLER_POOL_SIZE', '20'))
+    _TIMEOUT = float(os.getenv('TELLER_TIMEOUT', '10'))
 
-    def __init__(self, cert, access_token=None):
+    def __init__(self, cert, access_token=None, _shared=None):
         self.cert = cert
         self.access_token = access_token
+        # Per-user clients share the parent's connection pool, so TLS
+        # handshakes with Teller are reused across requests.
+        self._shared = _shared if _shared is not None else {}
+        self._shared.setdefault('lock', threading.Lock())
 
     def for_user(self, access_token):
-        return TellerClient(self.cert, access_token)
+        return TellerClient(self.cert, access_token, _shared=self._shared)
+
+    def _session(self):
+        session = self._shared.get('session')
+        if session is None:
+            with self._shared['lock']:
+                session = self._shared.get('session')
+                if session is None:
+                    # requests is imported on the first outbound call to
+                    # keep process start-up fast.
+                    import requests
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=self._POOL_SIZE,
+                        pool_maxsize=self._POOL_SIZE)
+                    session.mount('https://', adapter)
+                    self._shared['session'] = session
+        return session
 
     def list_accounts(self):
         return self._get('/accounts')
@@ -41,33 +95,43 @@ class TellerClient:
     def get_account_balances(self, account_id):
         return self._get(f'/accounts/{account_id}/balances')
 
-    def list_account_transactions(self, account_id, count=None):
-        params = {'count': count} if count else None
-        return self._get(f'/accounts/{account_id}/transactions', params=params)
+    def list_account_transactions(self, account_id, count=None, from_id=None):
+        params = {name: value for name, value in (('count', count),
+                                                  ('from_id', from_id))
+                  if value}
+        return self._get(f'/accounts/{account_id}/transactions',
+                         params=params or None)
 
     def list_account_payees(self, account_id, scheme):
         return self._get(f'/accounts/{account_id}/payments/{scheme}/payees')
 
-    def create_account_payee(self, account_id, scheme, data):
+    def create_account_payee(self, account_id, scheme, data, **kwargs):
         return self._post(f'/accounts/{account_id}/payments/{scheme}/payees',
-                          data)
+                          data, **kwargs)
 
-    def create_account_payment(self, account_id, scheme, data):
-        return self._post(f'/accounts/{account_id}/payments/{scheme}', data)
+    def create_account_payment(self, account_id, scheme, data, **kwargs):
+        return self._post(f'/accounts/{account_id}/payments/{scheme}', data,
+                          **kwargs)
 
     def _get(self, path, params=None):
         return self._request('GET', path, params=params)
 
-    def _post(self, path, data):
-        return self._request('POST', path, data=data)
+    def _post(self, path, data, idempotency_key=None, timeout=None):
+        headers = ({'Idempotency-Key': idempotency_key}
+                   if idempotency_key else None)
+        return self._request('POST', path, data=data, headers=headers,
+                             timeout=timeout)
 
-    def _request(self, method, path, data=None, params=None):
+    def _request(self, method, path, data=None, params=None, headers=None,
+                 timeout=None):
         url = self._BASE_URL + path
         auth = (self.access_token, '')
-        kwargs = {'json': data, 'auth': auth, 'params': params}
+        kwargs = {'json': data, 'auth': auth, 'params': params,
+                  'headers': headers,
+                  'timeout': timeout if timeout is not None else self._TIMEOUT}
         if self.cert and all(self.cert):
             kwargs['cert'] = self.cert
-        return requests.request(method, url, **kwargs)
+        return self._session().request(method, url, **kwargs)
 
 
 class HealthResource:
@@ -75,17 +139,120 @@ class HealthResource:
         resp.media = {"status": "ok"}
 
 
+class StreamResource:
+    """Server-sent events for balance and transaction changes.
+
+    Only the caller's own changes are streamed. ``?account_id=``
+    (repeatable) limits the stream to those of the caller's accounts.
+    """
+
+    def __init__(self, broker, accounts):
+        _load_subsystems()
+        self._broker = broker
+        self._accounts = accounts  # AccountsResource, to identify callers
+
+    def on_get_accounts(self, req, resp):
+        user = self._accounts._user(req)
+        if user.tenant_id is None:
+            raise falcon.HTTPUnauthorized(
+                title="Authorization Required",
+                description="The stream carries the changes of the "
+                            "authorized enrollment.")
+        account_ids = req.get_param_as_list('account_id') or []
+        if account_ids:
+            owned = self._accounts._account_ids(user)
+            if owned is not None:
+                account_ids = [a for a in account_ids if a in owned]
+                if not account_ids:
+                    raise falcon.HTTPNotFound(
+                        title="Unknown Account",
+                        description="None of these accounts belong to "
+                                    "these credentials.")
+        try:
+            sub = self._broker.subscribe(user.tenant_id, account_ids)
+        except events.TooManySubscribers:
+            raise falcon.HTTPServiceUnavailable(
+                title="Too Many Subscribers",
+                description="The live update stream is at capacity.",
+                retry_after=30)
+        resp.content_type = 'text/event-stream'
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.set_header('X-Accel-Buffering', 'no')
+        resp.stream = events.stream(sub)
+
+
+def _analytics():
+    # NumPy is only loaded once analytics are first requested.
+    global analytics
+    if analytics is None:
+        import analytics
+    return analytics
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    # Long-lived event streams would block the single-threaded default.
+    daemon_threads = True
+
+
+class _SharedResponse:
+    """A Teller response body another process stored in shared state."""
+
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode()
+
+    def json(self):
+        return json.loads(self.text)
+
+
 class AccountsResource:
 
-    def __init__(self, client):
+    # A cached account list older than this is refetched before an
+    # unknown account id is rejected.
+    ACCOUNTS_REFRESH_SECONDS = 60
+    # How long a request waits for an identical one in flight elsewhere.
+    FLIGHT_TIMEOUT = 15
+
+    def __init__(self, client, writer=None, archive=None, payments=None,
+                 users=None, offline_policy=None, state=None, cache_ttl=None,
+                 rate_limit=None):
         self._client = client
+        self._writer = writer
+        self._archive = archive
+        self._payments = payments
+        _load_subsystems()
+        self._users = users if users is not None else AuthCache.from_env()
+        self._state = state if state is not None else shared_state.from_env()
+        self._offline = (offline_policy if offline_policy is not None
+                         else offline.OfflinePolicy.from_env(self._state))
+        self._cache_ttl = (cache_ttl if cache_ttl is not None
+                           else float(os.getenv('TELLER_CACHE_TTL', '0')))
+        self._rate_limit = (rate_limit if rate_limit is not None
+                            else int(os.getenv('TELLER_RATE_LIMIT', '0')))
 
     def on_get(self, req, resp):
-        self._proxy(req, resp, lambda client: client.list_accounts())
+        def list_accounts(client):
+            teller_response = client.list_accounts()
+            if teller_response.status_code == 200:
+                user = self._user(req)
+                user.set_accounts(a['id'] for a in teller_response.json())
+                self._store_accounts(req, user.tenant_id,
+                                     teller_response.json())
+            return teller_response
+
+        def stored(s):
+            accounts, as_of = db.stored_accounts(s, self._tenant_id(req),
+                                                 self._owned_accounts(req))
+            return (accounts, as_of) if accounts else None
+        self._proxy(req, resp, list_accounts, stored=stored)
 
     def on_get_details(self, req, resp, account_id):
         self._proxy(req, resp,
-                    lambda client: client.get_account_details(account_id))
+                    lambda client: client.get_account_details(account_id),
+                    account_id=account_id)
 
     def on_get_balances(self, req, resp, account_id):
         def store_balances(client):
@@ -96,18 +263,23 @@ class AccountsResource:
                 balance_data = teller_response.json()
                 logger.info(f"[DEBUG] Teller balance data: {balance_data}")
                 try:
-                    from db import (SessionLocal, add_balance_snapshot,
-                                    upsert_account)
                     account_response = client.get_account(account_id)
                     if account_response.status_code == 200:
                         acct = account_response.json() or {}
                         logger.info(f"[DEBUG] Account data from Teller: {acct}")
+                        tenant_id = req.context.tenant_id
+                        if self._enqueue('balance', account_id, acct,
+                                         balance_data, tenant_id):
+                            return teller_response
                         logger.info(f"[DEBUG] Upserting account {account_id} to database")
-                        with SessionLocal() as s:
-                            upsert_account(s, acct)
+                        with db.session_for_tenant(tenant_id) as s:
+                            db.upsert_account(s, acct, tenant_id=tenant_id)
                             logger.info(f"[DEBUG] Adding balance snapshot: {balance_data}")
-                            add_balance_snapshot(s, account_id, balance_data)
+                            db.add_balance_snapshot(s, account_id,
+                                                    balance_data,
+                                                    tenant_id=tenant_id)
                             s.commit()
+                            db.mark_write(self._client_key(req))
                             logger.info(f"[DEBUG] Successfully committed balance for {account_id}")
                 except Exception:
                     logger.error(f"Error storing balance snapshot for "
@@ -118,29 +290,44 @@ class AccountsResource:
                                     "database."
                     )
             return teller_response
-        self._proxy(req, resp, store_balances)
+
+        def stored(s):
+            latest = db.latest_balance(s, account_id, self._tenant_id(req),
+                                       self._owned_accounts(req))
+            if latest is None:
+                return None
+            return ({'account_id': account_id,
+                     'available': latest['available'],
+                     'ledger': latest['ledger']}, latest['as_of'])
+        self._proxy(req, resp, store_balances, account_id=account_id,
+                    stored=stored)
 
     def on_get_transactions(self, req, resp, account_id):
+        try:
+            count = req.get_param_as_int('count') or None
+        except Exception:
+            count = None
+
         def store_transactions(client):
-            try:
-                count = req.get_param_as_int('count') or None
-            except Exception:
-                count = None
             teller_response = client.list_account_transactions(
                 account_id, count=count)
             if teller_response.status_code == 200:
                 try:
-                    from db import (SessionLocal, upsert_transactions,
-                                    upsert_account)
                     account_response = client.get_account(account_id)
                     if account_response.status_code == 200:
                         acct = account_response.json() or {}
                         logger.info(f"[DEBUG] Account data from Teller: {acct}")
-                        with SessionLocal() as s:
-                            upsert_account(s, acct)
-                            upsert_transactions(s, account_id,
-                                                teller_response.json())
+                        tenant_id = req.context.tenant_id
+                        if self._enqueue('transactions', account_id, acct,
+                                         teller_response.json(), tenant_id):
+                            return teller_response
+                        with db.session_for_tenant(tenant_id) as s:
+                            db.upsert_account(s, acct, tenant_id=tenant_id)
+                            db.upsert_transactions(s, account_id,
+                                                   teller_response.json(),
+                                                   tenant_id=tenant_id)
                             s.commit()
+                            db.mark_write(self._client_key(req))
                 except Exception:
                     logger.error(f"Error storing transactions for "
                                  f"account {account_id}", exc_info=True)
@@ -150,73 +337,411 @@ class AccountsResource:
                                     "database."
                     )
             return teller_response
-        self._proxy(req, resp, store_transactions)
+
+        def stored(s):
+            txns = db.stored_transactions(s, account_id,
+                                          self._tenant_id(req), count,
+                                          self._owned_accounts(req))
+            # Rows carry no fetch time, so no As-Of is reported.
+            return (txns, None) if txns else None
+        self._proxy(req, resp, store_transactions, account_id=account_id,
+                    stored=stored)
 
     def on_get_payees(self, req, resp, account_id, scheme):
         self._proxy(req, resp,
                     lambda client: client.list_account_payees(account_id,
-                                                              scheme))
+                                                              scheme),
+                    account_id=account_id)
 
     def on_post_payees(self, req, resp, account_id, scheme):
+        if self._payments is not None:
+            return self._submit(req, resp, 'payee', account_id, scheme)
         self._proxy(req, resp,
                     lambda client: client.create_account_payee(account_id,
                                                                scheme,
-                                                               req.media))
+                                                               req.media),
+                    account_id=account_id)
 
     def on_post_payments(self, req, resp, account_id, scheme):
+        if self._payments is not None:
+            return self._submit(req, resp, 'payment', account_id, scheme)
         self._proxy(req, resp,
                     lambda client: client.create_account_payment(account_id,
                                                                  scheme,
-                                                                 req.media))
+                                                                 req.media),
+                    account_id=account_id)
+
+    def on_get_payment_request(self, req, resp, request_id):
+        result = self._payments.status(self._tenant_id(req), request_id)
+        if result is None:
+            raise falcon.HTTPNotFound()
+        resp.media = result
+
+    def _submit(self, req, resp, kind, account_id, scheme):
+        """Queue a payment or payee creation; see payments.PaymentQueue."""
+        user = self._user(req)
+        if user.tenant_id is None:
+            raise falcon.HTTPUnauthorized(
+                title="Authorization Required",
+                description="Payments need the enrollment's access token.")
+        self._check_account(user, account_id)
+        key = req.get_header('Idempotency-Key')
+        if not key or len(key) > 255:
+            raise falcon.HTTPBadRequest(
+                title="Idempotency-Key Required",
+                description="Send a unique Idempotency-Key header (at most "
+                            "255 characters) with every payment and payee "
+                            "request, and reuse it when retrying.")
+        try:
+            result, created = self._payments.submit(
+                user.token, user.tenant_id, key, kind, account_id, scheme,
+                req.media)
+        except payments.IdempotencyConflict as e:
+            raise falcon.HTTPUnprocessableEntity(
+                title="Idempotency-Key Reused", description=str(e))
+        if not created:
+            logger.info(f"Repeated {kind} request {result['id']} "
+                        f"({result['status']})")
+        resp.media = result
+        resp.location = f"/api/payments/{result['id']}"
+        resp.status = (falcon.HTTP_200
+                       if result['status'] in payments.FINAL_STATUSES
+                       else falcon.HTTP_202)
 
     def on_get_cached_transactions(self, req, resp, account_id):
+        tenant_id = self._require_tenant(req)
+        owned = self._owned_accounts(req)
         try:
-            from db import SessionLocal, Transaction
             limit = int(req.get_param('limit', default=100))
-            with SessionLocal() as s:
-                rows = (s.query(Transaction)
+            with self._read_session(req) as s:
+                archive_version = (self._archive.version()
+                                   if self._archive else None)
+                etag = db.transactions_etag(s, account_id, limit,
+                                            archive_version,
+                                            tenant_id=tenant_id,
+                                            account_ids=owned)
+                matched = not_modified(req, etag)
+                if matched:
+                    set_not_modified(resp, matched)
+                    return
+                rows = (s.query(db.Transaction)
                         .filter_by(account_id=account_id)
-                        .order_by(Transaction.date.desc())
+                        .filter(db.tenant_filter(db.Transaction,
+                                                 tenant_id, owned))
+                        .order_by(db.Transaction.date.desc())
                         .limit(limit)
                         .all())
-                resp.media = [r.raw for r in rows]
+                txns = [r.payload() for r in rows]
+                if len(txns) < limit and self._archive:
+                    # Older history may have been moved to cold storage.
+                    # Rows stored again after archiving are listed once.
+                    seen = {t.get('id') for t in txns}
+                    archived = self._archive.read(account_id, limit,
+                                                  tenant_id, owned)
+                    txns.extend([t for t in archived
+                                 if t.get('id') not in seen]
+                                [:limit - len(txns)])
+                resp.media = txns
+                resp.etag = etag
         except Exception:
             logger.error(f"Error retrieving cached transactions for "
                          f"account {account_id}", exc_info=True)
             resp.status = falcon.HTTP_500
             resp.media = {"error": "Failed to retrieve cached transactions."}
 
+    def on_get_analytics(self, req, resp, account_id):
+        tenant_id = self._require_tenant(req)
+        try:
+            window = req.get_param_as_int('window', min_value=1) or 30
+            with self._read_session(req) as s:
+                resp.media = _analytics().account_analytics(
+                    s, account_id, window, tenant_id,
+                    self._owned_accounts(req))
+        except falcon.HTTPError:
+            raise
+        except Exception:
+            logger.error(f"Error computing analytics for "
+                         f"account {account_id}", exc_info=True)
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": "Failed to compute analytics."}
+
+    def on_get_recurring(self, req, resp, account_id):
+        tenant_id = self._require_tenant(req)
+        try:
+            with self._read_session(req) as s:
+                resp.media = recurring.detected(
+                    s, db.RecurringSeries, account_id,
+                    db.tenant_filter(db.RecurringSeries, tenant_id,
+                                     self._owned_accounts(req)))
+        except Exception:
+            logger.error(f"Error retrieving recurring payments for "
+                         f"account {account_id}", exc_info=True)
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": "Failed to retrieve recurring payments."}
+
     def on_get_cached_balances(self, req, resp, account_id):
         logger.info(f"[DEBUG] Retrieving cached balance for account {account_id}")
+        tenant_id = self._require_tenant(req)
+        owned = self._owned_accounts(req)
         try:
-            from db import SessionLocal, BalanceSnapshot
-            with SessionLocal() as s:
-                latest = (s.query(BalanceSnapshot)
-                           .filter_by(account_id=account_id)
-                           .order_by(BalanceSnapshot.as_of.desc())
-                           .first())
-                if latest:
-                    balance_data = {
-                        'available': str(latest.available),
-                        'ledger': str(latest.ledger)
-                    }
-                    logger.info(f"[DEBUG] Found cached balance for {account_id}: {balance_data}")
-                    resp.media = balance_data
-                else:
-                    logger.warning(f"[DEBUG] No cached balance found for {account_id}")
-                    resp.media = {}
+            # Cache hits need no database session at all.
+            latest = db.balance_cache.get(account_id, tenant_id, owned)
+            if latest is None:
+                with self._read_session(req) as s:
+                    latest = db.latest_balance(s, account_id, tenant_id,
+                                               owned)
+            if latest:
+                balance_data = {
+                    'available': latest['available'],
+                    'ledger': latest['ledger']
+                }
+                logger.info(f"[DEBUG] Found cached balance for {account_id}: {balance_data}")
+                resp.media = balance_data
+            else:
+                logger.warning(f"[DEBUG] No cached balance found for {account_id}")
+                resp.media = {}
         except Exception:
             logger.error(f"Error retrieving cached balances for "
                          f"account {account_id}", exc_info=True)
             resp.status = falcon.HTTP_500
             resp.media = {"error": "Failed to retrieve cached balances."}
 
-    def _proxy(self, req, resp, fun):
-        token = self._extract_token(req)
-        logger.info(f"[DEBUG] Extracted token (first 10 chars): {token[:10] if token else 'EMPTY'}...")
-        logger.info(f"[DEBUG] Token length: {len(token) if token else 0}")
-        user_client = self._client.for_user(token)
-        teller_response = fun(user_client)
+    def on_get_dashboard(self, req, resp):
+        tenant_id = self._require_tenant(req)
+        limit = req.get_param_as_int('limit', min_value=0, max_value=100)
+        try:
+            with self._read_session(req) as s:
+                resp.media = {'accounts': db.dashboard(
+                    s, tenant_id, 10 if limit is None else limit,
+                    self._owned_accounts(req))}
+        except Exception:
+            logger.error("Error building dashboard", exc_info=True)
+            resp.status = falcon.HTTP_500
+            resp.media = {"error": "Failed to build dashboard."}
+
+    def _read_session(self, req):
+        consistency = (req.get_header('X-Read-Consistency') or '').lower()
+        return db.read_session(self._client_key(req),
+                               require_primary=consistency == 'primary',
+                               tenant_id=self._tenant_id(req))
+
+    def _tenant_id(self, req):
+        return self._user(req).tenant_id
+
+    def _require_tenant(self, req):
+        """The caller's tenant; stored data is never read without one."""
+        tenant_id = self._tenant_id(req)
+        if tenant_id is None:
+            raise falcon.HTTPUnauthorized(
+                title="Authorization Required",
+                description="Stored data is only served to the enrollment "
+                            "it belongs to.")
+        return tenant_id
+
+    def _owned_accounts(self, req):
+        """Ids of the caller's accounts as last listed by Teller, if known.
+
+        Rows stored before tenants were tracked are only shown for these
+        (see db.tenant_filter); Teller is not asked here, so stored data
+        can still be served while it is down.
+        """
+        return self._user(req).accounts or ()
+
+    def _client_key(self, req):
+        if 'client_key' not in req.context:
+            auth_header = req.get_header('Authorization')
+            req.context.client_key = (
+                hashlib.sha256(auth_header.encode()).hexdigest()
+                if auth_header else None)
+        return req.context.client_key
+
+    def _user(self, req):
+        """The caller's CachedUser; the header is only decoded on a miss."""
+        user = req.context.get('user')
+        if user is not None:
+            return user
+        key = self._client_key(req)
+        user = self._users.get(key) if key else None
+        if user is None:
+            token = self._extract_token(req)
+            user = CachedUser(token, tenant_for_token(token),
+                              self._client.for_user(token))
+            if key:
+                self._users.put(key, user)
+        req.context.user = user
+        req.context.tenant_id = user.tenant_id
+        return user
+
+    def _account_ids(self, user, account_id=None):
+        """The user's account ids, asking Teller only when they are not
+        known yet or a stale list lacks ``account_id``; None if Teller
+        could not tell."""
+        if (user.accounts is None
+                or (account_id is not None
+                    and account_id not in user.accounts
+                    and user.accounts_age() > self.ACCOUNTS_REFRESH_SECONDS)):
+            teller_response = user.client.list_accounts()
+            if teller_response.status_code != 200:
+                return None
+            user.set_accounts(a['id'] for a in teller_response.json())
+        return user.accounts
+
+    def _check_account(self, user, account_id):
+        """Reject account ids the user does not have, without asking Teller
+        whenever the user's account list is already known."""
+        accounts = self._account_ids(user, account_id)
+        if accounts is None:
+            return  # let the proxied call report the problem
+        if account_id not in accounts:
+            raise falcon.HTTPNotFound(
+                title="Unknown Account",
+                description=f"No account {account_id} for these credentials.")
+
+    def _enqueue(self, kind, account_id, acct, payload, tenant_id=None):
+        """Hand a write to the write-behind spool, if one is configured.
+
+        Returns False when the caller has to persist synchronously, either
+        because write-behind is disabled or because the spool is full.
+        """
+        if self._writer is None:
+            return False
+        if self._writer.offer(kind, account_id, acct, payload,
+                              tenant_id=tenant_id):
+            return True
+        logger.warning(f"Write-behind spool full, storing {kind} for "
+                       f"account {account_id} synchronously")
+        return False
+
+    def _store_accounts(self, req, tenant_id, accts_json):
+        """Keep the account list for offline serving; unchanged accounts
+        cost no queries (see db.upsert_accounts)."""
+        if tenant_id is None:
+            return
+        try:
+            with db.session_for_tenant(tenant_id) as s:
+                if db.upsert_accounts(s, accts_json, tenant_id=tenant_id):
+                    s.commit()
+                    db.mark_write(self._client_key(req))
+        except Exception:
+            logger.warning("Could not store the account list", exc_info=True)
+
+    def _serve_stored(self, req, resp, user, fun, stored, reason):
+        """Answer from the database and refresh it from Teller in the
+        background. Returns False if nothing is stored for the request."""
+        if user.tenant_id is None:
+            return False
+        try:
+            with self._read_session(req) as s:
+                found = stored(s)
+        except Exception:
+            logger.error(f"Error reading stored data for {req.path}",
+                         exc_info=True)
+            return False
+        if found is None:
+            return False
+        data, as_of = found
+        resp.media = data
+        resp.set_header('X-Data-Source', 'database')
+        resp.set_header('X-Data-Reason', reason)
+        if as_of is not None:
+            age = (datetime.utcnow() - as_of).total_seconds()
+            resp.set_header('X-Data-As-Of', as_of.isoformat())
+            resp.set_header('Age', str(max(0, int(age))))
+        self._offline.refresh((user.tenant_id, req.path),
+                              lambda: fun(user.client))
+        return True
+
+    def _fetch(self, req, user, fun):
+        """``fun(user.client)``, coordinated through the shared state.
+
+        With TELLER_CACHE_TTL set, a GET answered by Teller is reused for
+        identical requests of the same user in any process, and identical
+        requests arriving meanwhile wait for that one call instead of
+        making their own. TELLER_RATE_LIMIT caps the Teller calls per user
+        and minute.
+        """
+        tenant_id = user.tenant_id
+        if req.method != 'GET' or self._cache_ttl <= 0 or tenant_id is None:
+            self._count_teller_call(tenant_id)
+            return self._call_teller(req, user, fun)
+        key = f"teller:{tenant_id}:{req.relative_uri}"
+        flight = 'flight:' + key
+        cached = self._state.get(key)
+        lock = None
+        if cached is None:
+            lock = self._state.acquire(flight, self.FLIGHT_TIMEOUT)
+            if lock is None:
+                cached = self._state.wait_for(key, flight,
+                                              self.FLIGHT_TIMEOUT)
+        if cached is not None:
+            return _SharedResponse(cached)
+        try:
+            self._count_teller_call(tenant_id)
+            teller_response = self._call_teller(req, user, fun)
+            if teller_response.status_code == 200:
+                self._state.set(key, teller_response.text, self._cache_ttl)
+            return teller_response
+        finally:
+            if lock is not None:
+                self._state.release(flight, lock)
+
+    def _call_teller(self, req, user, fun):
+        # Only time spent waiting on Teller adapts the proxy concurrency
+        # limit; see LoadSheddingMiddleware.
+        started = time.monotonic()
+        try:
+            return fun(user.client)
+        finally:
+            req.context.upstream_seconds = (
+                req.context.get('upstream_seconds', 0.0)
+                + time.monotonic() - started)
+
+    def _count_teller_call(self, tenant_id):
+        if (self._rate_limit > 0 and tenant_id is not None
+                and not self._state.hit(f"rate:{tenant_id}",
+                                        self._rate_limit, 60)):
+            raise falcon.HTTPTooManyRequests(
+                title="Rate Limit Exceeded",
+                description=f"At most {self._rate_limit} Teller requests "
+                            f"per minute are made for these credentials.",
+                retry_after=60)
+
+    def _proxy(self, req, resp, fun, account_id=None, stored=None):
+        """Call Teller through ``fun(client)`` and relay its response.
+
+        ``stored(session)`` returns ``(data, as_of)`` from the database, or
+        None; routes that pass it are served from there according to the
+        offline policy (see offline.py).
+        """
+        user = self._user(req)
+        if stored is not None:
+            reason = self._offline.stored_first(req)
+            if reason and self._serve_stored(req, resp, user, fun, stored,
+                                             reason):
+                return
+        try:
+            if account_id is not None:
+                self._check_account(user, account_id)
+            teller_response = self._fetch(req, user, fun)
+        except falcon.HTTPTooManyRequests:
+            if (stored is not None and self._offline.rate_limited()
+                    and self._serve_stored(req, resp, user, fun, stored,
+                                           offline.RATE_LIMITED)):
+                return
+            raise
+        except Exception as e:
+            if (stored is not None and self._offline.fall_back(exc=e)
+                    and self._serve_stored(req, resp, user, fun, stored,
+                                           offline.TELLER_UNAVAILABLE)):
+                return
+            raise
+        if stored is not None:
+            if not self._offline.fall_back(teller_response):
+                self._offline.teller_ok()
+            elif self._serve_stored(req, resp, user, fun, stored,
+                                    offline.TELLER_UNAVAILABLE):
+                return
+            resp.set_header('X-Data-Source', 'teller')
 
         logger.info(f"[DEBUG] Teller API response status: {teller_response.status_code}")
         if teller_response.status_code != 200:
@@ -229,18 +754,15 @@ class AccountsResource:
 
     def _extract_token(self, req):
         auth_header = req.get_header('Authorization') or ''
-        logger.info(f"[DEBUG] Raw Authorization header: {auth_header[:50] if auth_header else 'EMPTY'}...")
         if auth_header.startswith('Basic '):
             try:
                 b64 = auth_header.split(' ', 1)[1].strip()
                 decoded = base64.b64decode(b64).decode('utf-8')
                 username, _, _ = decoded.partition(':')
-                logger.info(f"[DEBUG] Extracted from Basic auth, username: {username[:10]}...")
                 return username
             except Exception as e:
-                logger.error(f"[DEBUG] Failed to decode Basic auth: {e}")
+                logger.error(f"Failed to decode Basic auth: {e}")
                 return ''
-        logger.info(f"[DEBUG] Using raw header as token")
         return auth_header
 
 
@@ -267,30 +789,45 @@ def _parse_args():
     return args
 
 
-def main():
-    args = _parse_args()
-    cert = (args.cert, args.cert_key) if args.cert and args.cert_key else None
-    client = TellerClient(cert)
+def create_app(client, writer=None, payment_queue=None):
+    """Build the WSGI app. The database engines are created here.
 
-    try:
-        from db import init_db
-        init_db()
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Database initialization failed: {e}", exc_info=True)
-        return 1
+    Without ``payment_queue`` one is created and its workers started.
+    """
+    _load_subsystems()
+    from archive import ArchiveReader
+    db.init_engine()
+    if payment_queue is None:
+        payment_queue = payments.PaymentQueue.from_env(
+            client, db.session_for_tenant, databases=db.session_factories)
+        payment_queue.start()
 
-    logger.info("Starting up ...")
-
-    accounts = AccountsResource(client)
+    accounts = AccountsResource(client, writer=writer,
+                                archive=ArchiveReader(),
+                                payments=payment_queue)
     health = HealthResource()
+    stream = StreamResource(events.broker, accounts)
 
     app = falcon.App(
-        middleware=falcon.CORSMiddleware(allow_origins='*',
-                                         allow_credentials='*')
+        middleware=[
+            LoadSheddingMiddleware(),
+            QueryStatsMiddleware(),
+            falcon.CORSMiddleware(allow_origins='*',
+                                  allow_credentials='*',
+                                  expose_headers=['ETag', 'Location', 'Age',
+                                                  'X-Data-Source',
+                                                  'X-Data-Reason',
+                                                  'X-Data-As-Of',
+                                                  'X-Query-Count',
+                                                  'X-Query-Time-Ms',
+                                                  'X-Query-Repeated']),
+            CompressionMiddleware(),
+            ETagMiddleware(),
+        ]
     )
 
     app.add_route('/health', health)
+    app.add_route('/api/stream/accounts', stream, suffix='accounts')
     app.add_route('/api/accounts', accounts)
     app.add_route('/api/accounts/{account_id}/details', accounts,
                   suffix='details')
@@ -302,18 +839,70 @@ def main():
                   accounts, suffix='payees')
     app.add_route('/api/accounts/{account_id}/payments/{scheme}', accounts,
                   suffix='payments')
+    app.add_route('/api/payments/{request_id}', accounts,
+                  suffix='payment_request')
+    app.add_route('/api/db/dashboard', accounts, suffix='dashboard')
     app.add_route('/api/db/accounts/{account_id}/transactions', accounts,
                   suffix='cached_transactions')
     app.add_route('/api/db/accounts/{account_id}/balances', accounts,
                   suffix='cached_balances')
+    app.add_route('/api/db/accounts/{account_id}/analytics', accounts,
+                  suffix='analytics')
+    app.add_route('/api/db/accounts/{account_id}/recurring', accounts,
+                  suffix='recurring')
+    return app
+
+
+def main():
+    args = _parse_args()
+    cert = (args.cert, args.cert_key) if args.cert and args.cert_key else None
+    client = TellerClient(cert)
+
+    try:
+        db.init_db()
+        logger.info("Database initialized successfully")
+        if db.engine.dialect.name == 'postgresql':
+            from partitions import start_maintenance_thread
+            start_maintenance_thread(db.engine)
+    except Exception as e:
+        logger.error(f"Database initialization failed: {e}", exc_info=True)
+        return 1
+
+    # Turn SIGTERM into SystemExit so the spool is flushed and in-flight
+    # payments are finished on shutdown.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    writer = None
+    if os.getenv('WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'):
+        from writebehind import WriteBehindWriter
+        writer = WriteBehindWriter.from_env(db.session_for_tenant)
+        writer.start()
+        atexit.register(writer.stop)
+
+    _load_subsystems()
+    payment_queue = payments.PaymentQueue.from_env(
+        client, db.session_for_tenant, databases=db.session_factories)
+    payment_queue.start()
+    atexit.register(payment_queue.stop)
+
+    logger.info("Starting up ...")
+    app = create_app(client, writer=writer, payment_queue=payment_queue)
 
     port = os.getenv('PORT') or '8001'
 
-    httpd = simple_server.make_server('', int(port), app)
+    httpd = simple_server.make_server('', int(port), app,
+                                      server_class=ThreadingWSGIServer)
 
     logger.info(f"Listening on port {port}, press ^C to stop.\n")
 
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        payment_queue.stop()
+        if writer is not None:
+            writer.stop()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,53 @@
 import sys
 from pathlib import Path
 
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
+import db  # noqa: E402
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A fresh database with every table; a file, so threads share it."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    db.Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def Session(engine):
+    return sessionmaker(bind=engine, autoflush=False, future=True)
+
+
+@pytest.fixture
+def session_factory(Session):
+    """Stand-in for db.session_for_tenant with every tenant in one database."""
+    return lambda tenant_id=None: Session()
+
+
+@pytest.fixture
+def session(Session):
+    with Session() as s:
+        yield s
+
+
+@pytest.fixture
+def db_engine(engine, monkeypatch):
+    """``engine`` as db's module-wide engine, restored after the test."""
+    from shards import ShardRouter, StaticShardMap
+
+    Session = sessionmaker(bind=engine, autoflush=False, future=True)
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "read_engine", engine)
+    monkeypatch.setattr(db, "SessionLocal", Session)
+    monkeypatch.setattr(db, "ReadSessionLocal", Session)
+    monkeypatch.setattr(db, "shard_router", ShardRouter(
+        engine, db.Base.metadata, StaticShardMap({})))
+    return engine
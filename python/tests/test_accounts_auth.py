@@ -1,7 +1,13 @@
 import base64
 
+import falcon
+import falcon.testing
 import pytest
 
+import db
+import offline
+import shared_state
+from shards import tenant_for_token
 from teller import AccountsResource, TellerClient
 
 
@@ -44,3 +50,124 @@ def test_extract_token_returns_header_for_non_basic():
 
     assert result == header
 
+
+
+class CountingClient:
+    def __init__(self, account_ids=("acc_1",)):
+        self.users = []
+        self.calls = []
+        self.account_ids = account_ids
+
+    def for_user(self, token):
+        self.users.append(token)
+        return self
+
+    def list_accounts(self):
+        self.calls.append('list_accounts')
+        return _Response(200, [{"id": a} for a in self.account_ids])
+
+    def get_account_details(self, account_id):
+        self.calls.append(account_id)
+        return _Response(200, {"account_id": account_id})
+
+
+class _Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.content = b"x"
+        self.text = ""
+
+    def json(self):
+        return self._body
+
+
+def test_users_are_cached_and_unknown_accounts_rejected_locally():
+    client = CountingClient()
+    app = falcon.App()
+    app.add_route("/api/accounts/{account_id}/details",
+                  AccountsResource(client), suffix="details")
+    http = falcon.testing.TestClient(app)
+    headers = {"Authorization": "token-a"}
+
+    assert http.simulate_get("/api/accounts/acc_1/details",
+                             headers=headers).status_code == 200
+    assert http.simulate_get("/api/accounts/acc_1/details",
+                             headers=headers).status_code == 200
+    assert http.simulate_get("/api/accounts/acc_bogus/details",
+                             headers=headers).status_code == 404
+    assert client.users == ["token-a"]
+    assert client.calls == ["list_accounts", "acc_1", "acc_1"]
+
+
+def test_stored_data_needs_credentials_and_legacy_rows_an_owner(
+        db_engine, session_factory):
+    with session_factory() as s:
+        db.upsert_account(s, {"id": "acc_legacy", "name": "Legacy"})
+        db.upsert_transactions(s, "acc_legacy", [
+            {"id": "txn_1", "date": "2025-01-02", "amount": "-5.00"}])
+        s.commit()
+    client = CountingClient(account_ids=())
+    resource = AccountsResource(client, state=shared_state.MemoryState(),
+                                offline_policy=offline.OfflinePolicy(
+                                    mode="off"))
+    app = falcon.App()
+    app.add_route("/api/accounts", resource)
+    app.add_route("/api/db/dashboard", resource, suffix="dashboard")
+    for suffix in ("transactions", "balances", "analytics", "recurring"):
+        app.add_route(f"/api/db/accounts/{{account_id}}/{suffix}", resource,
+                      suffix=("cached_" + suffix
+                              if suffix in ("transactions", "balances")
+                              else suffix))
+    http = falcon.testing.TestClient(app)
+    routes = ["/api/db/dashboard"] + [
+        f"/api/db/accounts/acc_legacy/{suffix}"
+        for suffix in ("transactions", "balances", "analytics", "recurring")]
+
+    for route in routes:
+        assert http.simulate_get(route).status_code == 401
+
+    owner = {"Authorization": "token-a"}
+    other = {"Authorization": "token-b"}
+    assert http.simulate_get("/api/db/dashboard",
+                             headers=owner).json == {"accounts": []}
+    client.account_ids = ("acc_legacy",)
+    assert http.simulate_get("/api/accounts",
+                             headers=owner).status_code == 200
+    assert [t["id"] for t in http.simulate_get(
+        "/api/db/accounts/acc_legacy/transactions",
+        headers=owner).json] == ["txn_1"]
+    assert http.simulate_get("/api/db/accounts/acc_legacy/transactions",
+                             headers=other).json == []
+    assert http.simulate_get("/api/db/dashboard",
+                             headers=other).json == {"accounts": []}
+
+
+def test_stored_transaction_tags_differ_between_tenants(db_engine,
+                                                        session_factory):
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", [
+            {"id": "txn_1", "date": "2025-01-02", "amount": "-5.00"}],
+            tenant_id=tenant_for_token("token-a"))
+        s.commit()
+    app = falcon.App()
+    app.add_route("/api/db/accounts/{account_id}/transactions",
+                  AccountsResource(CountingClient(),
+                                   state=shared_state.MemoryState()),
+                  suffix="cached_transactions")
+    http = falcon.testing.TestClient(app)
+    route = "/api/db/accounts/acc_1/transactions"
+
+    alice = http.simulate_get(route, headers={"Authorization": "token-a"})
+    bob = http.simulate_get(route, headers={"Authorization": "token-b"})
+    assert [t["id"] for t in alice.json] == ["txn_1"]
+    assert bob.json == []
+    assert alice.headers["ETag"] != bob.headers["ETag"]
+
+    replayed = http.simulate_get(route, headers={
+        "Authorization": "token-b", "If-None-Match": alice.headers["ETag"]})
+    assert replayed.status_code == 200
+    assert replayed.json == []
+    assert http.simulate_get(route, headers={
+        "Authorization": "token-a",
+        "If-None-Match": alice.headers["ETag"]}).status_code == 304
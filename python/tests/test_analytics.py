@@ -0,0 +1,94 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+import db
+import recurring
+from analytics import (account_analytics, anomaly_flags, daily_cash_flow,
+                       normalize_counterparty, rolling_mean)
+
+
+def test_daily_cash_flow_fills_empty_days():
+    dates = np.array(["2025-01-01", "2025-01-01", "2025-01-03"],
+                     dtype="datetime64[D]")
+    amounts = np.array([100.0, -40.0, -10.0])
+
+    days, inflow, outflow, net = daily_cash_flow(dates, amounts)
+
+    assert [str(d) for d in days] == ["2025-01-01", "2025-01-02", "2025-01-03"]
+    assert inflow.tolist() == [100.0, 0.0, 0.0]
+    assert outflow.tolist() == [-40.0, 0.0, -10.0]
+    assert net.tolist() == [60.0, 0.0, -10.0]
+
+
+def test_rolling_mean_uses_trailing_window():
+    assert rolling_mean(np.array([2.0, 4.0, 6.0, 8.0]), 2).tolist() == [
+        2.0, 3.0, 5.0, 7.0]
+
+
+def test_anomaly_flags_marks_outliers():
+    amounts = np.array([-10.0, -12.0, -11.0, -9.0, -10.5, -950.0])
+
+    assert anomaly_flags(amounts).tolist() == [False] * 5 + [True]
+
+
+def test_anomaly_flags_score_deposits_apart_from_spending():
+    amounts = np.array([-10.0, -12.0, -11.0, -9.0, -10.5,
+                        2500.0, 2500.0, 2450.0])
+
+    assert not anomaly_flags(amounts).any()
+
+
+def test_anomaly_flags_with_mostly_equal_amounts():
+    subscription = [-15.99] * 6
+    assert not anomaly_flags(np.array(subscription)).any()
+
+    amounts = np.array(subscription + [-20.0, -25.0, -950.0])
+    assert anomaly_flags(amounts).tolist() == [False] * 8 + [True]
+
+
+def test_normalize_counterparty_drops_reference_numbers():
+    assert normalize_counterparty("NETFLIX.COM #4821 ") == "netflix.com"
+
+
+def test_account_analytics_detects_monthly_subscription(session):
+    start = date(2025, 1, 15)
+    txns = [{"id": f"sub_{i}", "date": (start + timedelta(days=30 * i)).isoformat(),
+             "description": f"Streaming Co {1000 + i}", "amount": "-15.99"}
+            for i in range(4)]
+    txns.append({"id": "pay_1", "date": "2025-02-01", "description": "Payroll",
+                 "amount": "2500"})
+    db.upsert_transactions(session, "acc_1", txns)
+    session.commit()
+
+    result = account_analytics(session, "acc_1", window=7)
+
+    assert result["transactions"] == 5
+    assert result["monthly"][0] == {"month": "2025-01", "inflow": 0.0,
+                                    "outflow": -15.99, "net": -15.99}
+    [recurring] = result["recurring"]
+    assert recurring["counterparty"] == "streaming co"
+    assert recurring["period"] == "monthly"
+    assert recurring["next_expected"] == "2025-05-15"
+
+
+def test_account_analytics_agrees_with_the_recurring_index(session):
+    # One merchant, two monthly products: separate series in the index.
+    start = date(2025, 1, 1)
+    txns = []
+    for i in range(4):
+        day = start + timedelta(days=30 * i)
+        txns.append({"id": f"basic_{i}", "date": day.isoformat(),
+                     "description": "Cloud Co", "amount": "-9.99"})
+        txns.append({"id": f"pro_{i}",
+                     "date": (day + timedelta(days=5)).isoformat(),
+                     "description": "Cloud Co", "amount": "-49.99"})
+    db.upsert_transactions(session, "acc_1", txns)
+    session.commit()
+
+    found = account_analytics(session, "acc_1")["recurring"]
+    stored = recurring.detected(session, db.RecurringSeries, "acc_1")
+
+    assert len(found) == 2
+    assert (sorted((r["period"], r["next_expected"]) for r in found)
+            == sorted((r["period"], r["next_expected"]) for r in stored))
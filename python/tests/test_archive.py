@@ -0,0 +1,135 @@
+from datetime import date
+
+import falcon
+import falcon.testing
+import pytest
+
+import db
+import offline
+import shared_state
+import teller
+from shards import tenant_for_token
+
+pytest.importorskip("pyarrow")
+
+from archive import ArchiveReader, archive_transactions, load_manifest  # noqa: E402
+
+
+def _txn(txn_id, day):
+    return {"id": txn_id, "date": day, "description": "Rent", "amount": "-900"}
+
+
+def test_old_transactions_move_to_archive_and_read_back(tmp_path,
+                                                        session_factory):
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", [
+            _txn("txn_1", "2023-01-05"),
+            _txn("txn_2", "2023-02-05"),
+            _txn("txn_3", "2025-06-01"),
+        ])
+        s.commit()
+
+    moved = archive_transactions(session_factory, date(2024, 1, 1),
+                                 root=tmp_path, batch_size=1)
+
+    assert moved == 2
+    manifest = load_manifest(tmp_path)
+    assert sorted(manifest["files"]) == ["2023-01/acc_1.parquet",
+                                         "2023-02/acc_1.parquet"]
+    with session_factory() as s:
+        assert [t.id for t in s.query(db.Transaction)] == ["txn_3"]
+
+    reader = ArchiveReader(tmp_path)
+    assert [t["id"] for t in reader.read("acc_1", limit=10)] == [
+        "txn_2", "txn_1"]
+    assert [t["id"] for t in reader.read("acc_1", limit=1)] == ["txn_2"]
+    assert reader.read("acc_other", limit=10) == []
+
+
+def test_rearchiving_a_month_merges_rows(tmp_path, session_factory):
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", [_txn("txn_1", "2023-01-05")])
+        s.commit()
+    archive_transactions(session_factory, date(2024, 1, 1), root=tmp_path)
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", [_txn("txn_2", "2023-01-20")])
+        s.commit()
+
+    archive_transactions(session_factory, date(2024, 1, 1), root=tmp_path)
+
+    entry = load_manifest(tmp_path)["files"]["2023-01/acc_1.parquet"]
+    assert entry["rows"] == 2
+    assert entry["max_date"] == "2023-01-20"
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    root = tmp_path / "archive"
+    monkeypatch.setenv("TRANSACTION_ARCHIVE_DIR", str(root))
+    return root
+
+
+def test_archived_transactions_are_not_stored_again(archive_dir,
+                                                    session_factory):
+    txns = [_txn("txn_1", "2023-01-05"), _txn("txn_2", "2025-06-01")]
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", txns)
+        s.commit()
+    archive_transactions(session_factory, date(2024, 1, 1), root=archive_dir)
+
+    # The next sync returns the archived transaction again.
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", txns + [_txn("txn_3", "2025-06-02")])
+        db.bulk_insert_transactions(s, "acc_1", [_txn("txn_1", "2023-01-05")])
+        s.commit()
+        assert sorted(t.id for t in s.query(db.Transaction)) == [
+            "txn_2", "txn_3"]
+
+
+def test_history_that_was_never_archived_is_stored(archive_dir,
+                                                   session_factory):
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", [_txn("txn_1", "2023-01-05")])
+        s.commit()
+    archive_transactions(session_factory, date(2024, 1, 1), root=archive_dir)
+
+    # An account linked after the archive run brings its own old history.
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_new", [_txn("new_1", "2023-03-01"),
+                                              _txn("new_2", "2025-06-01")])
+        db.bulk_insert_transactions(s, "acc_new",
+                                    [_txn("new_0", "2022-12-01")])
+        s.commit()
+        assert sorted(t.id for t in s.query(db.Transaction)) == [
+            "new_0", "new_1", "new_2"]
+
+
+def test_cached_transactions_list_archived_rows_once(archive_dir, db_engine,
+                                                     session_factory):
+    tenant_id = tenant_for_token("token")
+    with session_factory() as s:
+        db.upsert_transactions(s, "acc_1", [_txn("txn_1", "2023-01-05"),
+                                            _txn("txn_2", "2023-01-06")],
+                               tenant_id=tenant_id)
+        s.commit()
+    archive_transactions(session_factory, date(2024, 1, 1), root=archive_dir)
+    # Stored again by a release that did not skip archived history.
+    with session_factory() as s:
+        s.add(db.Transaction(id="txn_2", account_id="acc_1",
+                             date=date(2023, 1, 6), raw={"id": "txn_2"},
+                             tenant_id=tenant_id))
+        s.commit()
+
+    app = falcon.App()
+    app.add_route("/api/db/accounts/{account_id}/transactions",
+                  teller.AccountsResource(
+                      teller.TellerClient(None),
+                      archive=ArchiveReader(archive_dir),
+                      state=shared_state.MemoryState(),
+                      offline_policy=offline.OfflinePolicy(mode="off")),
+                  suffix="cached_transactions")
+    result = falcon.testing.TestClient(app).simulate_get(
+        "/api/db/accounts/acc_1/transactions",
+        headers={"Authorization": "token"})
+
+    assert [t["id"] for t in result.json] == ["txn_2", "txn_1"]
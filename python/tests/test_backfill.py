@@ -0,0 +1,92 @@
+import backfill
+import db
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class PagingClient:
+    """Teller stand-in with 25 transactions per account, newest first."""
+
+    def __init__(self, accounts, fail_after=None):
+        self.accounts = accounts
+        self.fail_after = fail_after
+        self.pages = 0
+
+    def for_user(self, token):
+        return self
+
+    def list_accounts(self):
+        return FakeResponse(200, [{'id': a} for a in self.accounts])
+
+    def list_account_transactions(self, account_id, count=None, from_id=None):
+        self.pages += 1
+        if self.fail_after is not None and self.pages > self.fail_after:
+            return FakeResponse(404)
+        txns = [{'id': f'{account_id}_{n:03d}',
+                 'date': f'2024-{n % 12 + 1:02d}-01',
+                 'description': f'Shop {n}', 'amount': '-1.00'}
+                for n in range(25, 0, -1)]
+        start = 0
+        if from_id is not None:
+            start = [t['id'] for t in txns].index(from_id)  # inclusive
+        return FakeResponse(200, txns[start:start + count])
+
+
+def _count(session_factory):
+    with session_factory() as s:
+        return s.query(db.Transaction).count()
+
+
+def test_backfill_loads_every_page_of_every_account(tmp_path,
+                                                    session_factory):
+    checkpoints = backfill.Checkpoints(str(tmp_path / 'cp.sqlite'))
+    job = backfill.Backfill(PagingClient(['acc_a', 'acc_b']), checkpoints,
+                            session_factory, workers=2, page_size=10,
+                            batch_size=10)
+
+    progress = job.run(['token'])
+
+    assert progress.accounts_done == 2
+    assert progress.stored == 50
+    assert _count(session_factory) == 50
+    assert checkpoints.get('acc_a') == ('acc_a_001', 25, True)
+
+
+def test_backfill_resumes_from_the_checkpoint(tmp_path, session_factory):
+    checkpoints = backfill.Checkpoints(str(tmp_path / 'cp.sqlite'))
+    client = PagingClient(['acc_a'], fail_after=2)
+    job = backfill.Backfill(client, checkpoints, session_factory,
+                            page_size=10, batch_size=10, retries=0)
+    assert job.run(['token']).accounts_failed == 1
+    from_id, stored, done = checkpoints.get('acc_a')
+    assert (from_id, stored, done) == ('acc_a_016', 10, False)
+
+    client.fail_after, client.pages = None, 0
+    job = backfill.Backfill(client, checkpoints, session_factory,
+                            page_size=10, batch_size=10)
+    assert job.run(['token']).stored == 15
+    assert client.pages == 2  # continued from from_id, not from the start
+    assert _count(session_factory) == 25
+
+    # Finished accounts are not fetched again.
+    client.pages = 0
+    job.run(['token'])
+    assert client.pages == 0
+
+
+def test_bulk_insert_skips_stored_transactions(session_factory):
+    with session_factory() as s:
+        db.upsert_account(s, {'id': 'acc_1'})
+        txn = {'id': 'txn_1', 'date': '2025-01-02', 'amount': '-3.50',
+               'description': 'Coffee', 'status': 'posted'}
+        assert len(db.bulk_insert_transactions(s, 'acc_1', [txn])) == 1
+        assert db.bulk_insert_transactions(s, 'acc_1', [txn, txn]) == []
+        s.commit()
+        assert s.get(db.Transaction, 'txn_1').payload() == txn
@@ -0,0 +1,128 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import db
+from balance_cache import LatestBalanceCache, SQLiteInvalidationBackend
+
+
+@pytest.fixture(autouse=True)
+def empty_balance_cache():
+    db.balance_cache.clear()
+    yield
+    db.balance_cache.clear()
+
+
+def _value(amount, day, tenant_id=None):
+    return {"available": amount, "ledger": amount,
+            "as_of": datetime(2025, 1, day), "tenant_id": tenant_id}
+
+
+def test_cache_is_bounded_and_keeps_the_newest_balance():
+    cache = LatestBalanceCache(max_entries=2)
+    cache.put("acc_1", _value("1.00", 2))
+    cache.put("acc_1", _value("0.50", 1))
+    assert cache.get("acc_1")["available"] == "1.00"
+
+    cache.put("acc_2", _value("2.00", 1))
+    cache.get("acc_1")
+    cache.put("acc_3", _value("3.00", 1))
+    assert cache.get("acc_2") is None
+    assert cache.get("acc_1") is not None
+
+
+def test_cache_hides_other_tenants_balances():
+    cache = LatestBalanceCache()
+    cache.put("acc_1", _value("1.00", 1, tenant_id="t1"))
+    assert cache.get("acc_1", "t1") is not None
+    assert cache.get("acc_1", "t2") is None
+
+
+def test_writes_in_one_process_invalidate_the_others(tmp_path):
+    path = str(tmp_path / "invalidations.sqlite")
+    writer = LatestBalanceCache(backend=SQLiteInvalidationBackend(path),
+                                poll_interval=0)
+    reader = LatestBalanceCache(backend=SQLiteInvalidationBackend(path),
+                                poll_interval=0)
+    reader.get("acc_1")  # start following the log
+    reader.put("acc_1", _value("1.00", 1))
+
+    writer.written("acc_1", _value("2.00", 2))
+    assert writer.get("acc_1")["available"] == "2.00"
+    assert reader.get("acc_1") is None
+
+
+def test_committed_snapshot_is_written_through(session):
+    db.upsert_account(session, {"id": "acc_1"})
+    db.add_balance_snapshot(session, "acc_1",
+                            {"available": "5.00", "ledger": "6.00"},
+                            as_of=datetime(2025, 1, 1))
+    assert db.balance_cache.get("acc_1") is None
+    session.commit()
+    assert db.balance_cache.get("acc_1")["ledger"] == "6.00"
+
+    db.add_balance_snapshot(session, "acc_1",
+                            {"available": "7.00", "ledger": "7.00"},
+                            as_of=datetime(2025, 1, 2))
+    session.rollback()
+    assert db.balance_cache.get("acc_1")["ledger"] == "6.00"
+
+
+def test_latest_balance_is_one_primary_key_read(session):
+    db.upsert_account(session, {"id": "acc_1"}, tenant_id="t1")
+    for day in (1, 3, 2):
+        db.add_balance_snapshot(session, "acc_1",
+                                {"available": f"{day}.00",
+                                 "ledger": f"{day}.00"},
+                                as_of=datetime(2025, 1, day), tenant_id="t1")
+    session.commit()
+    db.balance_cache.clear()
+    session.expire_all()
+
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute",
+                 lambda *args: statements.append(args[2]))
+    assert db.latest_balance(session, "acc_1", "t1")["available"] == "3.00"
+    assert db.latest_balance(session, "acc_1", "t1")["available"] == "3.00"
+    assert len(statements) == 1
+    assert "latest_balances" in statements[0]
+    assert db.latest_balance(session, "acc_1", "t2") is None
+
+
+def test_older_snapshot_from_another_writer_keeps_the_newest(Session):
+    with Session() as s:
+        db.upsert_account(s, {"id": "acc_1"})
+        s.commit()
+    for day in (1, 3, 2):
+        with Session() as s:
+            db.add_balance_snapshot(s, "acc_1",
+                                    {"available": f"{day}.00",
+                                     "ledger": f"{day}.00"},
+                                    as_of=datetime(2025, 1, day))
+            s.commit()
+
+    with Session() as s:
+        assert s.query(db.LatestBalance).count() == 1
+        assert str(s.get(db.LatestBalance, "acc_1").available) == "3.00"
+    assert db.balance_cache.get("acc_1")["available"] == "3.00"
+
+
+def test_replica_reads_are_not_cached(db_engine, monkeypatch):
+    replica = create_engine("sqlite://", future=True)
+    db.Base.metadata.create_all(replica)
+    monkeypatch.setattr(db, "read_engine", replica)
+    monkeypatch.setattr(db, "ReadSessionLocal",
+                        sessionmaker(bind=replica, future=True))
+    with db.ReadSessionLocal() as s:
+        s.add(db.LatestBalance(account_id="acc_1", available=1, ledger=1,
+                               as_of=datetime(2025, 1, 1)))
+        s.commit()
+
+    with db.read_session("client-a") as s:
+        assert db.latest_balance(s, "acc_1")["available"] == "1.00"
+    assert db.balance_cache.get("acc_1") is None
+
+    with db.read_session("client-a", require_primary=True) as s:
+        assert db.latest_balance(s, "acc_1") is None
@@ -0,0 +1,147 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import db
+
+
+def _txn(txn_id, day="2025-01-01", amount="-5.00"):
+    return {"id": txn_id, "date": day, "description": "Coffee",
+            "amount": amount}
+
+
+def test_transactions_etag_changes_only_when_rows_are_added(session):
+    db.upsert_account(session, {"id": "acc_1", "name": "Checking"})
+    db.upsert_transactions(session, "acc_1", [_txn("txn_1")])
+    session.commit()
+    before = db.transactions_etag(session, "acc_1")
+
+    db.upsert_transactions(session, "acc_1", [_txn("txn_1")])
+    session.commit()
+    assert db.transactions_etag(session, "acc_1") == before
+
+    db.upsert_transactions(session, "acc_1", [_txn("txn_2")])
+    session.commit()
+    assert db.transactions_etag(session, "acc_1") != before
+
+
+def test_read_session_pins_recent_writers_to_primary(db_engine, monkeypatch):
+    replica = create_engine("sqlite://", future=True)
+    monkeypatch.setattr(db, "read_engine", replica)
+    monkeypatch.setattr(db, "ReadSessionLocal",
+                        sessionmaker(bind=replica, future=True))
+
+    with db.read_session("client-a") as s:
+        assert s.get_bind() is replica
+
+    db.mark_write("client-a")
+
+    with db.read_session("client-a") as s:
+        assert s.get_bind() is db.engine
+    with db.read_session("client-b") as s:
+        assert s.get_bind() is replica
+    with db.read_session("client-b", require_primary=True) as s:
+        assert s.get_bind() is db.engine
+
+    monkeypatch.setattr(db, "READ_AFTER_WRITE_SECONDS", 0)
+    with db.read_session("client-a") as s:
+        assert s.get_bind() is replica
+
+
+def _count_statements(session):
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute",
+                 lambda *args: statements.append(args[2]))
+    return statements
+
+
+def test_unchanged_account_is_not_read_or_written_again(session):
+    acct = {"id": "acc_1", "name": "Checking", "last_four": "1234",
+            "institution": {"id": "bank"}}
+    assert db.upsert_account(session, acct, tenant_id="t1") is not None
+    session.commit()
+
+    statements = _count_statements(session)
+    assert db.upsert_account(session, dict(acct), tenant_id="t1") is None
+    session.commit()
+    assert statements == []
+
+    db.upsert_account(session, dict(acct, name="Joint"), tenant_id="t1")
+    session.commit()
+    assert [s.split()[0] for s in statements] == ["SELECT", "UPDATE"]
+    assert session.get(db.Account, "acc_1").name == "Joint"
+
+
+def test_rolled_back_account_is_not_remembered(session):
+    db.upsert_account(session, {"id": "acc_1"})
+    session.rollback()
+    assert db.upsert_account(session, {"id": "acc_1"}) is not None
+    session.commit()
+    assert session.get(db.Account, "acc_1") is not None
+
+
+def test_upsert_accounts_skips_known_and_fetches_rest_in_one_query(session):
+    db.upsert_accounts(session, [{"id": "acc_1"}, {"id": "acc_2"}])
+    session.commit()
+
+    statements = _count_statements(session)
+    stored = db.upsert_accounts(session, [
+        {"id": "acc_1"}, {"id": "acc_2", "name": "Savings"},
+        {"id": "acc_3"}])
+    assert sorted(a.id for a in stored) == ["acc_2", "acc_3"]
+    session.commit()
+    assert sorted(s.split()[0] for s in statements) == [
+        "INSERT", "SELECT", "UPDATE"]
+    assert session.query(db.Account).count() == 3
+
+
+def test_dashboard_returns_balances_and_newest_transactions_in_two_queries(
+        session):
+    for acct_id, tenant in (("acc_1", "t1"), ("acc_2", "t1"), ("acc_3", "t2")):
+        db.upsert_account(session, {"id": acct_id, "name": acct_id},
+                          tenant_id=tenant)
+        db.upsert_transactions(
+            session, acct_id,
+            [_txn(f"{acct_id}_txn_{day}", day=f"2025-01-0{day}")
+             for day in range(1, 5)],
+            tenant_id=tenant)
+    db.add_balance_snapshot(session, "acc_1",
+                            {"available": "1.00", "ledger": "2.00"},
+                            tenant_id="t1")
+    session.commit()
+
+    statements = _count_statements(session)
+    accounts = db.dashboard(session, "t1", tx_limit=2)
+    assert len(statements) == 2
+    assert [a["id"] for a in accounts] == ["acc_1", "acc_2"]
+    assert accounts[0]["balance"]["ledger"] == "2.00"
+    assert accounts[1]["balance"] is None
+    assert [t["id"] for t in accounts[0]["transactions"]] == [
+        "acc_1_txn_4", "acc_1_txn_3"]
+    assert accounts[1]["transactions"][0]["date"] == "2025-01-04"
+
+
+def test_rows_stored_before_tenants_are_only_visible_to_their_owner(
+        session):
+    db.upsert_account(session, {"id": "acc_old", "name": "Legacy"})
+    db.upsert_transactions(session, "acc_old", [_txn("txn_old")])
+    db.add_balance_snapshot(session, "acc_old",
+                            {"available": "1.00", "ledger": "1.00"})
+    db.upsert_account(session, {"id": "acc_2", "name": "Other"},
+                      tenant_id="t2")
+    session.commit()
+
+    assert db.stored_accounts(session, "t1")[0] == []
+    assert db.stored_transactions(session, "acc_old", "t1") == []
+    assert db.dashboard(session, "t1") == []
+    assert db.latest_balance(session, "acc_old", "t1") is None
+
+    owned = {"acc_old"}
+    accounts, _ = db.stored_accounts(session, "t1", owned)
+    assert [a["id"] for a in accounts] == ["acc_old"]
+    assert [t["id"] for t in db.stored_transactions(
+        session, "acc_old", "t1", account_ids=owned)] == ["txn_old"]
+    assert [(a["id"], len(a["transactions"]))
+            for a in db.dashboard(session, "t1", account_ids=owned)] == [
+        ("acc_old", 1)]
+    assert db.latest_balance(session, "acc_old", "t1",
+                             owned)["ledger"] == "1.00"
@@ -0,0 +1,144 @@
+import json
+
+import falcon
+import falcon.testing
+import pytest
+
+import db
+import events
+import offline
+import shared_state
+import teller
+from auth_cache import AuthCache
+from shards import tenant_for_token
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = events.EventBroker(max_subscribers=2, queue_size=2)
+    monkeypatch.setattr(events, "broker", broker)
+    return broker
+
+
+def test_subscriber_limit_is_enforced(broker):
+    broker.subscribe("t1")
+    broker.subscribe("t1")
+
+    with pytest.raises(events.TooManySubscribers):
+        broker.subscribe("t2")
+
+
+def test_lagging_subscriber_is_dropped(broker):
+    sub = broker.subscribe("t1")
+    for i in range(3):
+        broker.publish({"type": "balance", "account_id": "acc_1", "n": i},
+                       tenant_id="t1")
+
+    assert sub.lagged
+    assert len(broker) == 0
+
+
+def test_events_are_published_on_commit_only(broker, session_factory):
+    sub = broker.subscribe("t1", ["acc_1"])
+    with session_factory() as s:
+        db.add_balance_snapshot(s, "acc_1", {"available": "5", "ledger": "6"},
+                                tenant_id="t1")
+        s.rollback()
+        assert sub.get(timeout=0) is None
+
+        db.add_balance_snapshot(s, "acc_1", {"available": "7", "ledger": "8"},
+                                tenant_id="t1")
+        db.upsert_transactions(s, "acc_2", [
+            {"id": "txn_1", "date": "2025-01-01", "amount": "1"}],
+            tenant_id="t1")
+        s.commit()
+
+    _, evt = sub.get(timeout=0)
+    assert evt["type"] == "balance"
+    assert evt["available"] == "7"
+    assert sub.get(timeout=0) is None
+
+
+def test_stream_emits_sse_frames(broker):
+    sub = broker.subscribe("t1")
+    frames = events.stream(sub, heartbeat=0)
+    assert next(frames).startswith(b"retry:")
+
+    broker.publish({"type": "balance", "account_id": "acc_1"}, tenant_id="t1")
+    frame = next(frames).decode()
+    frames.close()
+
+    assert frame.startswith("id: 1\nevent: balance\n")
+    assert json.loads(frame.split("data: ")[1]) == {
+        "type": "balance", "account_id": "acc_1"}
+    assert len(broker) == 0
+
+
+class AccountsClient:
+    """Teller stand-in where every token owns the account ``acc_<token>``."""
+
+    def __init__(self, token=None):
+        self.token = token
+
+    def for_user(self, token):
+        return AccountsClient(token)
+
+    def list_accounts(self):
+        return _Response([{"id": f"acc_{self.token}"}])
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, body):
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+def _stream_resource(broker):
+    accounts = teller.AccountsResource(
+        AccountsClient(), users=AuthCache(), state=shared_state.MemoryState(),
+        offline_policy=offline.OfflinePolicy(mode="off"))
+    return teller.StreamResource(broker, accounts)
+
+
+def _open_stream(resource, token, query=""):
+    req = falcon.testing.create_req(
+        path="/api/stream/accounts", query_string=query,
+        headers={"Authorization": token} if token else None)
+    resp = falcon.Response()
+    resource.on_get_accounts(req, resp)
+    return resp.stream
+
+
+def test_stream_only_carries_the_callers_changes(broker):
+    resource = _stream_resource(broker)
+    frames = _open_stream(resource, "a", "account_id=acc_a&account_id=acc_b")
+    assert next(frames).startswith(b"retry:")
+    sub, = broker._subscribers
+    assert sub.account_ids == {"acc_a"}
+
+    # Tenant B's changes, even to an account id A asked for, stay with B.
+    broker.publish({"type": "balance", "account_id": "acc_b"},
+                   tenant_id=tenant_for_token("b"))
+    broker.publish({"type": "balance", "account_id": "acc_a"},
+                   tenant_id=tenant_for_token("b"))
+    broker.publish({"type": "balance", "account_id": "acc_a", "n": 1},
+                   tenant_id=tenant_for_token("a"))
+
+    frame = next(frames).decode()
+    frames.close()
+    assert json.loads(frame.split("data: ")[1]) == {
+        "type": "balance", "account_id": "acc_a", "n": 1}
+    assert sub.get(timeout=0) is None
+
+
+def test_stream_requires_credentials_and_own_accounts(broker):
+    resource = _stream_resource(broker)
+    with pytest.raises(falcon.HTTPUnauthorized):
+        _open_stream(resource, None)
+    with pytest.raises(falcon.HTTPNotFound):
+        _open_stream(resource, "a", "account_id=acc_b")
+    assert len(broker) == 0
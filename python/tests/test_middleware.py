@@ -0,0 +1,213 @@
+import gzip
+import threading
+import time
+
+import falcon
+import pytest
+from falcon import testing
+
+import offline
+import shared_state
+import teller
+from middleware import (AdaptiveLimit, CompressionMiddleware, ETagMiddleware,
+                        LoadSheddingMiddleware, _upstream_queue_seconds)
+
+
+class BigResource:
+    def on_get(self, req, resp):
+        resp.media = [{"id": f"txn_{i}", "amount": "1.00"} for i in range(200)]
+
+
+class SmallResource:
+    def on_get(self, req, resp):
+        resp.media = {"status": "ok"}
+
+
+def make_client():
+    app = falcon.App(middleware=[CompressionMiddleware(min_size=512),
+                                 ETagMiddleware()])
+    app.add_route('/big', BigResource())
+    app.add_route('/small', SmallResource())
+    return testing.TestClient(app)
+
+
+def test_large_body_is_gzipped_when_accepted():
+    result = make_client().simulate_get(
+        '/big', headers={'Accept-Encoding': 'gzip'})
+
+    assert result.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in result.headers['Vary']
+    assert gzip.decompress(result.content).startswith(b'[{"id": "txn_0"')
+
+
+def test_small_body_is_not_compressed():
+    result = make_client().simulate_get(
+        '/small', headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in result.headers
+    assert result.json == {"status": "ok"}
+
+
+def test_no_compression_without_accept_encoding():
+    result = make_client().simulate_get('/big')
+
+    assert 'Content-Encoding' not in result.headers
+    assert len(result.json) == 200
+
+
+def test_if_none_match_returns_304():
+    client = make_client()
+    first = client.simulate_get('/big', headers={'Accept-Encoding': 'gzip'})
+    etag = first.headers['ETag']
+
+    second = client.simulate_get('/big', headers={'Accept-Encoding': 'gzip',
+                                                  'If-None-Match': etag})
+
+    assert etag.endswith('-gzip"')
+    assert second.status_code == 304
+    assert second.headers['ETag'] == etag
+    assert second.content == b''
+
+
+class SlowResource:
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def on_get(self, req, resp):
+        self.entered.set()
+        self.release.wait(5)
+        resp.media = {"status": "ok"}
+
+
+def test_load_shedding_returns_503_over_limit_but_not_for_health():
+    slow = SlowResource()
+    shedder = LoadSheddingMiddleware(proxy_limit=1, max_queue=0.05,
+                                     retry_after=3)
+    app = falcon.App(middleware=[shedder])
+    app.add_route('/api/accounts', slow)
+    app.add_route('/health', SmallResource())
+    client = testing.TestClient(app)
+
+    first = threading.Thread(target=client.simulate_get,
+                             args=('/api/accounts',))
+    first.start()
+    assert slow.entered.wait(5)
+
+    shed = client.simulate_get('/api/accounts')
+    assert shed.status_code == 503
+    assert shed.headers['Retry-After'] == '3'
+    assert client.simulate_get('/health').status_code == 200
+    assert shedder.stats()['proxy']['shed'] == 1
+
+    slow.release.set()
+    first.join(5)
+    assert shedder.stats()['proxy']['in_flight'] == 0
+    assert client.simulate_get('/api/accounts').status_code == 200
+
+
+def test_upstream_queue_time_counts_against_the_budget():
+    now = time.time()
+    assert _upstream_queue_seconds(f"t={now - 1:.3f}", now) == \
+        pytest.approx(1, abs=0.01)
+    assert _upstream_queue_seconds(f"t={int((now - 2) * 1e6)}", now) == \
+        pytest.approx(2, abs=0.01)
+    assert _upstream_queue_seconds("garbage") == 0.0
+
+
+def test_routes_are_classified():
+    shedder = LoadSheddingMiddleware(proxy_limit=4)
+    classes = {}
+    for method, path in (('GET', '/health'),
+                         ('GET', '/api/stream/accounts'),
+                         ('GET', '/api/accounts/acc_1/balances'),
+                         ('GET', '/api/db/dashboard'),
+                         ('POST', '/api/accounts/acc_1/payments/zelle')):
+        req = testing.create_req(method=method, path=path)
+        classes[path] = shedder.classify(req)
+    assert classes == {'/health': None, '/api/stream/accounts': None,
+                       '/api/accounts/acc_1/balances': 'proxy',
+                       '/api/db/dashboard': 'db-read',
+                       '/api/accounts/acc_1/payments/zelle': 'write'}
+
+
+def test_default_proxy_limit_starts_within_its_bounds(monkeypatch):
+    monkeypatch.setenv('SHED_PROXY_LIMIT', '6')
+    monkeypatch.setenv('SHED_PROXY_MIN_LIMIT', '4')
+    assert LoadSheddingMiddleware().stats()['proxy']['limit'] == 4
+    monkeypatch.setenv('SHED_PROXY_LIMIT', '2')
+    assert LoadSheddingMiddleware().stats()['proxy']['limit'] == 2
+    monkeypatch.setenv('SHED_PROXY_LIMIT', '32')
+    assert LoadSheddingMiddleware().stats()['proxy']['limit'] == 16
+
+
+def test_explicit_limits_are_kept():
+    stats = LoadSheddingMiddleware(proxy_limit=0, write_limit=0).stats()
+    assert stats['proxy']['limit'] == 0
+    assert stats['write']['limit'] == 0
+
+
+def test_adaptive_limit_follows_latency():
+    limit = AdaptiveLimit(initial=10, min_limit=2, max_limit=20)
+    for _ in range(50):
+        limit.record(0.1)
+    grown = limit.limit
+    assert grown > 10
+
+    for _ in range(200):
+        limit.record(1.0)
+    assert limit.limit < grown
+
+    for _ in range(20):
+        limit.record(0.1, ok=False)
+    assert limit.limit >= 2
+
+
+class RecordingLimit(AdaptiveLimit):
+    def __init__(self):
+        super().__init__(initial=4)
+        self.samples = []
+
+    def record(self, latency, ok=True):
+        self.samples.append((latency, ok))
+        super().record(latency, ok)
+
+
+class AccountsClient:
+    status_code = 200
+    text = '[{"id": "acc_1"}]'
+    content = text.encode()
+
+    def json(self):
+        return [{'id': 'acc_1'}]
+
+    def for_user(self, token):
+        return self
+
+    def list_accounts(self):
+        time.sleep(0.01)
+        return self
+
+
+def test_only_teller_calls_adapt_the_proxy_limit(monkeypatch):
+    monkeypatch.setattr(teller.AccountsResource, '_store_accounts',
+                        lambda *args: None)
+    limit = RecordingLimit()
+    app = falcon.App(middleware=[LoadSheddingMiddleware(proxy_limit=limit)])
+    app.add_route('/api/accounts', teller.AccountsResource(
+        AccountsClient(), state=shared_state.MemoryState(), cache_ttl=5,
+        offline_policy=offline.OfflinePolicy(mode='off')))
+    app.add_route('/api/local', SmallResource())
+    client = testing.TestClient(app)
+    headers = {'Authorization': 'token'}
+
+    assert client.simulate_get('/api/accounts', headers=headers).json == \
+        [{'id': 'acc_1'}]
+    assert len(limit.samples) == 1
+    assert limit.samples[0][0] >= 0.01
+
+    # A cached answer and a route that never calls Teller add no samples.
+    assert client.simulate_get('/api/accounts', headers=headers).json == \
+        [{'id': 'acc_1'}]
+    assert client.simulate_get('/api/local').status_code == 200
+    assert len(limit.samples) == 1
@@ -0,0 +1,104 @@
+import os
+import uuid
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+
+import db
+import migrations
+from partitions import ensure_months
+
+# A Postgres server on which a scratch database may be created, e.g.
+# postgresql+psycopg2://postgres@localhost/postgres
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+def _stamp(engine, revision):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE alembic_version "
+                          "(version_num VARCHAR(32) NOT NULL PRIMARY KEY)"))
+        conn.execute(text("INSERT INTO alembic_version VALUES (:rev)"),
+                     {'rev': revision})
+
+
+def test_expected_head_is_a_migration_script():
+    head = migrations.expected_head()
+    versions = migrations.ALEMBIC_INI.parent / 'alembic' / 'versions'
+    assert list(versions.glob(f"{head}_*.py"))
+
+
+def test_schema_at_head_skips_create_all():
+    engine = create_engine("sqlite://", future=True)
+    _stamp(engine, migrations.expected_head())
+
+    assert migrations.ensure_schema(engine, db.Base.metadata) is False
+    assert 'transactions' not in inspect(engine).get_table_names()
+
+
+def test_outdated_or_unversioned_schema_creates_tables():
+    engine = create_engine("sqlite://", future=True)
+    assert migrations.stored_revision(engine) is None
+    assert migrations.ensure_schema(engine, db.Base.metadata) is True
+    assert 'transactions' in inspect(engine).get_table_names()
+
+    old = create_engine("sqlite://", future=True)
+    _stamp(old, 'e3cac1307792')
+    assert migrations.ensure_schema(old, db.Base.metadata) is True
+
+
+@pytest.fixture
+def postgres_url():
+    if not POSTGRES_URL:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    admin = create_engine(POSTGRES_URL, isolation_level="AUTOCOMMIT",
+                          future=True)
+    name = f"test_migrations_{uuid.uuid4().hex[:8]}"
+    with admin.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{name}"'))
+    yield make_url(POSTGRES_URL).set(database=name).render_as_string(
+        hide_password=False)
+    with admin.connect() as conn:
+        conn.execute(text(f'DROP DATABASE "{name}" WITH (FORCE)'))
+    admin.dispose()
+
+
+def _insert_txn(engine, txn_id, day):
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO transactions (id, account_id, date) "
+                          "VALUES (:id, 'acc_1', :day)"),
+                     {"id": txn_id, "day": day})
+
+
+def test_partitioned_transactions_keep_ids_unique(postgres_url):
+    from alembic import command
+
+    config = migrations._config()
+    config.set_main_option("sqlalchemy.url", postgres_url.replace("%", "%%"))
+    command.upgrade(config, "head")
+    engine = create_engine(postgres_url, future=True)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO accounts (id) VALUES ('acc_1')"))
+    _insert_txn(engine, "txn_1", date.today())
+    # Older than every partition, so it lands in the DEFAULT partition.
+    _insert_txn(engine, "txn_old", date(2001, 1, 15))
+
+    # Same transaction, date changed since the last sync.
+    with pytest.raises(IntegrityError):
+        _insert_txn(engine, "txn_1", date(2001, 2, 1))
+
+    with engine.begin() as conn:
+        assert ensure_months(conn, "transactions", [date(2001, 1, 15)]) == [
+            "transactions_p2001_01"]
+    with engine.connect() as conn:
+        assert conn.execute(text(
+            "SELECT tableoid::regclass::text FROM transactions "
+            "WHERE id = 'txn_old'")).scalar() == "transactions_p2001_01"
+
+    command.downgrade(config, "4b7d2e91c0a5")
+    with engine.connect() as conn:
+        assert conn.execute(text(
+            "SELECT count(*) FROM transactions")).scalar() == 2
+    engine.dispose()
@@ -0,0 +1,133 @@
+import time
+
+import falcon
+import falcon.testing
+import pytest
+import requests
+
+import db
+import offline
+import teller
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body
+        self.content = b'x' if body is not None else b''
+        self.text = ''
+
+    def json(self):
+        return self._body
+
+
+class FlakyClient:
+    """Teller stand-in that can be switched off."""
+
+    def __init__(self):
+        self.down = False
+        self.calls = []
+
+    def for_user(self, token):
+        return self
+
+    def _answer(self, name, body):
+        self.calls.append(name)
+        if self.down:
+            raise requests.exceptions.ConnectionError("connection refused")
+        return FakeResponse(200, body)
+
+    def list_accounts(self):
+        return self._answer('list_accounts',
+                            [{'id': 'acc_off', 'name': 'Checking'}])
+
+    def get_account(self, account_id):
+        return self._answer('get_account',
+                            {'id': account_id, 'name': 'Checking'})
+
+    def get_account_balances(self, account_id):
+        return self._answer('balances', {'account_id': account_id,
+                                         'available': '7.00',
+                                         'ledger': '8.00'})
+
+    def list_account_transactions(self, account_id, count=None):
+        return self._answer('transactions', [
+            {'id': 'txn_off_1', 'date': '2025-01-01', 'amount': '-1.00',
+             'description': 'Tea'}])
+
+
+@pytest.fixture
+def app(db_engine):
+    client = FlakyClient()
+    policy = offline.OfflinePolicy(cooldown=60, refresh_interval=0)
+    resource = teller.AccountsResource(client, offline_policy=policy)
+    falcon_app = falcon.App()
+    falcon_app.add_route('/api/accounts', resource)
+    falcon_app.add_route('/api/accounts/{account_id}/balances', resource,
+                         suffix='balances')
+    falcon_app.add_route('/api/accounts/{account_id}/transactions', resource,
+                         suffix='transactions')
+    return falcon.testing.TestClient(falcon_app), client, policy
+
+
+def _wait_for(predicate):
+    deadline = time.monotonic() + 5
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_stored_data_is_served_while_teller_is_down(app):
+    http, client, policy = app
+    headers = {'Authorization': 'token-off'}
+    for path in ('/api/accounts', '/api/accounts/acc_off/balances',
+                 '/api/accounts/acc_off/transactions'):
+        result = http.simulate_get(path, headers=headers)
+        assert result.status_code == 200
+        assert result.headers['X-Data-Source'] == 'teller'
+
+    client.down = True
+    result = http.simulate_get('/api/accounts/acc_off/balances',
+                               headers=headers)
+    assert result.status_code == 200
+    assert result.json == {'account_id': 'acc_off', 'available': '7.00',
+                           'ledger': '8.00'}
+    assert result.headers['X-Data-Source'] == 'database'
+    assert result.headers['X-Data-Reason'] == offline.TELLER_UNAVAILABLE
+    assert 'X-Data-As-Of' in result.headers
+    assert policy.teller_down
+
+    # During the cooldown Teller is not on the request path at all.
+    _wait_for(lambda: not policy._refreshing)
+    calls = len(client.calls)
+    result = http.simulate_get('/api/accounts/acc_off/transactions',
+                               headers=headers)
+    assert [t['id'] for t in result.json] == ['txn_off_1']
+    assert result.headers['X-Data-Source'] == 'database'
+    accounts = http.simulate_get('/api/accounts', headers=headers)
+    assert [a['id'] for a in accounts.json] == ['acc_off']
+    assert _wait_for(lambda: len(client.calls) > calls)  # refreshes only
+
+
+def test_header_requests_stored_data_and_refreshes_in_background(app):
+    http, client, policy = app
+    headers = {'Authorization': 'token-off'}
+    http.simulate_get('/api/accounts/acc_off/balances', headers=headers)
+    client.calls.clear()
+
+    result = http.simulate_get('/api/accounts/acc_off/balances',
+                               headers=dict(headers,
+                                            **{'X-Data-Source': 'database'}))
+    assert result.headers['X-Data-Source'] == 'database'
+    assert result.headers['X-Data-Reason'] == offline.REQUESTED
+    assert _wait_for(lambda: 'balances' in client.calls)
+    assert not policy.teller_down
+
+
+def test_nothing_stored_relays_the_teller_failure(app):
+    http, client, policy = app
+    client.down = True
+    result = http.simulate_get('/api/accounts/acc_off/balances',
+                               headers={'Authorization': 'token-new'})
+    assert result.status_code == 500
+    assert policy.teller_down
@@ -0,0 +1,43 @@
+from datetime import date
+
+import db
+import partitions
+from partitions import (add_months, create_partition_sql, parse_partition_name,
+                        partition_name)
+
+
+def test_add_months_wraps_years():
+    assert add_months(date(2025, 11, 1), 3) == date(2026, 2, 1)
+    assert add_months(date(2025, 1, 1), -1) == date(2024, 12, 1)
+
+
+def test_partition_names_round_trip():
+    name = partition_name("balance_snapshots", date(2025, 3, 1))
+
+    assert name == "balance_snapshots_p2025_03"
+    assert parse_partition_name(name) == ("balance_snapshots", date(2025, 3, 1))
+    assert parse_partition_name("transactions_default") is None
+
+
+def test_create_partition_sql_covers_one_month():
+    sql = create_partition_sql("transactions", date(2025, 12, 1))
+
+    assert 'PARTITION OF "transactions"' in sql
+    assert "FROM ('2025-12-01') TO ('2026-01-01')" in sql
+
+
+def test_ids_of_detached_partitions_are_not_stored_again(session):
+    # What detaching a partition leaves behind on Postgres: the id is still
+    # guarded but the row is gone from the transactions table.
+    partitions.transaction_ids.create(session.connection())
+    session.execute(partitions.transaction_ids.insert(), [{"id": "txn_old"}])
+    txns = [{"id": "txn_old", "date": "2022-01-05", "amount": "-5.00"},
+            {"id": "txn_new", "date": "2025-06-01", "amount": "-5.00"}]
+
+    db.upsert_transactions(session, "acc_1", txns)
+    db.bulk_insert_transactions(session, "acc_1",
+                                txns + [{"id": "txn_bulk",
+                                         "date": "2025-06-02"}])
+
+    assert sorted(t.id for t in session.query(db.Transaction)) == [
+        "txn_bulk", "txn_new"]
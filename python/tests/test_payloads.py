@@ -0,0 +1,51 @@
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import text
+
+import db
+import payloads
+
+COLUMNS = {"id": "txn_1", "date": date(2025, 1, 2),
+           "description": "Coffee", "amount": Decimal("-5.00")}
+
+
+def test_compact_strips_fields_the_columns_reproduce():
+    txn = {"id": "txn_1", "date": "2025-01-02", "description": "Coffee",
+           "amount": "-5.00", "status": "posted"}
+    stored = payloads.compact(txn, COLUMNS)
+    assert stored == {"status": "posted"}
+    assert payloads.expand(stored, COLUMNS) == txn
+
+
+def test_compact_keeps_fields_that_differ_or_are_missing():
+    txn = {"id": "txn_1", "amount": "-5", "status": "posted"}
+    stored = payloads.compact(txn, COLUMNS)
+    assert stored["amount"] == "-5"
+    assert sorted(stored[payloads.ABSENT]) == ["date", "description"]
+    assert payloads.expand(stored, COLUMNS) == txn
+
+
+def test_decode_accepts_compressed_and_plain_json():
+    payload = {"a": [1, 2]}
+    assert payloads.decode(payloads.encode(payload)) == payload
+    assert payloads.decode('{"a": [1, 2]}') == payload
+
+
+def test_models_store_compressed_payloads_and_rebuild_them(session):
+    txn = {"id": "txn_1", "account_id": "acc_1", "date": "2025-01-02",
+           "description": "Coffee", "amount": "-5.00",
+           "details": {"category": "dining"}}
+    balance = {"account_id": "acc_1", "available": "10.00",
+               "ledger": "12.50", "links": {"self": "/balances"}}
+    db.upsert_account(session, {"id": "acc_1"})
+    db.upsert_transactions(session, "acc_1", [txn])
+    db.add_balance_snapshot(session, "acc_1", balance)
+    session.commit()
+    session.expire_all()
+
+    stored = session.execute(text("SELECT raw FROM transactions")).scalar()
+    assert isinstance(stored, bytes)
+    assert payloads.decode(stored) == {"details": {"category": "dining"}}
+    assert session.get(db.Transaction, "txn_1").payload() == txn
+    assert session.query(db.BalanceSnapshot).one().payload() == balance
@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta
+
+import falcon
+import falcon.testing
+import pytest
+import requests
+
+import db
+import payments
+import teller
+from shards import StaticShardMap
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body
+        self.content = b'x' if body is not None else b''
+
+    def json(self):
+        return self._body
+
+
+class FakeClient:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def for_user(self, token):
+        return self
+
+    def list_accounts(self):
+        return FakeResponse(200, [{'id': 'acc_1'}])
+
+    def create_account_payment(self, account_id, scheme, data, **kwargs):
+        self.calls.append((account_id, scheme, data, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    create_account_payee = create_account_payment
+
+
+class HTMLResponse(FakeResponse):
+    def json(self):
+        raise ValueError("Expecting value: line 1 column 1 (char 0)")
+
+
+def _queue(client, session_factory):
+    return payments.PaymentQueue(client, session_factory, retry_delay=0)
+
+
+def _submit(queue, key='key-1', body=None):
+    return queue.submit('token', 't1', key, 'payment', 'acc_1', 'zelle',
+                        body or {'amount': '10.00', 'payee_id': 'p_1'})
+
+
+def test_repeated_submission_sends_once(session_factory):
+    client = FakeClient(FakeResponse(200, {'id': 'pay_1'}))
+    queue = _queue(client, session_factory)
+
+    first, created = _submit(queue)
+    assert created and first['status'] == payments.QUEUED
+    queue.process(first['id'])
+
+    again, created = _submit(queue)
+    assert not created
+    assert again['id'] == first['id']
+    assert again['status'] == payments.SUCCEEDED
+    assert again['response'] == {'id': 'pay_1'}
+    queue.process(first['id'])
+    assert len(client.calls) == 1
+    assert client.calls[0][3]['idempotency_key'] == 'key-1'
+
+
+def test_key_reused_for_another_request_is_rejected(session_factory):
+    queue = _queue(FakeClient(), session_factory)
+    _submit(queue)
+    with pytest.raises(payments.IdempotencyConflict):
+        _submit(queue, body={'amount': '99.00', 'payee_id': 'p_1'})
+
+
+def test_only_requests_that_never_reached_teller_are_retried(session_factory):
+    client = FakeClient(FakeResponse(503), requests.exceptions.ConnectTimeout(),
+                        requests.exceptions.ReadTimeout())
+    queue = _queue(client, session_factory)
+    request_id = _submit(queue)[0]['id']
+
+    queue.process(request_id)
+    assert queue.status('t1', request_id)['status'] == payments.QUEUED
+    queue.process(request_id)
+    assert queue.status('t1', request_id)['status'] == payments.QUEUED
+    queue.process(request_id)
+    status = queue.status('t1', request_id)
+    assert status['status'] == payments.UNKNOWN
+    assert status['attempts'] == 3
+
+
+def test_rejected_request_fails_and_status_is_tenant_scoped(session_factory):
+    queue = _queue(FakeClient(FakeResponse(400, {'error': 'bad'})),
+                   session_factory)
+    request_id = _submit(queue)[0]['id']
+    queue.process(request_id)
+    assert queue.status('t1', request_id)['status'] == payments.FAILED
+    assert queue.status('t2', request_id) is None
+
+
+def test_interrupted_sends_become_unknown(session_factory):
+    queue = _queue(FakeClient(), session_factory)
+    request_id = _submit(queue)[0]['id']
+    with session_factory() as s:
+        row = s.get(db.PaymentRequest, request_id)
+        row.status = payments.SENDING
+        row.updated_at = datetime.utcnow() - timedelta(hours=1)
+        s.commit()
+    assert queue.recover() == 1
+    assert queue.status('t1', request_id)['status'] == payments.UNKNOWN
+
+
+def test_unreadable_answer_or_lost_write_after_sending_is_unknown(
+        session_factory):
+    client = FakeClient(HTMLResponse(502, '<html>'),
+                        FakeResponse(200, {'id': 'pay_2'}))
+    queue = _queue(client, session_factory)
+    request_id = _submit(queue)[0]['id']
+    queue.process(request_id)
+    status = queue.status('t1', request_id)
+    assert status['status'] == payments.UNKNOWN
+    assert status['response_status'] == 502
+
+    calls = []
+
+    def flaky_factory(tenant_id=None):
+        calls.append(tenant_id)
+        if len(calls) == 2:
+            raise RuntimeError("database went away")
+        return session_factory(tenant_id)
+
+    queue = _queue(client, flaky_factory)
+    request_id = _submit(queue, key='key-2')[0]['id']
+    calls.clear()
+    queue.process(request_id)
+    assert queue.status('t1', request_id)['status'] == payments.UNKNOWN
+    queue.process(request_id)
+    assert len(client.calls) == 2
+
+
+def test_recovery_visits_every_shard_and_expires_lost_tokens(db_engine,
+                                                             tmp_path):
+    shard_url = f"sqlite:///{tmp_path / 'shard.db'}"
+    db.shard_router.shard_map = StaticShardMap({'t2': shard_url})
+    queue = payments.PaymentQueue(FakeClient(), db.session_for_tenant,
+                                  databases=db.session_factories)
+    old = datetime.utcnow() - timedelta(days=1)
+    for tenant_id, status in (('t1', payments.QUEUED),
+                              ('t2', payments.SENDING)):
+        with db.session_for_tenant(tenant_id) as s:
+            s.add(db.PaymentRequest(
+                id=tenant_id, tenant_id=tenant_id, idempotency_key='k',
+                kind='payment', account_id='acc_1', scheme='zelle', body={},
+                body_hash='x', status=status, attempts=0, updated_at=old))
+            s.commit()
+    held = _submit(queue)[0]['id']
+
+    assert queue.recover_all() == 2
+    assert queue.status('t1', 't1')['status'] == payments.FAILED
+    assert queue.status('t2', 't2')['status'] == payments.UNKNOWN
+    assert queue.status('t1', held)['status'] == payments.QUEUED
+
+
+def test_key_stored_where_it_cannot_be_found_is_a_conflict(session_factory,
+                                                           monkeypatch):
+    queue = _queue(FakeClient(), session_factory)
+    _submit(queue)
+    monkeypatch.setattr(queue, '_find', lambda s, tenant_id, key: None)
+    with pytest.raises(payments.IdempotencyConflict):
+        _submit(queue)
+
+
+def test_post_returns_202_and_requires_idempotency_key(session_factory):
+    queue = _queue(FakeClient(), session_factory)
+    app = falcon.App()
+    app.add_route('/api/accounts/{account_id}/payments/{scheme}',
+                  teller.AccountsResource(FakeClient(), payments=queue),
+                  suffix='payments')
+    client = falcon.testing.TestClient(app)
+    path = '/api/accounts/acc_1/payments/zelle'
+    body = {'amount': '10.00', 'payee_id': 'p_1'}
+
+    result = client.simulate_post(path, json=body,
+                                  headers={'Authorization': 'token'})
+    assert result.status_code == 400
+
+    headers = {'Authorization': 'token', 'Idempotency-Key': 'k'}
+    result = client.simulate_post(path, json=body, headers=headers)
+    assert result.status_code == 202
+    assert result.headers['Location'] == f"/api/payments/{result.json['id']}"
+    assert client.simulate_post(path, json=body, headers=headers).json == \
+        result.json
+
+
+def test_main_stops_the_payment_queue_on_sigterm(db_engine, monkeypatch):
+    class Server:
+        def serve_forever(self):
+            raise SystemExit(0)  # what the SIGTERM handler raises
+
+    stopped = []
+    queue = payments.PaymentQueue(FakeClient(), lambda tenant_id=None: None)
+    monkeypatch.setattr(queue, 'start', lambda: None)
+    monkeypatch.setattr(queue, 'stop', lambda: stopped.append(True))
+    monkeypatch.setattr(payments.PaymentQueue, 'from_env',
+                        classmethod(lambda cls, *args, **kwargs: queue))
+    monkeypatch.setattr(db, 'init_db', lambda: None)
+    monkeypatch.setattr(teller.signal, 'signal', lambda *args: None)
+    monkeypatch.setattr(teller.atexit, 'register', lambda *args: None)
+    monkeypatch.setattr(teller.simple_server, 'make_server',
+                        lambda *args, **kwargs: Server())
+    monkeypatch.setattr('sys.argv', ['teller.py'])
+
+    with pytest.raises(SystemExit):
+        teller.main()
+    assert stopped == [True]
+
+
+def test_duplicate_enqueue_keeps_the_token_for_the_retry(session_factory):
+    queue = None
+
+    class DuplicatingClient(FakeClient):
+        def create_account_payment(self, *args, **kwargs):
+            if not self.calls:
+                # The same request, queued again by a repeated POST, is
+                # picked up while this first attempt is in flight.
+                queue.process(request_id)
+            return super().create_account_payment(*args, **kwargs)
+
+    client = DuplicatingClient(FakeResponse(503), FakeResponse(200, {}))
+    queue = _queue(client, session_factory)
+    request_id = _submit(queue)[0]['id']
+
+    queue.process(request_id)
+    assert queue.status('t1', request_id)['status'] == payments.QUEUED
+    queue.process(request_id)  # the retry
+    assert len(client.calls) == 2
+    assert queue.status('t1', request_id)['status'] == payments.SUCCEEDED
+
+
+@pytest.mark.parametrize('code', [500, 502, 504])
+def test_server_errors_other_than_503_are_unknown(session_factory, code):
+    queue = _queue(FakeClient(FakeResponse(code, {'error': 'gateway'})),
+                   session_factory)
+    request_id = _submit(queue)[0]['id']
+    queue.process(request_id)
+    status = queue.status('t1', request_id)
+    assert status['status'] == payments.UNKNOWN
+    assert status['response_status'] == code
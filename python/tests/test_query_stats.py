@@ -0,0 +1,77 @@
+import logging
+
+import falcon
+import pytest
+from falcon import testing
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+import db
+import query_stats
+from middleware import QueryStatsMiddleware
+
+
+@pytest.fixture(autouse=True)
+def installed():
+    query_stats.install(Engine)
+
+
+def test_normalize_collapses_literals_and_lists():
+    assert query_stats.normalize(
+        "SELECT * FROM t WHERE id IN (?, ?, ?) AND name = 'x'\n AND n > 42"
+    ) == "SELECT * FROM t WHERE id IN (?) AND name = ? AND n > ?"
+    assert query_stats.normalize(
+        "INSERT INTO t (a, b) VALUES (%(a_0)s, %(b_0)s), (%(a_1)s, %(b_1)s)"
+    ) == "INSERT INTO t (a, b) VALUES (?)"
+
+
+class LookupResource:
+    def __init__(self, Session):
+        self._Session = Session
+
+    def on_get(self, req, resp):
+        with self._Session() as s:
+            for n in range(6):
+                s.get(db.Account, f"acc_{n}")
+        resp.media = {}
+
+
+def test_repeated_statements_are_flagged_per_request(Session, caplog):
+    app = falcon.App(middleware=[QueryStatsMiddleware(debug_headers=True,
+                                                      n_plus_one=5)])
+    app.add_route('/lookups', LookupResource(Session))
+
+    with caplog.at_level(logging.WARNING, logger='middleware'):
+        result = testing.TestClient(app).simulate_get('/lookups')
+
+    assert result.headers['X-Query-Count'] == '6'
+    assert result.headers['X-Query-Repeated'] == '6'
+    assert "Possible N+1 query in GET /lookups: 6 x SELECT" in caplog.text
+    assert query_stats.current() is None
+
+
+def test_upsert_transactions_reads_stored_rows_in_one_query(Session):
+    txns = [{"id": f"txn_{n}", "date": "2025-01-01", "amount": "-1.00",
+             "description": f"Shop {n}"} for n in range(20)]
+    with Session() as s:
+        db.upsert_account(s, {"id": "acc_1"})
+        db.upsert_transactions(s, "acc_1", txns[:10])
+        s.commit()
+        stats = query_stats.begin()
+        try:
+            db.upsert_transactions(s, "acc_1", txns)
+            s.commit()
+        finally:
+            query_stats.end()
+    assert stats.repeated(5) == []
+
+
+def test_slow_statements_are_logged_with_their_plan(Session, caplog,
+                                                    monkeypatch):
+    monkeypatch.setattr(query_stats, 'SLOW_QUERY_SECONDS', 1e-9)
+    with caplog.at_level(logging.WARNING, logger='slow_queries'):
+        with Session() as s:
+            s.execute(text("SELECT id FROM accounts WHERE id = :id"),
+                      {"id": "acc_1"})
+    assert "SELECT id FROM accounts WHERE id = ?" in caplog.text
+    assert "plan:" in caplog.text
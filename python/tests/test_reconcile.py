@@ -0,0 +1,158 @@
+from datetime import datetime
+from decimal import Decimal
+
+import db
+import reconcile
+from shards import StaticShardMap, tenant_for_token
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class LiveClient:
+    def __init__(self, ledgers):
+        self.ledgers = ledgers
+        self.requested = []
+
+    def for_user(self, token):
+        return self
+
+    def get_account_balances(self, account_id):
+        self.requested.append(account_id)
+        return FakeResponse(200, {'ledger': self.ledgers[account_id],
+                                  'available': self.ledgers[account_id]})
+
+    def list_account_transactions(self, account_id, count=None):
+        return FakeResponse(200, [])
+
+
+def _store(session_factory, tenant_id, account_id, ledger, day, txns=()):
+    with session_factory() as s:
+        db.upsert_account(s, {'id': account_id, 'type': 'depository'},
+                          tenant_id=tenant_id)
+        db.upsert_transactions(s, account_id, [
+            {'id': f'{account_id}_{n}', 'date': date, 'amount': amount,
+             'status': status}
+            for n, (date, amount, status) in enumerate(txns)],
+            tenant_id=tenant_id)
+        db.add_balance_snapshot(s, account_id,
+                                {'ledger': ledger, 'available': ledger},
+                                as_of=datetime(2025, 1, day),
+                                tenant_id=tenant_id)
+        s.commit()
+
+
+def _open(session_factory):
+    with session_factory() as s:
+        return sorted((d.account_id, d.kind, d.difference) for d in
+                      s.query(db.BalanceDiscrepancy)
+                      .filter(db.BalanceDiscrepancy.resolved_at.is_(None)))
+
+
+def test_stored_balance_is_checked_against_transactions_since_checkpoint(
+        session_factory):
+    tenant = tenant_for_token('token')
+    for account_id in ('acc_ok', 'acc_gap'):
+        _store(session_factory, tenant, account_id, '100.00', 1)
+    reconciler = reconcile.Reconciler(session_factory=session_factory,
+                                      batch_size=1)
+    assert reconciler.run() == []  # first run only sets checkpoints
+
+    _store(session_factory, tenant, 'acc_ok', '75.00', 5, [
+        ('2025-01-02', '-20.00', 'posted'), ('2025-01-04', '-5.00', 'posted'),
+        ('2025-01-05', '-9.00', 'pending'), ('2025-01-06', '-1.00', 'posted')])
+    _store(session_factory, tenant, 'acc_gap', '75.00', 5, [
+        ('2025-01-02', '-20.00', 'posted')])
+    found = reconcile.Reconciler(session_factory=session_factory).run()
+
+    assert found == [('acc_gap', reconcile.TRANSACTIONS, Decimal('-5.00'))]
+    assert _open(session_factory) == [
+        ('acc_gap', reconcile.TRANSACTIONS, Decimal('-5.00'))]
+    with session_factory() as s:
+        assert s.get(db.ReconciliationCheckpoint, 'acc_ok').ledger == \
+            Decimal('75.00')
+        assert s.get(db.ReconciliationCheckpoint, 'acc_gap').ledger == \
+            Decimal('100.00')
+
+
+def test_live_drift_is_recorded_and_only_drifted_accounts_resync(
+        session_factory):
+    tenant = tenant_for_token('token')
+    _store(session_factory, tenant, 'acc_1', '10.00', 1)
+    _store(session_factory, tenant, 'acc_2', '20.00', 1)
+    client = LiveClient({'acc_1': '10.00', 'acc_2': '25.00'})
+    reconciler = reconcile.Reconciler(client, session_factory)
+
+    found = reconciler.run(['token'])
+    assert found == [('acc_2', reconcile.TELLER, Decimal('-5.00'))]
+    assert reconciler.run(['token']) == found  # still open, one row
+    assert len(_open(session_factory)) == 1
+
+    client.requested.clear()
+    assert reconciler.resync(['token']) == ['acc_2']
+    assert client.requested == ['acc_2']
+    assert _open(session_factory) == []
+    with session_factory() as s:
+        assert s.get(db.LatestBalance, 'acc_2').ledger == Decimal('25.00')
+
+
+def test_run_without_tokens_visits_every_shard(db_engine, tmp_path):
+    db.shard_router.shard_map = StaticShardMap(
+        {'big': f"sqlite:///{tmp_path / 'shard.db'}"})
+    _store(db.SessionLocal, 'small', 'acc_small', '10.00', 1)
+    _store(lambda: db.session_for_tenant('big'), 'big', 'acc_big', '10.00', 1)
+
+    reconcile.Reconciler().run()
+
+    with db.session_for_tenant('big') as s:
+        assert s.get(db.ReconciliationCheckpoint, 'acc_big') is not None
+    with db.SessionLocal() as s:
+        assert s.get(db.ReconciliationCheckpoint, 'acc_small') is not None
+
+
+def test_checks_not_made_leave_their_discrepancies_open(session_factory):
+    tenant = tenant_for_token('token')
+    _store(session_factory, tenant, 'acc_1', '10.00', 1)
+    client = LiveClient({'acc_1': '15.00'})
+    reconcile.Reconciler(client, session_factory).run(['token'])
+    reconcile.Reconciler(client, session_factory).run()  # checkpoint only
+    assert reconcile.Reconciler(client, session_factory).run() == []
+
+    assert _open(session_factory) == [
+        ('acc_1', reconcile.TELLER, Decimal('-5.00'))]
+
+
+def test_transactions_of_the_checkpoint_day_are_counted_once(
+        session_factory):
+    tenant = tenant_for_token('token')
+    with session_factory() as s:
+        db.upsert_account(s, {'id': 'acc_1', 'type': 'depository'},
+                          tenant_id=tenant)
+        db.upsert_transactions(s, 'acc_1', [
+            {'id': 'early', 'date': '2025-01-01', 'amount': '-3.00'}],
+            tenant_id=tenant)
+        db.add_balance_snapshot(s, 'acc_1', {'ledger': '100.00'},
+                                as_of=datetime(2025, 1, 1, 9),
+                                tenant_id=tenant)
+        s.commit()
+    reconciler = reconcile.Reconciler(session_factory=session_factory)
+    assert reconciler.run() == []
+    with session_factory() as s:
+        assert s.get(db.ReconciliationCheckpoint,
+                     'acc_1').counted_ids == ['early']
+
+    # Posted after the 09:00 balance but dated the same day.
+    _store(session_factory, tenant, 'acc_1', '90.00', 2,
+           [('2025-01-01', '-10.00', 'posted')])
+
+    assert reconciler.run() == []
+    with session_factory() as s:
+        checkpoint = s.get(db.ReconciliationCheckpoint, 'acc_1')
+        assert checkpoint.ledger == Decimal('90.00')
+        assert checkpoint.counted_ids == []
@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+
+from sqlalchemy import event
+
+import db
+import recurring
+
+
+def _charges(prefix, start, days, count, amount="-9.99",
+             description="GYM CLUB 0042"):
+    return [{"id": f"{prefix}_{i}",
+             "date": (start + timedelta(days=days * i)).isoformat(),
+             "description": description, "amount": amount}
+            for i in range(count)]
+
+
+def test_amount_band_groups_small_price_changes():
+    assert recurring.amount_band("-15.99") == recurring.amount_band("-16.49")
+    assert recurring.amount_band("-9.99") != recurring.amount_band("-29.99")
+    assert recurring.amount_band("-9.99") != recurring.amount_band("9.99")
+
+
+def test_series_is_detected_incrementally(session):
+    txns = _charges("gym", date(2025, 1, 3), 7, 4)
+    db.upsert_transactions(session, "acc_1", txns[:2])
+    session.commit()
+    assert recurring.detected(session, db.RecurringSeries, "acc_1") == []
+
+    db.upsert_transactions(session, "acc_1", txns)
+    session.commit()
+
+    [series] = recurring.detected(session, db.RecurringSeries, "acc_1")
+    assert series["period"] == "weekly"
+    assert series["occurrences"] == 4
+    assert series["next_expected"] == "2025-01-31"
+
+
+def test_irregular_charges_are_not_recurring(session):
+    db.upsert_transactions(session, "acc_1", [
+        {"id": f"t{i}", "date": d, "description": "Corner Deli",
+         "amount": "-8.00"}
+        for i, d in enumerate(["2025-01-01", "2025-01-04", "2025-02-20"])])
+    session.commit()
+
+    assert recurring.detected(session, db.RecurringSeries, "acc_1") == []
+
+
+def test_rebuild_matches_incremental_index(session):
+    db.upsert_transactions(session, "acc_1",
+                           _charges("rent", date(2024, 1, 1), 30, 5,
+                                    amount="-1500", description="Rent"))
+    session.commit()
+    before = recurring.detected(session, db.RecurringSeries, "acc_1")
+
+    recurring.rebuild(session, db.RecurringSeries, db.Transaction)
+    session.commit()
+
+    assert recurring.detected(session, db.RecurringSeries, "acc_1") == before
+    assert before[0]["period"] == "monthly"
+
+
+def test_series_of_a_batch_are_loaded_with_one_query(session):
+    def charges(prefix, day, merchants):
+        return [{"id": f"{prefix}{i}", "date": f"2025-01-{day:02d}",
+                 "description": f"Merchant {chr(65 + i % 26)}{chr(65 + i // 26)}",
+                 "amount": "-5.00"} for i in range(merchants)]
+
+    db.upsert_transactions(session, "acc_1", charges("a", 2, 30))
+    session.commit()
+
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute",
+                 lambda *args: statements.append(args[2]))
+    db.upsert_transactions(session, "acc_1", charges("b", 9, 60))
+    session.commit()
+
+    assert len([sql for sql in statements
+                if "FROM recurring_series" in sql]) == 1
+    assert session.query(db.RecurringSeries).count() == 60
+    assert sorted({r.occurrences for r in session.query(
+        db.RecurringSeries)}) == [1, 2]
@@ -0,0 +1,42 @@
+from sqlalchemy import create_engine
+
+import db
+from shards import ShardRouter, StaticShardMap, tenant_for_token
+
+
+def test_tenant_for_token_is_stable_and_opaque():
+    tenant = tenant_for_token("token_abc")
+
+    assert tenant == tenant_for_token("token_abc")
+    assert tenant != tenant_for_token("token_xyz")
+    assert "token_abc" not in tenant
+    assert tenant_for_token("") is None
+
+
+def test_router_sends_mapped_tenants_to_their_shard(tmp_path):
+    default = create_engine("sqlite://", future=True)
+    shard_url = f"sqlite:///{tmp_path / 'big_customer.db'}"
+    router = ShardRouter(default, db.Base.metadata,
+                         StaticShardMap({"big": shard_url}))
+
+    assert router.is_default(None)
+    assert router.is_default("small")
+    assert router.sessionmaker_for("small") is None
+
+    factory = router.sessionmaker_for("big")
+    with factory() as s:
+        db.upsert_account(s, {"id": "acc_1"}, tenant_id="big")
+        s.commit()
+        assert str(s.get_bind().url) == shard_url
+        assert s.get(db.Account, "acc_1").tenant_id == "big"
+    assert router.sessionmaker_for("big") is factory
+
+
+def test_router_lists_every_shard(tmp_path):
+    default = create_engine("sqlite://", future=True)
+    shard_url = f"sqlite:///{tmp_path / 'shard.db'}"
+    router = ShardRouter(default, db.Base.metadata,
+                         StaticShardMap({"a": shard_url, "b": shard_url}))
+
+    assert router.sessionmakers() == [router.sessionmaker_for("a")]
+    assert ShardRouter(default, db.Base.metadata).sessionmakers() == []
@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+
+import falcon
+import falcon.testing
+import pytest
+
+import offline
+import shared_state
+import teller
+
+
+class FakeRedis:
+    """Local stand-in for the few redis-py calls RedisState makes."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        value, expires = self._data.get(key, (None, None))
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            value = self._live(key)
+        return None if value is None else str(value).encode()
+
+    def set(self, key, value, px=None, nx=False):
+        with self._lock:
+            if nx and self._live(key) is not None:
+                return None
+            expires = time.monotonic() + px / 1000 if px else None
+            self._data[key] = (value, expires)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._live(key) or 0) + 1
+            expires = self._data.get(key, (None, None))[1]
+            self._data[key] = (value, expires)
+            return value
+
+    def pexpire(self, key, ms):
+        with self._lock:
+            self._data[key] = (self._data[key][0],
+                               time.monotonic() + ms / 1000)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def state(request, tmp_path):
+    if request.param == 'memory':
+        return shared_state.MemoryState()
+    if request.param == 'sqlite':
+        return shared_state.SQLiteState(str(tmp_path / 'state.sqlite'))
+    return shared_state.RedisState(FakeRedis())
+
+
+def test_values_expire(state):
+    state.set('k', 'v', 0.05)
+    assert state.get('k') == 'v'
+    time.sleep(0.06)
+    assert state.get('k') is None
+
+
+def test_locks_are_exclusive_until_released_or_expired(state):
+    token = state.acquire('lock', 0.05)
+    assert token is not None
+    assert state.acquire('lock', 0.05) is None
+    state.release('lock', 'someone-else')
+    assert state.acquire('lock', 0.05) is None
+    state.release('lock', token)
+    assert state.acquire('lock', 0.05) is not None
+    time.sleep(0.06)
+    assert state.acquire('lock', 0.05) is not None
+
+
+def test_hits_are_limited_per_window(state):
+    assert [state.hit('bucket', 2, 0.1) for _ in range(3)] == [
+        True, True, False]
+    time.sleep(0.11)
+    assert state.hit('bucket', 2, 0.1)
+
+
+def test_sqlite_state_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'state.sqlite')
+    first = shared_state.SQLiteState(path)
+    second = shared_state.SQLiteState(path)
+    token = first.acquire('lock', 5)
+    assert second.acquire('lock', 5) is None
+    first.set('answer', '42', 5)
+    assert second.wait_for('answer', 'lock', 1) == '42'
+    first.release('lock', token)
+    assert second.wait_for('missing', 'lock', 1) is None
+
+
+class SlowClient:
+    def __init__(self):
+        self.calls = 0
+
+    def for_user(self, token):
+        return self
+
+    def list_accounts(self):
+        self.calls += 1
+        time.sleep(0.1)
+        return _Response('[{"id": "acc_1"}]')
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode()
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _worker(client, state, policy=None, **kwargs):
+    app = falcon.App()
+    resource = teller.AccountsResource(
+        client, state=state,
+        offline_policy=policy or offline.OfflinePolicy(mode='off'), **kwargs)
+    app.add_route('/api/accounts', resource)
+    return falcon.testing.TestClient(app)
+
+
+def test_workers_share_one_teller_call(tmp_path, monkeypatch):
+    monkeypatch.setattr(teller.AccountsResource, '_store_accounts',
+                        lambda *args: None)
+    path = str(tmp_path / 'state.sqlite')
+    client = SlowClient()
+    workers = [_worker(client, shared_state.SQLiteState(path), cache_ttl=5)
+               for _ in range(3)]
+    results = []
+
+    def call(http):
+        results.append(http.simulate_get(
+            '/api/accounts', headers={'Authorization': 'token'}))
+
+    threads = [threading.Thread(target=call, args=(w,)) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert [r.json for r in results] == [[{'id': 'acc_1'}]] * 3
+    assert client.calls == 1
+
+
+def test_teller_calls_are_rate_limited_per_user(db_engine, monkeypatch):
+    monkeypatch.setattr(teller.AccountsResource, '_store_accounts',
+                        lambda *args: None)
+    http = _worker(SlowClient(), shared_state.MemoryState(), rate_limit=1)
+    headers = {'Authorization': 'token'}
+    assert http.simulate_get('/api/accounts', headers=headers).status_code \
+        == 200
+    limited = http.simulate_get('/api/accounts', headers=headers)
+    assert limited.status_code == 429
+    assert limited.headers['Retry-After'] == '60'
+
+
+def test_rate_limited_calls_fall_back_to_stored_data(db_engine):
+    policy = offline.OfflinePolicy(refresh_interval=0)
+    http = _worker(SlowClient(), shared_state.MemoryState(), policy,
+                   rate_limit=1)
+    headers = {'Authorization': 'token'}
+    assert http.simulate_get('/api/accounts', headers=headers).status_code \
+        == 200
+
+    limited = http.simulate_get('/api/accounts', headers=headers)
+    assert limited.status_code == 200
+    assert limited.headers['X-Data-Reason'] == offline.RATE_LIMITED
+    assert limited.json == [{'id': 'acc_1', 'name': None, 'type': None,
+                             'subtype': None, 'last_four': None,
+                             'institution': {'id': None}}]
+    # The background refresh writes to the database; let it finish first.
+    deadline = time.monotonic() + 5
+    while policy._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
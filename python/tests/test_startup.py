@@ -0,0 +1,45 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import teller
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+
+# Falcon and SQLAlchemy are imported first so that ``elapsed`` is the cost
+# of this package alone, which is what the budget below is about.
+_PROBE = """
+import json, sys, time
+import falcon, sqlalchemy.orm
+start = time.perf_counter()
+import teller
+elapsed = time.perf_counter() - start
+import db
+print(json.dumps({
+    'elapsed': elapsed,
+    'lazy': sorted(m for m in %r if m in sys.modules),
+    'engine': db.engine is not None,
+}))
+"""
+
+# Only loaded when a request, create_app() or a CLI needs them.
+LAZY = ('requests', 'numpy', 'pyarrow', 'writebehind', 'payments', 'offline',
+        'shared_state', 'archive', 'recurring', 'events', 'query_stats')
+
+
+def test_importing_teller_is_cheap():
+    out = subprocess.run([sys.executable, '-c', _PROBE % (LAZY,)],
+                         cwd=PYTHON_DIR,
+                         capture_output=True, text=True, check=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    assert result['lazy'] == []
+    assert result['engine'] is False
+    assert result['elapsed'] < 0.3
+
+
+def test_per_user_clients_share_one_session():
+    client = teller.TellerClient(None)
+    alice = client.for_user('token-a')
+    bob = client.for_user('token-b')
+    assert alice._session() is bob._session() is client._session()
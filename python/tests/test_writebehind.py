@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+import db
+from writebehind import Spool, SpoolFull, WriteBehindWriter
+
+
+ACCOUNT = {"id": "acc_1", "name": "Checking", "institution": {"id": "bank"}}
+
+
+def test_spool_survives_reopen(tmp_path):
+    path = tmp_path / "spool.sqlite"
+    spool = Spool(str(path))
+    spool.put('balance', 'acc_1', ACCOUNT, {"available": "1.00"})
+    spool.close()
+
+    reopened = Spool(str(path))
+
+    assert len(reopened) == 1
+    assert reopened.peek(10)[0][1] == 'balance'
+
+
+def test_spool_applies_backpressure(tmp_path):
+    spool = Spool(str(tmp_path / "spool.sqlite"), max_items=1)
+    spool.put('balance', 'acc_1', ACCOUNT, {"available": "1.00"})
+
+    with pytest.raises(SpoolFull):
+        spool.put('balance', 'acc_1', ACCOUNT, {"available": "2.00"},
+                  timeout=0.01)
+
+
+def test_writer_flushes_spool_on_stop(tmp_path, session_factory):
+    spool = Spool(str(tmp_path / "spool.sqlite"))
+    writer = WriteBehindWriter(spool, session_factory)
+    writer.start()
+    writer.submit('balance', 'acc_1', ACCOUNT,
+                  {"available": "10.00", "ledger": "12.00"})
+    writer.submit('transactions', 'acc_1', ACCOUNT,
+                  [{"id": "txn_1", "date": "2025-01-02", "amount": "-3.50"}],
+                  tenant_id="tenant-a")
+
+    writer.stop()
+
+    assert len(spool) == 0
+    with session_factory() as s:
+        assert s.query(db.BalanceSnapshot).count() == 1
+        txn = s.get(db.Transaction, "txn_1")
+        assert txn.amount == db.Decimal("-3.50")
+        assert txn.tenant_id == "tenant-a"
+
+
+def test_bad_item_is_dropped_without_blocking_others(tmp_path,
+                                                     session_factory):
+    spool = Spool(str(tmp_path / "spool.sqlite"))
+    writer = WriteBehindWriter(spool, session_factory, max_attempts=1)
+    spool.put('transactions', 'acc_1', ACCOUNT, [{"id": "txn_bad"}])
+    spool.put('balance', 'acc_1', ACCOUNT, {"available": "1.00"})
+
+    writer.flush()
+
+    assert len(spool) == 0
+    with session_factory() as s:
+        assert s.query(db.BalanceSnapshot).count() == 1
+        assert s.query(db.Transaction).count() == 0
+
+
+def test_stop_timeout_does_not_drain_alongside_the_writer(tmp_path,
+                                                          session_factory):
+    spool = Spool(str(tmp_path / "spool.sqlite"))
+    entered, release = threading.Event(), threading.Event()
+    sessions = []
+
+    def slow_factory(tenant_id=None):
+        sessions.append(threading.current_thread().name)
+        entered.set()
+        release.wait(5)
+        return session_factory(tenant_id)
+
+    writer = WriteBehindWriter(spool, slow_factory)
+    writer.submit('balance', 'acc_1', ACCOUNT, {"available": "1.00"})
+    writer.start()
+    assert entered.wait(5)
+
+    writer.stop(timeout=0.05)
+    release.set()
+
+    assert sessions == ['write-behind']
+    assert _wait_for(lambda: len(spool) == 0)
+    with session_factory() as s:
+        assert s.query(db.BalanceSnapshot).count() == 1
+
+
+def _wait_for(predicate):
+    deadline = time.monotonic() + 5
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
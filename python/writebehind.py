@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+SpooledWrite = namedtuple('SpooledWrite', 'id kind account_id account payload '
+                                          'queued_at attempts tenant_id')
+
+
+class Spool:
+    """Bounded, durable FIFO of pending DB writes backed by a SQLite file."""
+
+    def __init__(self, path, max_items=10000):
+        self._max_items = max_items
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " account_id TEXT NOT NULL,"
+            " account TEXT,"
+            " payload TEXT NOT NULL,"
+            " queued_at TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " tenant_id TEXT)")
+        columns = [row[1] for row in
+                   self._conn.execute("PRAGMA table_info(spool)")]
+        if 'tenant_id' not in columns:  # spool written by an older version
+            self._conn.execute("ALTER TABLE spool ADD COLUMN tenant_id TEXT")
+        self._cond = threading.Condition()
+        self._size = self._conn.execute(
+            "SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    def put(self, kind, account_id, account, payload, tenant_id=None,
+            timeout=0.5):
+        """Append a write, waiting up to ``timeout`` seconds for room."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._size >= self._max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SpoolFull(f"write-behind spool holds "
+                                    f"{self._size} items")
+                self._cond.wait(remaining)
+            self._conn.execute(
+                "INSERT INTO spool (kind, account_id, account, payload,"
+                " queued_at, tenant_id) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, account_id, json.dumps(account), json.dumps(payload),
+                 datetime.utcnow().isoformat(), tenant_id))
+            self._size += 1
+            self._cond.notify_all()
+
+    def peek(self, limit):
+        with self._cond:
+            rows = self._conn.execute(
+                "SELECT id, kind, account_id, account, payload, queued_at,"
+                " attempts, tenant_id FROM spool ORDER BY id LIMIT ?",
+                (limit,)).fetchall()
+        return [SpooledWrite(row_id, kind, account_id, json.loads(account),
+                             json.loads(payload),
+                             datetime.fromisoformat(queued_at), attempts,
+                             tenant_id)
+                for (row_id, kind, account_id, account, payload, queued_at,
+                     attempts, tenant_id) in rows]
+
+    def ack(self, ids):
+        if not ids:
+            return
+        with self._cond:
+            self._conn.executemany("DELETE FROM spool WHERE id = ?",
+                                   [(i,) for i in ids])
+            self._size -= len(ids)
+            self._cond.notify_all()
+
+    def record_failure(self, ids):
+        with self._cond:
+            self._conn.executemany(
+                "UPDATE spool SET attempts = attempts + 1 WHERE id = ?",
+                [(i,) for i in ids])
+
+    def wait_for_items(self, timeout):
+        with self._cond:
+            if self._size == 0:
+                self._cond.wait(timeout)
+            return self._size > 0
+
+    def close(self):
+        with self._cond:
+            self._conn.close()
+
+
+def apply_write(s, item):
+    """Apply one spooled Teller payload to the session ``s``."""
+    from db import add_balance_snapshot, upsert_account, upsert_transactions
+
+    if item.account:
+        upsert_account(s, item.account, tenant_id=item.tenant_id)
+    if item.kind == 'balance':
+        add_balance_snapshot(s, item.account_id, item.payload,
+                             as_of=item.queued_at, tenant_id=item.tenant_id)
+    elif item.kind == 'transactions':
+        upsert_transactions(s, item.account_id, item.payload,
+                            tenant_id=item.tenant_id)
+    else:
+        raise ValueError(f"unknown write-behind kind: {item.kind}")
+
+
+class WriteBehindWriter:
+    """Drains a :class:`Spool` into the database on a background thread.
+
+    Items are applied in batches, one transaction per tenant in the batch;
+    ``session_factory`` is called with the tenant id. A batch that
+    fails is retried item by item so one bad payload cannot block the rest;
+    items that keep failing are dropped after ``max_attempts``. Connection
+    errors never count as attempts: the writer backs off and retries until
+    the database is reachable again.
+    """
+
+    def __init__(self, spool, session_factory, batch_size=200,
+                 max_attempts=5, retry_delay=1.0):
+        self._spool = spool
+        self._session_factory = session_factory
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, session_factory):
+        spool = Spool(os.getenv('WRITE_BEHIND_SPOOL', 'write_behind.sqlite'),
+                      int(os.getenv('WRITE_BEHIND_MAX_ITEMS', '10000')))
+        return cls(spool, session_factory,
+                   batch_size=int(os.getenv('WRITE_BEHIND_BATCH', '200')))
+
+    def submit(self, kind, account_id, account, payload, tenant_id=None):
+        self._spool.put(kind, account_id, account, payload,
+                        tenant_id=tenant_id)
+
+    def offer(self, kind, account_id, account, payload, tenant_id=None):
+        """Like ``submit`` but returns False instead of raising SpoolFull."""
+        try:
+            self.submit(kind, account_id, account, payload,
+                        tenant_id=tenant_id)
+        except SpoolFull:
+            return False
+        return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='write-behind', daemon=True)
+        self._thread.start()
+        logger.info(f"Write-behind writer started "
+                    f"({len(self._spool)} items pending)")
+
+    def stop(self, timeout=30):
+        """Stop the writer, flushing everything still in the spool.
+
+        If the writer thread is still busy after ``timeout`` the spool is
+        left as it is, to be drained after the next start; flushing from
+        this thread as well would apply the same items twice.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"Write-behind writer did not stop within "
+                           f"{timeout}s, leaving {len(self._spool)} items "
+                           f"in the spool")
+            return
+        self._thread = None
+        self.flush()
+        if len(self._spool):
+            logger.warning(f"Write-behind stopped with {len(self._spool)} "
+                           f"items left in the spool")
+
+    def flush(self):
+        while self.drain_once():
+            pass
+
+    def drain_once(self):
+        """Apply one batch; return True if progress was made."""
+        batch = self._spool.peek(self._batch_size)
+        if not batch:
+            return False
+        by_tenant = {}
+        for item in batch:
+            by_tenant.setdefault(item.tenant_id, []).append(item)
+        progressed = False
+        for tenant_id, items in by_tenant.items():
+            try:
+                with self._session_factory(tenant_id) as s:
+                    for item in items:
+                        apply_write(s, item)
+                    s.commit()
+                self._spool.ack([item.id for item in items])
+                progressed = True
+                continue
+            except Exception:
+                logger.warning(f"Write-behind batch of {len(items)} failed, "
+                               f"retrying items individually", exc_info=True)
+            progressed = self._drain_individually(items) or progressed
+        return progressed
+
+    def _drain_individually(self, items):
+        done, failed = [], []
+        for item in items:
+            try:
+                with self._session_factory(item.tenant_id) as s:
+                    apply_write(s, item)
+                    s.commit()
+                done.append(item.id)
+            except OperationalError:
+                logger.warning("Database unavailable, write-behind backing "
+                               "off", exc_info=True)
+                break
+            except Exception:
+                if item.attempts + 1 >= self._max_attempts:
+                    logger.error(f"Dropping {item.kind} write for account "
+                                 f"{item.account_id} after "
+                                 f"{item.attempts + 1} attempts",
+                                 exc_info=True)
+                    done.append(item.id)
+                else:
+                    failed.append(item.id)
+        self._spool.ack(done)
+        self._spool.record_failure(failed)
+        return bool(done)
+
+    def _run(self):
+        delay = self._retry_delay
+        while not self._stopping.is_set():
+            if not self._spool.wait_for_items(timeout=1.0):
+                continue
+            try:
+                progressed = self.drain_once()
+            except Exception:
+                logger.error("Write-behind drain failed", exc_info=True)
+                progressed = False
+            if progressed:
+                delay = self._retry_delay
+            else:
+                self._stopping.wait(delay)
+                delay = min(delay * 2, 60)
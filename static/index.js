@@ -77,11 +77,38 @@ class Client {
   }
 
   createAccountPayee(account, payee) {
-    return this.post(`/accounts/${account.id}/payments/zelle/payees`, payee);
+    return this.submit(`/accounts/${account.id}/payments/zelle/payees`, payee);
   }
 
   createAccountPayment(account, payment) {
-    return this.post(`/accounts/${account.id}/payments/zelle`, payment);
+    return this.submit(`/accounts/${account.id}/payments/zelle`, payment);
+  }
+
+  // Payments and payees are queued by the server (202 + request status).
+  // Poll until Teller has answered and resolve with Teller's response.
+  submit(path, data) {
+    const client = this;
+    const headers = { 'Idempotency-Key': crypto.randomUUID() };
+    const poll = function(status) {
+      if (['succeeded', 'failed', 'unknown'].includes(status.status)) {
+        const body = status.response || { error: status.error };
+        return new Response(JSON.stringify(body), {
+          status: status.response_status || 502,
+          headers: { 'Content-Type': 'application/json' },
+        });
+      }
+      return new Promise(function(resolve) { setTimeout(resolve, 500); })
+        .then(function() { return client.get(`/payments/${status.id}`); })
+        .then(function(response) { return response.json(); })
+        .then(poll);
+    };
+    return this.request('POST', path, JSON.stringify(data), headers)
+      .then(function(response) {
+        if (response.status !== 200 && response.status !== 202) {
+          return response;
+        }
+        return response.json().then(poll);
+      });
   }
 
   get(path) {
@@ -92,12 +119,13 @@ class Client {
     return this.request('POST', path, JSON.stringify(data));
   }
 
-  request(method, path, data) {
+  request(method, path, data, extraHeaders) {
     const request = new Request(this.baseURL + path, {
       method: method,
       headers: new Headers({
         'Authorization': this.accessToken,
         'Content-Type': 'application/json',
+        ...extraHeaders,
       }),
       body: data,
     });
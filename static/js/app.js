@@ -56,6 +56,11 @@ class Api {
     if (!r.ok) throw new Error(`getLiveBalances ${r.status}`);
     return r.json();
   }
+  static async getDashboard(limit = TX_LIMIT) {
+    const r = await fetch(`${DB_API}/dashboard?limit=${limit}`, { headers: { ...authHeaders() } });
+    if (!r.ok) throw new Error(`dashboard ${r.status}`);
+    return r.json();
+  }
   static async listDbTransactions(accountId, limit = TX_LIMIT) {
     const r = await fetch(`${DB_API}/accounts/${accountId}/transactions?limit=${limit}`, { headers: { ...authHeaders() } });
     if (!r.ok) throw new Error(`transactions ${r.status}`);
@@ -197,15 +202,36 @@ function persistAccountIds(ids) {
   }
 }
 
+// Stored balances and recent transactions of every account, loaded with one
+// request; entries are dropped when a live update makes them stale.
+let dashboardByAccount = new Map();
+
+async function loadDashboard() {
+  try {
+    const data = await Api.getDashboard();
+    dashboardByAccount = new Map(data.accounts.map(a => [a.id, a]));
+  } catch (e) {
+    console.log('[app.js] dashboard unavailable, loading accounts one by one', e && e.message);
+    dashboardByAccount = new Map();
+  }
+}
+
+async function storedBalance(accountId) {
+  const entry = dashboardByAccount.get(accountId);
+  if (entry && entry.balance) return entry.balance;
+  return Api.getDbBalances(accountId);
+}
+
 async function hydrateBalances(ids) {
   console.log('[DEBUG] hydrateBalances called with ids:', ids);
   let cb = null, sb = null;
+  await loadDashboard();
   const checkingEl = document.querySelector(ACCOUNTS_PAGE.checking.balanceEl);
   const savingsEl = document.querySelector(ACCOUNTS_PAGE.savings.balanceEl);
   try {
     if (ids.checkingId) {
       console.log('[DEBUG] Fetching checking balance from DB for id:', ids.checkingId);
-      cb = await Api.getDbBalances(ids.checkingId);
+      cb = await storedBalance(ids.checkingId);
       console.log('[DEBUG] Checking balance from DB:', cb);
       if (checkingEl) {
         const formattedBalance = formatUSD(cb.available);
@@ -223,7 +249,7 @@ async function hydrateBalances(ids) {
   try {
     if (ids.savingsId) {
       console.log('[DEBUG] Fetching savings balance from DB for id:', ids.savingsId);
-      sb = await Api.getDbBalances(ids.savingsId);
+      sb = await storedBalance(ids.savingsId);
       console.log('[DEBUG] Savings balance from DB:', sb);
       if (savingsEl) {
         const formattedBalance = formatUSD(sb.available);
@@ -268,6 +294,101 @@ async function refreshTellerBalances(ids) {
   }
 }
 
+// EventSource cannot send the Authorization header the stream requires, so
+// the stream is read with fetch and its frames are parsed here.
+class AuthorizedEventStream {
+  constructor(url) {
+    this.url = url;
+    this.listeners = {};
+    this.controller = null;
+    this.closed = false;
+    this.retry = 5000;
+    this.connect();
+  }
+
+  addEventListener(type, fn) {
+    (this.listeners[type] = this.listeners[type] || []).push(fn);
+  }
+
+  close() {
+    this.closed = true;
+    if (this.controller) this.controller.abort();
+  }
+
+  async connect() {
+    while (!this.closed) {
+      this.controller = new AbortController();
+      try {
+        const r = await fetch(this.url, { headers: { ...authHeaders() }, signal: this.controller.signal });
+        if (r.status === 401 || r.status === 404) return;
+        if (r.ok && r.body) await this.read(r.body.getReader());
+      } catch (e) {
+        if (this.closed) return;
+        console.warn('[app.js] live update stream interrupted', e);
+      }
+      if (!this.closed) await new Promise(resolve => setTimeout(resolve, this.retry));
+    }
+  }
+
+  async read(reader) {
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) return;
+      buffer += decoder.decode(value, { stream: true });
+      let end;
+      while ((end = buffer.indexOf('\n\n')) >= 0) {
+        this.dispatch(buffer.slice(0, end));
+        buffer = buffer.slice(end + 2);
+      }
+    }
+  }
+
+  dispatch(frame) {
+    let type = 'message';
+    const data = [];
+    for (const line of frame.split('\n')) {
+      if (line.startsWith('event: ')) type = line.slice(7);
+      else if (line.startsWith('data: ')) data.push(line.slice(6));
+      else if (line.startsWith('retry: ')) this.retry = Number(line.slice(7)) || this.retry;
+    }
+    if (!data.length) return;
+    const event = { data: data.join('\n') };
+    (this.listeners[type] || []).forEach(fn => fn(event));
+  }
+}
+
+let liveBalanceStream = null;
+
+function subscribeLiveBalances(ids) {
+  if (!window.fetch || !window.ReadableStream || !getAccessToken()) return;
+  const accountIds = [ids.checkingId, ids.savingsId].filter(Boolean);
+  if (!accountIds.length) return;
+  if (liveBalanceStream) liveBalanceStream.close();
+  const query = accountIds.map(id => `account_id=${encodeURIComponent(id)}`).join('&');
+  liveBalanceStream = new AuthorizedEventStream(`${API_BASE}/stream/accounts?${query}`);
+  liveBalanceStream.addEventListener('transactions', (e) => {
+    dashboardByAccount.delete(JSON.parse(e.data).account_id);
+  });
+  liveBalanceStream.addEventListener('balance', (e) => {
+    const evt = JSON.parse(e.data);
+    console.log('[app.js] live balance update', evt);
+    dashboardByAccount.delete(evt.account_id);
+    if (evt.account_id === ids.checkingId) {
+      const el = document.querySelector(ACCOUNTS_PAGE.checking.balanceEl);
+      if (el) el.textContent = formatUSD(evt.available);
+      accountsData.llcBank.balance = parseFloat(evt.available) || 0;
+    } else if (evt.account_id === ids.savingsId) {
+      const el = document.querySelector(ACCOUNTS_PAGE.savings.balanceEl);
+      if (el) el.textContent = formatUSD(evt.available);
+      accountsData.llcSavings.balance = parseFloat(evt.available) || 0;
+    }
+    const equityEl = document.getElementById('total-equity-balance');
+    if (equityEl) equityEl.textContent = formatCurrency(calculateTotalEquity());
+  });
+}
+
 function renderTransactions(transactions) {
   const container = document.createElement('div');
   if (!transactions || !transactions.length) {
@@ -327,8 +448,9 @@ async function onCardClick(kind, ids) {
   content.appendChild(spinner);
   openModal(kind === 'checking' ? 'LLC Checking' : 'LLC Savings', 'Recent activity', content);
   try {
-    const bal = await Api.getDbBalances(id);
-    const txs = await Api.listDbTransactions(id, TX_LIMIT);
+    const entry = dashboardByAccount.get(id);
+    const bal = await storedBalance(id);
+    const txs = entry ? entry.transactions : await Api.listDbTransactions(id, TX_LIMIT);
     content.innerHTML = '';
     content.appendChild(renderBalanceDetail(bal));
     content.appendChild(renderTransactions(txs));
@@ -374,6 +496,7 @@ async function handleRefresh() {
           const mergedIds = persistAccountIds(ids);
           console.log('[app.js] persisted and merged account IDs', mergedIds);
           window.__llcIds = mergedIds;
+          subscribeLiveBalances(mergedIds);
           
           await fetchFreshBalances(mergedIds);
           console.log('[app.js] fetched fresh balances from Teller API');
@@ -456,6 +579,7 @@ async function handleRefresh() {
         const mergedIds = persistAccountIds(ids);
         console.log('[app.js] persisted and merged account IDs', mergedIds);
         window.__llcIds = mergedIds;
+        subscribeLiveBalances(mergedIds);
         
         await fetchFreshBalances(mergedIds);
         console.log('[app.js] fetched fresh balances from Teller API (simulated)');
@@ -1262,6 +1386,7 @@ document.addEventListener('DOMContentLoaded', async () => {
   } catch (e) {
     console.log('[app.js] hydrate cached failed', e && e.message);
   }
+  subscribeLiveBalances(ids);
 
   try {
     await loadAccountDataFromBackend();
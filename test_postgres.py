@@ -5,7 +5,7 @@ import os
 import sys
 sys.path.append('python')
 
-from python.db import engine, init_db, SessionLocal, Account, BalanceSnapshot, Transaction
+from python.db import init_engine, init_db, SessionLocal, Account, BalanceSnapshot, Transaction
 from decimal import Decimal
 from datetime import datetime, date
 
@@ -17,7 +17,7 @@ def test_postgres_connection():
     
     try:
         print(f"Database URL: {os.getenv('DATABASE_URL')}")
-        print(f"Engine URL: {engine.url}")
+        print(f"Engine URL: {init_engine().url}")
         
         print("Creating tables...")
         init_db()